@@ -1,23 +1,44 @@
-from flask import Flask, request, jsonify, send_file, current_app, send_from_directory
+from flask import Flask, request, jsonify, send_file, current_app, send_from_directory, Response, g, redirect
 from flask_cors import CORS
 import os
+import logging
 from dotenv import load_dotenv
 from openai import OpenAI
 import json
-from PIL import Image, ImageDraw
-import io
-import tempfile
-import requests
-from datetime import datetime
-import sqlite3
-from pathlib import Path
 import re
 import time
-import uuid
+import base64
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import db
+from jobs import JobQueue, QueueFull, FINISHED_STATUSES
+from limiter import AdmissionController, Overloaded
+from cache import GenerationCache
+import masks
+import fetch
+import thumbnails
+import storage
+import reconcile
+import similarity
+import search
+import export
+import metrics
+from imaging import (
+    MAX_UPLOAD_BYTES, PNG_COMPRESS_LEVEL, UploadTooLarge, fit_to_square, open_upload, upload_suffix, upright_size
+)
+from preprocess import Preprocessor
+from metrics import span
 
 # Load environment variables
 load_dotenv()
 
+# LOG_LEVEL=DEBUG brings back the per-request image and prompt dumps
+logging.basicConfig(
+    level=os.getenv('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(name)s: %(message)s'
+)
+logger = logging.getLogger('app')
+
 # Initialize Flask app
 app = Flask(__name__)
 
@@ -29,238 +50,642 @@ api_key = os.getenv('OPENAI_API_KEY')
 if not api_key:
     raise ValueError("OpenAI API key not found in environment variables")
 
-client = OpenAI(api_key=api_key)
-
-# Create storage directory if it doesn't exist
-STORAGE_DIR = Path(os.path.abspath(os.path.dirname(__file__))) / "stored_images"
-STORAGE_DIR.mkdir(exist_ok=True)
-
-print(f"Storage directory: {STORAGE_DIR}")
-
-def get_absolute_url(filename):
-    """Get absolute URL for a file"""
-    return f"https://interior-image-generation.onrender.com/api/stored-image/{filename}"
-
-# Database initialization
-def init_db():
-    conn = sqlite3.connect('images.db')
-    c = conn.cursor()
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS generated_images
-        (id INTEGER PRIMARY KEY AUTOINCREMENT,
-         original_path TEXT NOT NULL,
-         generated_path TEXT NOT NULL,
-         style TEXT NOT NULL,
-         room_type TEXT NOT NULL,
-         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
-    ''')
-    conn.commit()
-    conn.close()
-
-# Initialize database on startup
-init_db()
-
-def save_image_from_url(url, filename):
-    """Download and save image from URL"""
-    response = requests.get(url)
-    if response.status_code == 200:
-        img_path = STORAGE_DIR / filename
-        with open(img_path, 'wb') as f:
-            f.write(response.content)
-        return str(img_path)
-    return None
-
-def validate_stored_images():
-    """Clean up database entries that don't have corresponding image files"""
-    conn = sqlite3.connect('images.db')
-    c = conn.cursor()
-    
-    # Get all entries
-    c.execute('SELECT id, original_path, generated_path FROM generated_images')
-    rows = c.fetchall()
-    
-    # Check each entry
-    for row in rows:
-        id, original_path, generated_path = row
-        original_exists = (STORAGE_DIR / Path(original_path).name).exists()
-        generated_exists = (STORAGE_DIR / Path(generated_path).name).exists()
-        
-        if not (original_exists and generated_exists):
-            print(f"Removing invalid entry {id} due to missing files")
-            c.execute('DELETE FROM generated_images WHERE id = ?', (id,))
-    
-    conn.commit()
-    conn.close()
+# Retries are left to the admission controller below, which backs
+# everyone off on a 429 instead of each request retrying on its own
+client = OpenAI(api_key=api_key, max_retries=0)
+
+upstream = AdmissionController(
+    rate=float(os.getenv('UPSTREAM_RATE', 2)),
+    burst=int(os.getenv('UPSTREAM_BURST', 5)),
+    initial_limit=int(os.getenv('UPSTREAM_CONCURRENCY', 4)),
+    max_limit=int(os.getenv('UPSTREAM_MAX_CONCURRENCY', 16)),
+    max_wait=float(os.getenv('UPSTREAM_MAX_WAIT', 30)),
+    max_retries=int(os.getenv('UPSTREAM_RETRIES', 2))
+)
+
+# 'url' downloads the result in a second request; 'b64_json' returns it inline
+RESPONSE_FORMAT = os.getenv('OPENAI_RESPONSE_FORMAT', 'url')
+if RESPONSE_FORMAT not in ('url', 'b64_json'):
+    raise ValueError("OPENAI_RESPONSE_FORMAT must be 'url' or 'b64_json'")
+
+EDIT_MODEL = "dall-e-2"
+FULL_SIZE = 1024
+EDIT_SIZE = "1024x1024"
+# Cheaper, faster edits a client can ask for while it picks a style;
+# a preview is rendered at FULL_SIZE once it is finalized
+PREVIEW_SIZES = (256, 512)
+# A finalize claim older than this belongs to a render that died
+FINALIZE_CLAIM_SECONDS = 300
+# How long a second finalize call waits for the first before a 503
+FINALIZE_MAX_WAIT = 120
+FINALIZE_POLL_SECONDS = 0.5
+# Dollars per generated image, from OpenAI's published pricing
+IMAGE_PRICES = {
+    ("dall-e-2", "1024x1024"): 0.020,
+    ("dall-e-2", "512x512"): 0.018,
+    ("dall-e-2", "256x256"): 0.016,
+}
+
+upstream_cost_dollars = metrics.counter(
+    'designspace_upstream_cost_dollars_total', 'Estimated spend on billed OpenAI image edits')
+generations_total = metrics.counter(
+    'designspace_generations_total', 'Generated designs by where the image came from')
+http_requests_total = metrics.counter(
+    'designspace_http_requests_total', 'HTTP responses by endpoint and status')
+http_request_seconds = metrics.histogram(
+    'designspace_http_request_seconds', 'Time to produce a response, by endpoint')
+
+# Where this backend is reachable from the browser; image URLs point here
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', 'https://interior-image-generation.onrender.com')
+
+# Uploaded and generated images, on local disk or in a bucket (see storage.py)
+image_store = storage.from_env(PUBLIC_BASE_URL)
+logger.info("Image storage: %s", image_store)
+
+def get_absolute_url(key):
+    """Get absolute URL for a stored image"""
+    return image_store.url(key)
+
+# Create or upgrade the database schema on startup
+db.migrate()
+
+# Encode the fixed edit masks once instead of on every request
+masks.warm([(size, size) for size in (FULL_SIZE,) + PREVIEW_SIZES])
+
+# Larger request bodies are refused before they are read
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Upload preprocessing runs in worker processes, with a bounded queue in front.
+# On a single core the workers would only add IPC, so it stays in-thread there
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', os.cpu_count() if (os.cpu_count() or 1) > 1 else 0))
+preprocessor = Preprocessor(
+    workers=PREPROCESS_WORKERS,
+    max_queued=int(os.getenv('PREPROCESS_QUEUE', max(1, PREPROCESS_WORKERS) * 2)),
+    max_wait=float(os.getenv('PREPROCESS_MAX_WAIT', 10)),
+    compress_level=PNG_COMPRESS_LEVEL
+)
 
-def store_generation_data(original_path, generated_path, style, room_type):
-    """Store generation data in database"""
+# Page sizes for /api/generations
+GENERATIONS_PAGE_SIZE = 50
+GENERATIONS_MAX_PAGE_SIZE = 200
+# Days of volume /api/generations/stats reports by default, and at most
+STATS_DAYS = 30
+STATS_MAX_DAYS = 366
+# Generations that can be picked by id in one export
+EXPORT_MAX_IDS = 1000
+
+# Background pool that runs queued generations (see /api/jobs)
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 4))
+JOB_MAX_PENDING = int(os.getenv('JOB_MAX_PENDING', 32))
+# Unfinished jobs whose worker hasn't reported them alive for this long are failed
+JOB_HEARTBEAT_SECONDS = float(os.getenv('JOB_HEARTBEAT_SECONDS', 10))
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', 60))
+SSE_KEEPALIVE_SECONDS = 15
+
+# Batch generation: variants per request and concurrent upstream calls per batch
+BATCH_MAX_VARIANTS = int(os.getenv('BATCH_MAX_VARIANTS', 18))
+BATCH_CONCURRENCY = int(os.getenv('BATCH_CONCURRENCY', 3))
+
+# Reuse generated images for repeat submissions of the same photo and prompt
+CACHE_ENABLED = os.getenv('GENERATION_CACHE', '1') != '0'
+generation_cache = GenerationCache(
+    image_store,
+    max_entries=int(os.getenv('CACHE_MAX_ENTRIES', 1000)),
+    max_bytes=int(os.getenv('CACHE_MAX_BYTES', 1 << 30)),
+    max_age=int(os.getenv('CACHE_MAX_AGE_DAYS', 30)) * 86400
+)
+
+# Opt-in reuse of an earlier generation when the same room was uploaded
+# before (see similarity.py); distance is in bits of a 64-bit hash
+SIMILAR_MAX_DISTANCE = int(os.getenv('SIMILAR_MAX_DISTANCE', 8))
+similar_index = similarity.SimilarityIndex(max_distance=SIMILAR_MAX_DISTANCE)
+
+def save_image_from_url(url):
+    """Download and store the image at url; returns its storage key or None"""
+    try:
+        return fetch.download(url, lambda write: save_image(write, '.png'))
+    except Exception as e:
+        logger.error("Error downloading generated image: %s", e)
+        return None
+
+# Removes orphaned rows and files and enforces retention and the disk
+# quota, in small batches off the request path. It deletes whatever the
+# database doesn't refer to, so it only runs in a server, never on import
+# (see start_background_tasks).
+reconciler = reconcile.from_env(image_store)
+_background_started = False
+
+def save_image(write, suffix):
+    """image_store.save, marking the key used so the reconciler keeps it until a row refers to it"""
+    key = image_store.save(write, suffix)
+    reconciler.touch(key)
+    return key
+
+def start_background_tasks():
+    """Start the storage reconciler; called once by whichever server runs the app"""
+    global _background_started
+    if not _background_started:
+        _background_started = True
+        reconciler.start()
+
+def store_generation_data(original_key, generated_key, style, room_type, image_hash=None,
+                          prompt=None, custom_prompt=None):
+    """Store generation data in database.
+
+    image_hash is the perceptual hash of the original, recorded only for
+    generations the similarity index may hand out again. prompt is the
+    full prompt sent upstream and custom_prompt the user's part of it.
+    Returns the new row's id, or None if nothing was stored.
+    """
     # Verify both files exist before storing
-    original_exists = (STORAGE_DIR / Path(original_path).name).exists()
-    generated_exists = (STORAGE_DIR / Path(generated_path).name).exists()
+    original_exists = image_store.exists(original_key)
+    generated_exists = image_store.exists(generated_key)
     
     if not (original_exists and generated_exists):
-        print("Warning: Not storing generation data because files don't exist")
-        return False
+        logger.warning("Not storing generation data because files don't exist")
+        return None
         
-    conn = sqlite3.connect('images.db')
-    c = conn.cursor()
     try:
-        c.execute('''
-            INSERT INTO generated_images
-            (original_path, generated_path, style, room_type)
-            VALUES (?, ?, ?, ?)
-        ''', (original_path, generated_path, style, room_type))
-        conn.commit()
-        return True
+        with span('db_insert'):
+            row_id = db.execute('''
+                INSERT INTO generated_images
+                (original_path, generated_path, style, room_type, image_hash, prompt, custom_prompt)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                original_key, generated_key, style, room_type,
+                similarity.to_db(image_hash) if image_hash is not None else None,
+                prompt, custom_prompt or None
+            )).lastrowid
+        if image_hash is not None:
+            similar_index.add(row_id, image_hash, style, room_type)
+        return row_id
     except Exception as e:
-        print(f"Error storing generation data: {str(e)}")
-        return False
-    finally:
-        conn.close()
+        logger.error("Error storing generation data: %s", e)
+        return None
+
+def store_preview_data(original_key, generated_key, style, room_type, size, prompt, custom_prompt, mask_spec):
+    """Record a preview apart from the history; returns its id, or None if nothing was stored"""
+    if not (image_store.exists(original_key) and image_store.exists(generated_key)):
+        logger.warning("Not storing preview data because files don't exist")
+        return None
+    try:
+        with span('db_insert'):
+            return db.execute('''
+                INSERT INTO preview_images
+                (original_path, generated_path, style, room_type, size, prompt, custom_prompt, mask)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                original_key, generated_key, style, room_type, size, prompt, custom_prompt or None,
+                mask_spec if isinstance(mask_spec, str) else masks.geometry_json(mask_spec)
+            )).lastrowid
+    except Exception as e:
+        logger.error("Error storing preview data: %s", e)
+        return None
+
+def encode_cursor(timestamp, row_id):
+    """Opaque pagination cursor pointing just past (timestamp, id)"""
+    raw = json.dumps([timestamp, row_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    """Inverse of encode_cursor; raises ValueError on a malformed cursor"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(timestamp), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def parse_generations_query(args):
+    """Read limit, cursor and filters for a history page; raises ValueError"""
+    limit = min(max(int(args.get('limit', GENERATIONS_PAGE_SIZE)), 1), GENERATIONS_MAX_PAGE_SIZE)
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    room_type = args.get('room_type')
+    if room_type:
+        room_type = ROOM_TYPE_MAPPING.get(room_type.lower(), room_type)
+    return limit, after, args.get('style'), room_type
+
+def generation_payload(row):
+    """History entry for a (id, original, generated, style, room_type, timestamp) row"""
+    return {
+        'id': row[0],
+        'originalImage': get_absolute_url(storage.key_from_path(row[1])),
+        'generatedImage': get_absolute_url(storage.key_from_path(row[2])),
+        'style': row[3],
+        'roomType': row[4],
+        'timestamp': row[5]
+    }
+
+def list_generations(limit, after=None, style=None, room_type=None):
+    """One page of history, newest first; returns (generations, next cursor or None)"""
+    rows, next_cursor = history_page(
+        'generated_images', 'id, original_path, generated_path, style, room_type, timestamp',
+        limit, after, style, room_type
+    )
+    return [generation_payload(row) for row in rows], next_cursor
+
+def history_page(table, columns, limit, after=None, style=None, room_type=None):
+    """Rows of one page of a history table, newest first; returns (rows, next cursor or None).
+
+    columns must start with id and have the timestamp sixth, as in
+    generation_payload.
+    """
+    conditions = []
+    params = []
+    if style:
+        conditions.append('style = ?')
+        params.append(style)
+    if room_type:
+        conditions.append('room_type = ?')
+        params.append(room_type)
+    if after:
+        # Row-value comparison lets SQLite seek straight into the index
+        conditions.append('(timestamp, id) < (?, ?)')
+        params.extend(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    rows = db.query(f'''
+        SELECT {columns}
+        FROM {table}
+        {where}
+        ORDER BY timestamp DESC, id DESC
+        LIMIT ?
+    ''', params + [limit + 1])
+
+    next_cursor = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_cursor = encode_cursor(last[5], last[0])
+    return rows[:limit], next_cursor
 
 @app.route('/api/generations', methods=['GET'])
 def get_generations():
-    """Get all generated images history"""
+    """Get generated images history, newest first, one page at a time.
+
+    Query parameters: limit, cursor (from the X-Next-Cursor header of the
+    previous page), style and room_type. Only the database is read here;
+    missing files are cleaned up outside the request path.
+    """
     try:
-        # First, clean up invalid entries
-        validate_stored_images()
-        
-        conn = sqlite3.connect('images.db')
-        c = conn.cursor()
-        c.execute('''
-            SELECT id, original_path, generated_path, style, room_type, timestamp
-            FROM generated_images
-            ORDER BY timestamp DESC
-        ''')
-        rows = c.fetchall()
-        conn.close()
-
-        generations = []
-        for row in rows:
-            original_filename = Path(row[1]).name
-            generated_filename = Path(row[2]).name
-            
-            # Double check files exist before adding to response
-            if (STORAGE_DIR / original_filename).exists() and (STORAGE_DIR / generated_filename).exists():
-                generations.append({
-                    'id': row[0],
-                    'originalImage': get_absolute_url(original_filename),
-                    'generatedImage': get_absolute_url(generated_filename),
-                    'style': row[3],
-                    'roomType': row[4],
-                    'timestamp': row[5]
-                })
-        
-        return jsonify(generations)
+        try:
+            query = parse_generations_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        generations, next_cursor = list_generations(*query)
+        response = jsonify(generations)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
     except Exception as e:
-        print(f"Error fetching generations: {str(e)}")
+        logger.error("Error fetching generations: %s", e)
         return jsonify({'error': str(e)}), 500
 
-@app.route('/api/stored-image/<filename>')
+def search_generations(text, limit, after=None, style=None, room_type=None):
+    """One page of history matching text, with facet counts.
+
+    Returns (payload, next cursor or None). Without search text the page
+    is the plain history and the counts come from the aggregate tables.
+    """
+    expression = search.match_expression(text or '')
+    if expression is None:
+        generations, next_cursor = list_generations(limit, after, style, room_type)
+        counts = search.facet_counts()
+    else:
+        rows = search.search(expression, limit, after[1] if after else None, style, room_type)
+        generations = [
+            {**generation_payload(row), 'prompt': row[6], 'customPrompt': row[7]}
+            for row in rows[:limit]
+        ]
+        next_cursor = encode_cursor(rows[limit - 1][5], rows[limit - 1][0]) if len(rows) > limit else None
+        counts = search.facet_counts(expression)
+    total, facets = search.facets(counts, style, room_type)
+    return {'results': generations, 'total': total, 'facets': facets}, next_cursor
+
+def generation_stats(days):
+    """Totals by style and room type, and volume per day for the last days days"""
+    total, facets = search.facets(search.facet_counts())
+    return {'total': total, **facets, 'days': search.daily_volume(days)}
+
+@app.route('/api/generations/search', methods=['GET'])
+def search_generations_route():
+    """Search prompts in the history, newest first, with style and room type counts.
+
+    Query parameters: q, plus limit, cursor, style and room_type as for
+    /api/generations. Every word of q must appear in the prompt.
+    """
+    try:
+        try:
+            query = parse_generations_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        payload, next_cursor = search_generations(request.args.get('q', ''), *query)
+        response = jsonify(payload)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+    except Exception as e:
+        logger.error("Error searching generations: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/generations/stats', methods=['GET'])
+def get_generation_stats():
+    """Generation counts by style, room type and day (query parameter: days, default 30)"""
+    try:
+        try:
+            days = min(max(int(request.args.get('days', STATS_DAYS)), 1), STATS_MAX_DAYS)
+        except ValueError:
+            return jsonify({'error': 'days must be a number'}), 400
+        return jsonify(generation_stats(days))
+    except Exception as e:
+        logger.error("Error reading generation stats: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def parse_export_query(args):
+    """Selection and archive options for an export, as stream_archive keywords; raises ValueError"""
+    ids = None
+    if args.get('ids'):
+        try:
+            ids = [int(value) for value in args['ids'].split(',') if value.strip()]
+        except ValueError:
+            raise ValueError("ids must be comma-separated numbers")
+        if len(ids) > EXPORT_MAX_IDS:
+            raise ValueError(f"At most {EXPORT_MAX_IDS} ids can be exported at once")
+    include = args.get('include', ','.join(export.INCLUDE_FOLDERS))
+    include = tuple(value.strip() for value in include.split(',') if value.strip())
+    unknown = [value for value in include if value not in export.INCLUDE_FOLDERS]
+    if unknown or not include:
+        raise ValueError(f"include must be a list of {', '.join(export.INCLUDE_FOLDERS)}")
+    manifest = args.get('manifest', 'json').lower()
+    if manifest not in export.MANIFEST_FORMATS:
+        raise ValueError(f"manifest must be one of {', '.join(export.MANIFEST_FORMATS)}")
+    room_type = args.get('room_type')
+    if room_type:
+        room_type = ROOM_TYPE_MAPPING.get(room_type.lower(), room_type)
+    return {'ids': ids, 'text': args.get('q', ''), 'style': args.get('style'), 'room_type': room_type,
+            'include': include, 'manifest': manifest}
+
+def export_filename():
+    return f"designspace-export-{time.strftime('%Y%m%d-%H%M%S', time.gmtime())}.zip"
+
+@app.route('/api/generations/export', methods=['GET'])
+def export_generations():
+    """Stream a ZIP of originals, generations and a manifest of the history.
+
+    Query parameters: ids (comma-separated), q, style and room_type select
+    generations as for /api/generations/search, all of them by default;
+    include (originals,generated) picks the images; manifest is json or csv.
+    """
+    try:
+        selection = parse_export_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    response = Response(export.stream_archive(image_store, **selection), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{export_filename()}"'
+    response.headers['Cache-Control'] = 'no-store'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def list_previews(limit, after=None, style=None, room_type=None):
+    """One page of previews, newest first; returns (previews, next cursor or None)"""
+    rows, next_cursor = history_page(
+        'preview_images',
+        'id, original_path, generated_path, style, room_type, timestamp, size, custom_prompt, final_id',
+        limit, after, style, room_type
+    )
+    return [
+        {**generation_payload(row), 'size': row[6], 'customPrompt': row[7], 'finalId': row[8]}
+        for row in rows
+    ], next_cursor
+
+@app.route('/api/previews', methods=['GET'])
+def get_previews():
+    """Low-resolution previews, newest first, paged and filtered as /api/generations"""
+    try:
+        try:
+            query = parse_generations_query(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        previews, next_cursor = list_previews(*query)
+        response = jsonify(previews)
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+    except Exception as e:
+        logger.error("Error fetching previews: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def finalized_generation(preview_id):
+    """Payload of the full render already made from a preview, or None.
+
+    Raises LookupError when there is no such preview.
+    """
+    row = db.query_one('''
+        SELECT p.id, g.id, g.generated_path
+        FROM preview_images p
+        LEFT JOIN generated_images g ON g.id = p.final_id
+        WHERE p.id = ?
+    ''', (preview_id,))
+    if row is None:
+        raise LookupError("Preview not found")
+    if row[1] is None:
+        return None
+    url = get_absolute_url(storage.key_from_path(row[2]))
+    return {"id": row[1], "url": url, "storedImage": url, "previewId": preview_id, "timings": {}}
+
+def prepare_finalize(preview_id):
+    """Full-size prepared photo of a preview and its (style, room_type, custom_prompt).
+
+    Raises LookupError when the preview or its stored photo is gone.
+    """
+    row = db.query_one(
+        'SELECT original_path, style, room_type, custom_prompt, mask FROM preview_images WHERE id = ?',
+        (preview_id,)
+    )
+    if row is None:
+        raise LookupError("Preview not found")
+    original_key, style, room_type, custom_prompt, mask = row
+    try:
+        with image_store.open(original_key) as f:
+            image_data = f.read()
+    except FileNotFoundError:
+        raise LookupError("The preview's photo is no longer stored")
+    mask_spec = mask if mask in masks.STRATEGIES else masks.parse_geometry(mask)
+    prepared = prepare_generation(image_data, mask_spec, FULL_SIZE, original_key)
+    return prepared, (style, room_type, custom_prompt or '')
+
+def begin_finalize(preview_id):
+    """Start finalizing a preview: (payload of its full render, whether this call claimed it).
+
+    Only one call at a time holds the claim and renders; the others find
+    the render once it is recorded. Raises LookupError when there is no
+    such preview.
+    """
+    existing = finalized_generation(preview_id)
+    if existing is not None:
+        return existing, False
+    now = time.time()
+    # One statement, so two calls can't both see the preview unclaimed. A
+    # final render the reconciler has since deleted is rendered again.
+    cursor = db.execute('''
+        UPDATE preview_images SET finalizing_at = ?
+        WHERE id = ?
+          AND (final_id IS NULL OR NOT EXISTS (SELECT 1 FROM generated_images WHERE id = final_id))
+          AND (finalizing_at IS NULL OR finalizing_at < ?)
+    ''', (now, preview_id, now - FINALIZE_CLAIM_SECONDS))
+    return None, cursor.rowcount == 1
+
+def finalize_busy():
+    """Overloaded for a call that gave up waiting on another finalize"""
+    return Overloaded(FINALIZE_POLL_SECONDS * 10, "Preview is already being finalized")
+
+def release_finalize(preview_id):
+    """Give up a finalize claim after the render failed"""
+    db.execute('UPDATE preview_images SET finalizing_at = NULL WHERE id = ?', (preview_id,))
+
+def record_finalized(preview_id, payload):
+    """Link a preview to the history entry rendered from it, releasing the claim"""
+    if payload.get('id') is not None:
+        db.execute('UPDATE preview_images SET final_id = ?, finalizing_at = NULL WHERE id = ?',
+                   (payload['id'], preview_id))
+    else:
+        release_finalize(preview_id)
+    return {**payload, 'previewId': preview_id}
+
+def finalize_preview(preview_id):
+    """Render a preview at full size and return the response payload"""
+    deadline = time.monotonic() + FINALIZE_MAX_WAIT
+    while True:
+        existing, claimed = begin_finalize(preview_id)
+        if existing is not None:
+            return existing
+        if claimed:
+            break
+        if time.monotonic() >= deadline:
+            raise finalize_busy()
+        time.sleep(FINALIZE_POLL_SECONDS)
+    try:
+        prepared, (style, room_type, custom_prompt) = prepare_finalize(preview_id)
+        payload = generate_variant(prepared, style, room_type, custom_prompt)
+    except BaseException:
+        release_finalize(preview_id)
+        raise
+    return record_finalized(preview_id, payload)
+
+@app.route('/api/previews/<int:preview_id>/finalize', methods=['POST'])
+def finalize_preview_route(preview_id):
+    """Render a preview at full resolution from its stored photo, prompt and mask.
+
+    The result goes into the history like any generation, and the
+    preview's finalId points at it. Finalizing again returns that render;
+    a call made while another is rendering waits for it.
+    """
+    try:
+        logger.info("Finalizing preview %d", preview_id)
+        return jsonify(finalize_preview(preview_id))
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 404
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as api_error:
+        return jsonify({"error": describe_api_error(api_error)}), 500
+
+# Stored images are never rewritten, so browsers may cache them for a year
+IMAGE_MAX_AGE = 365 * 24 * 3600
+
+# Leading bytes of the image formats we may have stored
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF8', 'image/gif'),
+    (b'RIFF', 'image/webp'),
+)
+
+@lru_cache(maxsize=4096)
+def sniff_mimetype(path):
+    """Mimetype from the file's contents.
+
+    New files are stored under the suffix of their format, but files kept
+    from before content addressing include generated PNGs named .jpg.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(12)
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return mimetype
+    return 'image/jpeg'
+
+@app.route('/api/stored-image/<path:filename>')
 def get_stored_image(filename):
-    """Serve stored images"""
+    """Serve stored images, or a resized copy when ?w= is given.
+
+    Stored files never change once written, so responses can be cached
+    for good. ETag/If-None-Match and Range requests are handled by
+    send_file. Images kept in a bucket are served by redirecting there.
+    """
     try:
+        storage.validate_key(filename)
+        reconciler.touch(filename)
+        width = request.args.get('w', type=int)
+        if width:
+            fmt = 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'jpeg'
+            path = thumbnails.get_thumbnail(filename, width, fmt, lambda: image_store.open(filename))
+            mimetype = f'image/{fmt}'
+        else:
+            path = image_store.local_path(filename)
+            if path is None:
+                response = redirect(image_store.direct_url(filename))
+                # Signed URLs expire, so the redirect may only be cached for a while
+                response.headers['Cache-Control'] = f'public, max-age={storage.S3_URL_EXPIRY // 2}'
+                return response
+            mimetype = sniff_mimetype(path)
+
         response = send_file(
-            STORAGE_DIR / filename,
-            mimetype='image/jpeg'
+            path,
+            mimetype=mimetype,
+            conditional=True,
+            etag=True
         )
+        response.headers['Cache-Control'] = f'public, max-age={IMAGE_MAX_AGE}, immutable'
+        response.headers['Accept-Ranges'] = 'bytes'
+        if width:
+            response.headers['Vary'] = 'Accept'
         # Add CORS headers
         response.headers['Access-Control-Allow-Origin'] = '*'
         return response
-    except FileNotFoundError as e:
-        print(f"Image not found: {filename}")
-        print(f"Storage directory contents: {list(STORAGE_DIR.glob('*'))}")
+    except (FileNotFoundError, storage.InvalidKey):
+        logger.info("Image not found: %s", filename)
         return jsonify({'error': 'Image not found'}), 404
     except Exception as e:
-        print(f"Error serving image: {str(e)}")
+        logger.error("Error serving image: %s", e)
         return jsonify({'error': str(e)}), 500
 
-def debug_image(stage, image):
-    """Debug helper to print image information"""
-    print(f"\n=== {stage} ===")
-    print(f"Image mode: {image.mode}")
-    print(f"Image size: {image.size}")
-    print(f"Image format: {getattr(image, 'format', 'N/A')}")
-
 def prepare_image_for_api(image_data, size=(1024, 1024)):
     """Prepare image for OpenAI API - must be square PNG."""
-    try:
-        # Open the image using PIL
-        image = Image.open(io.BytesIO(image_data))
-        debug_image("Original image", image)
-        
-        # Convert to RGBA
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
-            debug_image("After RGBA conversion", image)
-        
-        # Calculate the target size while maintaining aspect ratio
-        # We'll use the larger dimension to fill the square
-        aspect = image.width / image.height
-        if aspect > 1:
-            # Wider than tall
-            new_width = size[0]
-            new_height = int(size[0] / aspect)
-        else:
-            # Taller than wide
-            new_height = size[1]
-            new_width = int(size[1] * aspect)
-            
-        # Resize the image
-        image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        debug_image("After resize", image)
-        
-        # Create a square transparent background
-        square = Image.new('RGBA', size, (0, 0, 0, 0))
-        
-        # Paste the resized image in the center
-        paste_x = (size[0] - new_width) // 2
-        paste_y = (size[1] - new_height) // 2
-        square.paste(image, (paste_x, paste_y))
-        debug_image("Final square image", square)
-        
-        # Save as PNG to bytes
-        output = io.BytesIO()
-        square.save(output, format='PNG')
-        output.seek(0)
-        
-        # Print the first few bytes to verify PNG header
-        print("First few bytes of PNG:", output.getvalue()[:8].hex())
-        print(f"Total bytes in PNG: {len(output.getvalue())}")
-        
-        return output.getvalue()
+    return prepare_image(image_data, size)[0]
 
-    except Exception as e:
-        print(f"Error processing image: {str(e)}")
-        raise
+def prepare_image(image_data, size=(1024, 1024), timings=None):
+    """Square PNG for the API and the perceptual hash of the photo, made in the preprocessing pool"""
+    return preprocessor.prepare(image_data, size, timings)
 
-def create_mask(size=(1024, 1024)):
-    """Create a mask for the interior - must match image dimensions exactly."""
-    try:
-        # Create new image with transparent interior (area to edit)
-        mask = Image.new('RGBA', size, (0, 0, 0, 0))
-        
-        # Calculate border width - about 5% of the image width
-        border_width = size[0] // 20
-        
-        # Draw white borders (areas to preserve)
-        draw = ImageDraw.Draw(mask)
-        
-        # Draw white frame
-        draw.rectangle([0, 0, size[0], border_width], fill=(255, 255, 255, 255))  # Top
-        draw.rectangle([0, size[1]-border_width, size[0], size[1]], fill=(255, 255, 255, 255))  # Bottom
-        draw.rectangle([0, 0, border_width, size[1]], fill=(255, 255, 255, 255))  # Left
-        draw.rectangle([size[0]-border_width, 0, size[0], size[1]], fill=(255, 255, 255, 255))  # Right
-        
-        # Save as PNG to bytes
-        output = io.BytesIO()
-        mask.save(output, format='PNG')
-        output.seek(0)
-        return output.getvalue()
+def create_mask(size=(1024, 1024), strategy='border'):
+    """Get the mask for the interior - must match image dimensions exactly."""
+    # Built once per size and strategy, then served from the registry
+    return masks.get_mask(size, strategy)
 
-    except Exception as e:
-        print(f"Error creating mask: {str(e)}")
-        raise
+def build_mask(image_data, mask_spec, size=(1024, 1024)):
+    """Return the mask PNG for a strategy name or client geometry"""
+    if isinstance(mask_spec, str):
+        return create_mask(size, mask_spec)
+
+    # Client geometry is relative to the upright photo, which sits
+    # letterboxed in the square; only the header is read to get its size
+    width, height = upright_size(open_upload(image_data))
+    return masks.rasterize(tuple(size), fit_to_square(width, height, size), mask_spec)
 
 def get_style_prompt(style, room_type):
     """Generate a style-specific prompt for DALL-E."""
@@ -298,151 +723,558 @@ def get_style_prompt(style, room_type):
 
     return full_prompt
 
+# Map the room types the frontend may send onto the prompt keys
+ROOM_TYPE_MAPPING = {
+    'living': 'living room',
+    'living room': 'living room',
+    'bedroom': 'bedroom',
+    'kitchen': 'kitchen'
+}
+
+def parse_generation_form(form):
+    """Read style, room type and custom prompt from the request form"""
+    style = form.get('style', 'modern minimalist')
+    room_type = form.get('roomType', 'living room')
+    custom_prompt = form.get('customPrompt', '').strip()
+
+    # Validate and normalize room type
+    room_type = ROOM_TYPE_MAPPING.get(room_type.lower(), 'living room')
+    return style, room_type, custom_prompt
+
+def parse_reuse_form(form):
+    """Whether the client opted in to reusing a generation of a similar photo"""
+    return form.get('reuseSimilar', '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+def parse_mask_form(form):
+    """Read the optional client mask from the request form.
+
+    Returns either a fixed strategy name (maskStrategy, default 'border')
+    or canonical geometry parsed from the JSON 'mask' field. Raises
+    ValueError for anything malformed.
+    """
+    geometry = form.get('mask', '').strip()
+    if geometry:
+        return masks.parse_geometry(geometry)
+
+    strategy = form.get('maskStrategy', 'border')
+    if strategy not in masks.STRATEGIES:
+        raise ValueError(f"Unknown mask strategy: {strategy}")
+    return strategy
+
+def parse_preview_form(form):
+    """Square size to render at: a PREVIEW_SIZES entry for 'preview', else FULL_SIZE; raises ValueError"""
+    preview = form.get('preview', '').strip().lower()
+    if preview in ('', '0', 'false', 'no', 'off'):
+        return FULL_SIZE
+    if preview in ('1', 'true', 'yes', 'on'):
+        return PREVIEW_SIZES[0]
+    if not preview.isdigit() or int(preview) not in PREVIEW_SIZES:
+        raise ValueError(f"preview must be one of {', '.join(map(str, PREVIEW_SIZES))}")
+    return int(preview)
+
+def build_prompt(style, room_type, custom_prompt):
+    """Combine the style prompt with the user's custom prompt"""
+    # Get detailed prompt for the style and room type
+    base_prompt = get_style_prompt(style, room_type)
+
+    # If custom prompt is provided, append it to the base prompt
+    if custom_prompt:
+        prompt = base_prompt + " " + custom_prompt
+        # Ensure prompt doesn't exceed 999 characters
+        if len(prompt) > 999:
+            prompt = prompt[:996] + "..."
+    else:
+        prompt = base_prompt
+    return prompt
+
+def describe_api_error(api_error):
+    """Turn an upstream error into a message suitable for the client"""
+    error_message = str(api_error)
+    logger.error("Full API error: %s", error_message)
+
+    if "rate_limit" in error_message.lower():
+        error_message = (
+            "Rate limit exceeded or insufficient credits. "
+            "Please check your OpenAI account billing status and try again later."
+        )
+    elif "invalid_api_key" in error_message.lower():
+        error_message = "Invalid API key. Please check your OpenAI API key configuration."
+    elif "invalid_request_error" in error_message.lower():
+        error_message = "Invalid request. Please try again with different parameters."
+
+    return f"API Error: {error_message}"
+
+def edit_size(size):
+    """images.edit size argument for a square side in pixels"""
+    return f"{size}x{size}"
+
+def edit_params(processed_image, mask_data, prompt, size=EDIT_SIZE):
+    """Arguments for images.edit, shared by the sync and async clients"""
+    return {
+        'image': ("image.png", processed_image, "image/png"),
+        'mask': ("mask.png", mask_data, "image/png"),
+        'prompt': prompt,
+        'n': 1,
+        'size': size,
+        'model': EDIT_MODEL,
+        'response_format': RESPONSE_FORMAT
+    }
+
+def save_generated_base64(data):
+    """Decode a b64_json result into storage and return its key"""
+    return fetch.write_base64(data, lambda write: save_image(write, '.png'))
+
+def request_edit(processed_image, mask_data, prompt, timings, size=EDIT_SIZE):
+    """Call the OpenAI edit endpoint and store the result.
+
+    The PNG bytes are handed to the client as named in-memory files, so
+    nothing is written to disk on the way out. With OPENAI_RESPONSE_FORMAT
+    set to b64_json the image comes back inline and is decoded straight
+    into storage, skipping the second HTTP round trip. Stage durations in
+    seconds are added to timings. size must match the prepared image.
+
+    Returns (storage key or None, upstream URL of the result).
+    """
+    # Admission control paces the calls and retries 429s
+    with span('upstream_edit', timings):
+        response = upstream.call(lambda: client.images.edit(**edit_params(processed_image, mask_data, prompt, size)))
+    # Only successful calls are billed; 429s and errors raise above
+    upstream_cost_dollars.inc(IMAGE_PRICES[(EDIT_MODEL, size)])
+    logger.debug("Received response from OpenAI")
+
+    # Save generated image
+    result = response.data[0]
+    if RESPONSE_FORMAT == 'b64_json':
+        with span('b64_decode', timings):
+            generated_key = save_generated_base64(result.b64_json)
+        return generated_key, None
+
+    with span('download', timings):
+        generated_key = save_image_from_url(result.url)
+    return generated_key, result.url
+
+def prepare_generation(image_data, mask_spec='border', size=FULL_SIZE, original_key=None):
+    """Preprocess an upload once so any number of styles can be generated from it.
+
+    The image and mask are size pixels square; anything under FULL_SIZE
+    makes previews. original_key is given when the photo is already stored.
+    """
+    # Process image and create mask
+    processed_image, image_hash = prepare_image(image_data, (size, size))
+    with span('mask'):
+        mask_data = build_mask(image_data, mask_spec, (size, size))
+
+    # Save the original image; a repeat upload of the same photo is stored once.
+    # The suffix follows the real format: S3 serves the object's content type.
+    if original_key is None:
+        with span('store_original'):
+            original_key = save_image(lambda f: f.write(image_data), upload_suffix(open_upload(image_data)))
+
+    return {
+        'processed_image': processed_image,
+        'mask_data': mask_data,
+        'mask_spec': mask_spec,
+        'size': size,
+        'original_key': original_key,
+        'image_hash': image_hash
+    }
+
+def run_generation(image_data, style, room_type, custom_prompt, mask_spec='border', reuse_similar=False,
+                   size=FULL_SIZE):
+    """Run the full generation pipeline and return the response payload"""
+    prepared = prepare_generation(image_data, mask_spec, size)
+    return generate_variant(prepared, style, room_type, custom_prompt, reuse_similar)
+
+def is_plain_generation(prepared, custom_prompt):
+    """Whether a generation depends only on the photo, style and room type"""
+    return not custom_prompt and prepared['mask_spec'] == 'border' and prepared['size'] == FULL_SIZE
+
+def find_similar(prepared, style, room_type, custom_prompt):
+    """Earlier generation of a near-identical photo as (row id, key, distance), or None"""
+    if not is_plain_generation(prepared, custom_prompt):
+        return None
+    with span('similar_lookup'):
+        match = similar_index.find(prepared['image_hash'], style, room_type)
+    if match is None or not image_store.exists(match[1]):
+        return None
+    return match
+
+def generation_cache_key(prepared, style, room_type, custom_prompt):
+    """Cache key for one style/room combination of a prepared upload"""
+    mask_spec = prepared['mask_spec']
+    return GenerationCache.make_key(
+        prepared['processed_image'], get_style_prompt(style, room_type), custom_prompt, edit_size(prepared['size']),
+        mask_spec if isinstance(mask_spec, str) else json.dumps(mask_spec)
+    )
+
+def generate_variant(prepared, style, room_type, custom_prompt, reuse_similar=False):
+    """Generate one style/room combination from a prepared upload.
+
+    With reuse_similar, an earlier generation of a near-identical photo
+    is returned instead of calling OpenAI, if there is one.
+    """
+    if reuse_similar:
+        match = find_similar(prepared, style, room_type, custom_prompt)
+        if match is not None:
+            return finish_variant(prepared, style, room_type, custom_prompt, match[1], None, {}, reused=match)
+
+    processed_image = prepared['processed_image']
+    mask_data = prepared['mask_data']
+    size = edit_size(prepared['size'])
+
+    prompt = build_prompt(style, room_type, custom_prompt)
+    logger.debug("Using prompt: %s", prompt)
+
+    timings = {}
+    if CACHE_ENABLED:
+        cache_key = generation_cache_key(prepared, style, room_type, custom_prompt)
+        (generated_key, upstream_url), cached = generation_cache.get_or_create(
+            cache_key,
+            lambda: request_edit(processed_image, mask_data, prompt, timings, size)
+        )
+        if cached:
+            logger.info("Cache hit for %s, reusing %s", cache_key[:12], generated_key)
+    else:
+        generated_key, upstream_url = request_edit(processed_image, mask_data, prompt, timings, size)
+
+    return finish_variant(prepared, style, room_type, custom_prompt, generated_key, upstream_url, timings)
+
+def finish_variant(prepared, style, room_type, custom_prompt, generated_key, upstream_url, timings, reused=None):
+    """Record a finished generation and build the response payload.
+
+    reused is the find_similar() match the result was taken from, if any.
+    """
+    if reused is not None:
+        source = 'similar'
+        logger.info("Reusing generation %d for a photo %d bits away", reused[0], reused[2])
+    else:
+        source = 'upstream' if timings else 'cache'
+    generations_total.inc(source=source)
+    if timings:
+        logger.info("Stage timings: %s", ", ".join(f"{stage}={seconds * 1000:.0f}ms" for stage, seconds in timings.items()))
+
+    if generated_key:
+        prompt = build_prompt(style, room_type, custom_prompt)
+        if prepared['size'] != FULL_SIZE:
+            # Previews are kept out of the history until they are finalized
+            preview_id = store_preview_data(prepared['original_key'], generated_key, style, room_type,
+                                            prepared['size'], prompt, custom_prompt, prepared['mask_spec'])
+            if preview_id is not None:
+                return {
+                    "url": get_absolute_url(generated_key),
+                    "storedImage": get_absolute_url(generated_key),
+                    "previewId": preview_id,
+                    "previewSize": prepared['size'],
+                    "timings": timings
+                }
+            return {"url": upstream_url}
+
+        # Store generation data in database
+        image_hash = prepared['image_hash'] if is_plain_generation(prepared, custom_prompt) else None
+        row_id = store_generation_data(prepared['original_key'], generated_key, style, room_type, image_hash,
+                                       prompt, custom_prompt)
+        if row_id is not None:
+            payload = {
+                "id": row_id,
+                "url": get_absolute_url(generated_key),
+                "storedImage": get_absolute_url(generated_key),
+                "timings": timings
+            }
+            if reused is not None:
+                payload["reusedFrom"] = {"id": reused[0], "distance": reused[2]}
+            return payload
+
+    return {"url": upstream_url}
+
+job_queue = JobQueue(
+    workers=JOB_WORKERS,
+    max_pending=JOB_MAX_PENDING,
+    describe_error=describe_api_error,
+    heartbeat=JOB_HEARTBEAT_SECONDS,
+    stale_after=JOB_STALE_SECONDS
+)
+# Jobs left queued or running by a stopped worker can't be resumed
+job_queue.start()
+
 @app.route('/api/generate-designs', methods=['POST'])
 def generate_designs():
-    temp_files = []  # Keep track of temporary files to clean up
     try:
         # Get style and image from request
-        style = request.form.get('style', 'modern minimalist')
-        room_type = request.form.get('roomType', 'living room')
-        custom_prompt = request.form.get('customPrompt', '').strip()
-        
-        # Validate and normalize room type
-        room_type_mapping = {
-            'living': 'living room',
-            'living room': 'living room',
-            'bedroom': 'bedroom',
-            'kitchen': 'kitchen'
-        }
-        room_type = room_type_mapping.get(room_type.lower(), 'living room')
-        
+        style, room_type, custom_prompt = parse_generation_form(request.form)
+        reuse_similar = parse_reuse_form(request.form)
+        try:
+            mask_spec = parse_mask_form(request.form)
+            size = parse_preview_form(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
         if 'image' not in request.files:
             return jsonify({"error": "No image provided"}), 400
             
         image_file = request.files['image']
         image_data = image_file.read()
         
-        print("\n=== Starting design generation ===")
-        print(f"Received style request: {style}")
-        print(f"Received room type: {room_type}")
-        print(f"Received image size: {len(image_data)} bytes")
-        print(f"Original file content type: {image_file.content_type}")
+        logger.info(
+            "Starting design generation: style=%s room_type=%s size=%d bytes=%d content_type=%s",
+            style, room_type, size, len(image_data), image_file.content_type
+        )
         
         try:
-            # Process image and create mask
-            processed_image = prepare_image_for_api(image_data)
-            mask_data = create_mask()
-            
-            # Save original image
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            original_filename = f"original_{timestamp}.jpg"
-            original_path = STORAGE_DIR / original_filename
-            
-            # Save the original image
-            with open(original_path, 'wb') as f:
-                f.write(image_data)
-            
-            # Get detailed prompt for the style and room type
-            base_prompt = get_style_prompt(style, room_type)
-            
-            # If custom prompt is provided, append it to the base prompt
-            if custom_prompt:
-                prompt = base_prompt + " " + custom_prompt
-                # Ensure prompt doesn't exceed 999 characters
-                if len(prompt) > 999:
-                    prompt = prompt[:996] + "..."
-            else:
-                prompt = base_prompt
-            
-            print(f"\nUsing prompt: {prompt}")
-            
-            # Create temporary files for API request
-            with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as image_temp, \
-                 tempfile.NamedTemporaryFile(suffix='.png', delete=False) as mask_temp:
-                
-                # Write the processed images to temporary files
-                image_temp.write(processed_image)
-                mask_temp.write(mask_data)
-                image_temp.flush()
-                mask_temp.flush()
-                
-                # Store the file paths for cleanup
-                temp_files.extend([image_temp.name, mask_temp.name])
-            
-            # Open files in a new context for the API request
-            with open(temp_files[0], 'rb') as image_file, \
-                 open(temp_files[1], 'rb') as mask_file:
-                
-                print("\n=== Making API Request ===")
-                response = client.images.edit(
-                    image=image_file,
-                    mask=mask_file,
-                    prompt=prompt,
-                    n=1,
-                    size="1024x1024",
-                    model="dall-e-2"
-                )
-            
-            print("\nSuccessfully received response from OpenAI")
-            
-            # Save generated image
-            generated_filename = f"generated_{timestamp}.jpg"
-            generated_path = save_image_from_url(response.data[0].url, generated_filename)
-            
-            if generated_path:
-                # Store generation data in database
-                if store_generation_data(
-                    str(original_path),
-                    generated_path,
-                    style,
-                    room_type
-                ):
-                    return jsonify({
-                        "url": get_absolute_url(generated_filename),
-                        "storedImage": get_absolute_url(generated_filename)
-                    })
-            
-            return jsonify({"url": response.data[0].url})
-            
+            return jsonify(run_generation(image_data, style, room_type, custom_prompt, mask_spec, reuse_similar, size))
+        except UploadTooLarge as e:
+            return jsonify({"error": str(e)}), 413
+        except Overloaded as e:
+            return overloaded_response(e)
         except Exception as api_error:
-            error_message = str(api_error)
-            print(f"\nFull API error: {error_message}")
-            
-            if "rate_limit" in error_message.lower():
-                error_message = (
-                    "Rate limit exceeded or insufficient credits. "
-                    "Please check your OpenAI account billing status and try again later."
-                )
-            elif "invalid_api_key" in error_message.lower():
-                error_message = "Invalid API key. Please check your OpenAI API key configuration."
-            elif "invalid_request_error" in error_message.lower():
-                error_message = "Invalid request. Please try again with different parameters."
-            
-            print(f"API Error: {error_message}")
-            return jsonify({"error": f"API Error: {error_message}"}), 500
+            return jsonify({"error": describe_api_error(api_error)}), 500
         
     except Exception as e:
-        print(f"\n!!! Error occurred: {str(e)}")
-        print(f"Error type: {type(e)}")
+        logger.exception("Error generating design")
         return jsonify({"error": str(e)}), 500
-        
-    finally:
-        # Clean up temporary files
-        for temp_file in temp_files:
-            try:
-                if os.path.exists(temp_file):
-                    os.unlink(temp_file)
-            except Exception as e:
-                print(f"Error cleaning up temporary file {temp_file}: {str(e)}")
 
+def overloaded_response(error):
+    """503 telling the client when to try again"""
+    retry_after = max(1, int(round(error.retry_after)))
+    response = jsonify({"error": str(error), "retryAfter": retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def parse_variants_form(form):
+    """Read the list of style/room type pairs for a batch; raises ValueError"""
+    try:
+        variants = json.loads(form.get('variants', ''))
+    except ValueError:
+        raise ValueError("variants must be a JSON list of {style, roomType} objects")
+    if not isinstance(variants, list) or not variants:
+        raise ValueError("variants must be a non-empty JSON list")
+    if len(variants) > BATCH_MAX_VARIANTS:
+        raise ValueError(f"At most {BATCH_MAX_VARIANTS} variants per batch")
+
+    parsed = []
+    for variant in variants:
+        if not isinstance(variant, dict):
+            raise ValueError("Each variant must be an object with style and roomType")
+        style = str(variant.get('style', 'modern minimalist'))
+        room_type = str(variant.get('roomType', 'living room'))
+        parsed.append((style, ROOM_TYPE_MAPPING.get(room_type.lower(), 'living room')))
+    return parsed
+
+def sse_event(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/generate-designs/batch', methods=['POST'])
+def generate_designs_batch():
+    """Render one photo in several styles, streaming each result as it finishes.
+
+    The upload is decoded, resized and masked once; the upstream edits
+    then run concurrently, at most BATCH_CONCURRENCY at a time.
+    """
+    try:
+        _, _, custom_prompt = parse_generation_form(request.form)
+        reuse_similar = parse_reuse_form(request.form)
+        try:
+            mask_spec = parse_mask_form(request.form)
+            variants = parse_variants_form(request.form)
+            size = parse_preview_form(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if 'image' not in request.files:
+            return jsonify({"error": "No image provided"}), 400
+
+        image_data = request.files['image'].read()
+        logger.info("Starting batch of %d designs at %dpx", len(variants), size)
+
+        try:
+            prepared = prepare_generation(image_data, mask_spec, size)
+        except UploadTooLarge as e:
+            return jsonify({"error": str(e)}), 413
+        except Overloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return jsonify({"error": describe_api_error(e)}), 500
+    except Exception as e:
+        logger.exception("Error starting batch generation")
+        return jsonify({"error": str(e)}), 500
+
+    def results():
+        executor = ThreadPoolExecutor(
+            max_workers=min(BATCH_CONCURRENCY, len(variants)),
+            thread_name_prefix='batch-generation'
+        )
+        try:
+            futures = {
+                executor.submit(generate_variant, prepared, style, room_type, custom_prompt, reuse_similar): (index, style, room_type)
+                for index, (style, room_type) in enumerate(variants)
+            }
+            for future in as_completed(futures):
+                index, style, room_type = futures[future]
+                variant = {"index": index, "style": style, "roomType": room_type}
+                try:
+                    yield sse_event('result', {**variant, **future.result()})
+                except Overloaded as e:
+                    yield sse_event('error', {**variant, "error": str(e), "retryAfter": round(e.retry_after)})
+                except Exception as e:
+                    yield sse_event('error', {**variant, "error": describe_api_error(e)})
+            yield sse_event('done', {"count": len(variants)})
+        finally:
+            # A client that disconnects early doesn't cancel started edits
+            executor.shutdown(wait=False)
+
+    response = Response(results(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/upstream/stats', methods=['GET'])
+def get_upstream_stats():
+    """Current concurrency limit and admission counters for OpenAI calls"""
+    return jsonify(upstream.stats())
+
+@app.route('/api/storage/reconcile', methods=['GET'])
+def get_reconcile_report():
+    """What the last storage reconciliation pass found and removed"""
+    if reconciler.last_report is None:
+        return jsonify({"error": "No reconciliation pass has finished yet"}), 404
+    return jsonify(reconciler.last_report)
+
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Hit/miss counters and current size of the generation cache and similarity index"""
+    try:
+        return jsonify({**generation_cache.stats(), 'similar': similar_index.stats()})
+    except Exception as e:
+        logger.error("Error reading cache stats: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_generation_job():
+    """Queue a design generation and return its job id right away"""
+    try:
+        style, room_type, custom_prompt = parse_generation_form(request.form)
+        reuse_similar = parse_reuse_form(request.form)
+        try:
+            mask_spec = parse_mask_form(request.form)
+            size = parse_preview_form(request.form)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+
+        if 'image' not in request.files:
+            return jsonify({"error": "No image provided"}), 400
+
+        image_data = request.files['image'].read()
+        # Refuse an oversized photo now rather than fail the job later
+        try:
+            open_upload(image_data)
+        except UploadTooLarge as e:
+            return jsonify({"error": str(e)}), 413
+
+        try:
+            job_id = job_queue.submit(
+                run_generation, image_data, style, room_type, custom_prompt, mask_spec, reuse_similar, size,
+                style=style, room_type=room_type
+            )
+        except QueueFull:
+            return jsonify({"error": "Too many pending generations. Please try again shortly."}), 503
+
+        logger.info("Queued generation job %s (%s, %s)", job_id, style, room_type)
+        return jsonify({
+            "jobId": job_id,
+            "status": "queued",
+            "statusUrl": f"/api/jobs/{job_id}",
+            "eventsUrl": f"/api/jobs/{job_id}/events"
+        }), 202
+    except Exception as e:
+        logger.exception("Error queueing generation job")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_generation_job(job_id):
+    """Poll the status and result of a generation job"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_generation_job(job_id):
+    """Stream job status changes as server-sent events"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def events(job):
+        last_status = None
+        while True:
+            if job['status'] != last_status:
+                last_status = job['status']
+                yield sse_event(last_status, job)
+            else:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            if last_status in FINISHED_STATUSES:
+                return
+            job = job_queue.wait(job_id, last_status, timeout=SSE_KEEPALIVE_SECONDS)
+
+    response = Response(events(job), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Counters and latency histograms in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@metrics.gauge_callback
+def sample_gauges():
+    """Point-in-time values read when /metrics is scraped"""
+    upstream_stats = upstream.stats()
+    preprocess_stats = preprocessor.stats()
+    generations = generations_total.total()
+    spend = upstream_cost_dollars.total()
+    return [
+        ('designspace_upstream_concurrency_limit', 'Current adaptive limit on in-flight OpenAI calls', upstream_stats['limit']),
+        ('designspace_upstream_in_flight', 'OpenAI calls in flight', upstream_stats['inFlight']),
+        ('designspace_upstream_waiting', 'Requests waiting for upstream admission', upstream_stats['waiting']),
+        ('designspace_preprocess_in_flight', 'Uploads being preprocessed or queued for a worker', preprocess_stats['inFlight']),
+        ('designspace_preprocess_waiting', 'Uploads waiting for a preprocessing slot', preprocess_stats['waiting']),
+        ('designspace_cost_per_generation_dollars', 'Average upstream spend per generated design, cache hits included',
+         spend / generations if generations else 0),
+    ]
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.before_request
+def reject_large_uploads():
+    # Answer from the Content-Length header before any of the body is read
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_BYTES:
+        return jsonify({"error": f"Upload is larger than {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"}), 413
+
+@app.after_request
+def record_request_metrics(response):
+    # The route pattern, not the path, so stored image names don't each get a series
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    http_requests_total.inc(endpoint=endpoint, status=response.status_code)
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        http_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+    return response
 
 @app.after_request
 def add_cors_headers(response):
     response.headers["Access-Control-Allow-Origin"] = "*"
     response.headers["Access-Control-Allow-Headers"] = "Content-Type"
     response.headers["Access-Control-Allow-Methods"] = "GET,POST,OPTIONS"
+    response.headers["Access-Control-Expose-Headers"] = "X-Next-Cursor"
     return response
 
 if __name__ == '__main__':
+    start_background_tasks()
     port = int(os.environ.get("PORT", 5000))
     app.run(debug=True, host='0.0.0.0', port=port) 
\ No newline at end of file
@@ -0,0 +1,644 @@
+"""ASGI entry point serving the same API as app.py without a thread per request.
+
+Upstream edits go through AsyncOpenAI and downloads through an async
+HTTP client, so a generation waiting on OpenAI holds a coroutine rather
+than an OS thread. PIL work, storage writes and SQLite calls run in an
+executor to keep the event loop free. Everything else (configuration,
+storage, the cache, admission control, the job queue, metrics) is shared
+with the Flask app, which this module imports:
+
+    cd backend/app && uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+bench/parity.py runs the same requests against both servers and
+compares the responses.
+"""
+import asyncio
+import functools
+import logging
+import os
+import queue
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import httpx
+from openai import AsyncOpenAI
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import app as flask_app
+import export
+import fetch
+import metrics
+import storage
+import thumbnails
+from jobs import FINISHED_STATUSES, QueueFull
+from app import UploadTooLarge
+from limiter import Overloaded
+from metrics import span
+
+logger = logging.getLogger('asgi')
+
+# Threads for PIL, disk and database work; PIL releases the GIL while it works
+BLOCKING_WORKERS = int(os.getenv('ASGI_BLOCKING_WORKERS', min(32, (os.cpu_count() or 1) * 4)))
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix='asgi-blocking')
+
+# How often an events stream checks its job for a new status
+JOB_POLL_SECONDS = 0.5
+# Downloaded chunks that may wait for the storage write before reading pauses
+DOWNLOAD_BUFFER_CHUNKS = 8
+
+aclient = AsyncOpenAI(api_key=flask_app.api_key, max_retries=0)
+http_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(fetch.READ_TIMEOUT, connect=fetch.CONNECT_TIMEOUT),
+    limits=httpx.Limits(max_connections=fetch.POOL_SIZE * 4, max_keepalive_connections=fetch.POOL_SIZE)
+)
+
+
+async def run_blocking(fn, *args):
+    """Run fn(*args) on the blocking executor and await the result"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(fn, *args))
+
+
+def error(message, status_code):
+    return JSONResponse({'error': message}, status_code=status_code)
+
+
+def overloaded_response(e):
+    """503 telling the client when to try again"""
+    retry_after = max(1, int(round(e.retry_after)))
+    return JSONResponse(
+        {'error': str(e), 'retryAfter': retry_after},
+        status_code=503,
+        headers={'Retry-After': str(retry_after)}
+    )
+
+
+async def save_stream(response):
+    """Stream a response body into storage and return its key.
+
+    app.save_image runs on the blocking executor and takes chunks from a
+    queue as they arrive, so only DOWNLOAD_BUFFER_CHUNKS chunks are held
+    in memory. If reading fails, the write is aborted and storage drops
+    the partial file.
+    """
+    loop = asyncio.get_running_loop()
+    chunks = queue.Queue()
+    space = asyncio.Semaphore(DOWNLOAD_BUFFER_CHUNKS)
+    aborted = object()
+
+    def write(f):
+        while True:
+            chunk = chunks.get()
+            loop.call_soon_threadsafe(space.release)
+            if chunk is None:
+                return
+            if chunk is aborted:
+                raise fetch.FetchError("Download interrupted")
+            f.write(chunk)
+
+    def finished(future):
+        # Mark a failure as retrieved, so one nobody awaits after an abort isn't logged
+        if not future.cancelled():
+            future.exception()
+        # Wake the reader if the write stopped early
+        space.release()
+
+    saving = loop.run_in_executor(blocking_executor, flask_app.save_image, write, '.png')
+    saving.add_done_callback(finished)
+    try:
+        async for chunk in response.aiter_bytes(fetch.CHUNK_SIZE):
+            await space.acquire()
+            if saving.done():
+                break
+            chunks.put(chunk)
+        chunks.put(None)
+    except BaseException:
+        chunks.put(aborted)
+        raise
+    return await saving
+
+
+async def download(url):
+    """Fetch a generated image into storage; same retry policy as fetch.download"""
+    for attempt in range(fetch.MAX_RETRIES + 1):
+        retry_after = None
+        try:
+            async with http_client.stream('GET', url) as response:
+                if response.status_code == 200:
+                    return await save_stream(response)
+                error_ = fetch.FetchError(f"Download failed with HTTP {response.status_code}")
+                if response.status_code not in fetch.RETRY_STATUSES:
+                    raise error_
+                retry_after = response.headers.get('Retry-After')
+        except httpx.TransportError as e:
+            error_ = e
+
+        if attempt == fetch.MAX_RETRIES:
+            break
+        delay = fetch.BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        logger.warning("Download attempt %d failed (%s), retrying in %.1fs", attempt + 1, error_, delay)
+        await asyncio.sleep(delay)
+
+    raise fetch.FetchError(f"Download failed after {fetch.MAX_RETRIES + 1} attempts: {error_}")
+
+
+async def request_edit(processed_image, mask_data, prompt, timings, size=flask_app.EDIT_SIZE):
+    """Async counterpart of app.request_edit"""
+    with span('upstream_edit', timings):
+        response = await flask_app.upstream.call_async(
+            lambda: aclient.images.edit(**flask_app.edit_params(processed_image, mask_data, prompt, size))
+        )
+    flask_app.upstream_cost_dollars.inc(flask_app.IMAGE_PRICES[(flask_app.EDIT_MODEL, size)])
+
+    result = response.data[0]
+    if flask_app.RESPONSE_FORMAT == 'b64_json':
+        with span('b64_decode', timings):
+            generated_key = await run_blocking(flask_app.save_generated_base64, result.b64_json)
+        return generated_key, None
+
+    with span('download', timings):
+        try:
+            generated_key = await download(result.url)
+        except Exception as e:
+            logger.error("Error downloading generated image: %s", e)
+            generated_key = None
+    return generated_key, result.url
+
+
+async def generate_variant(prepared, style, room_type, custom_prompt, reuse_similar=False):
+    """Async counterpart of app.generate_variant"""
+    if reuse_similar:
+        match = await run_blocking(flask_app.find_similar, prepared, style, room_type, custom_prompt)
+        if match is not None:
+            return await run_blocking(functools.partial(
+                flask_app.finish_variant, prepared, style, room_type, custom_prompt, match[1], None, {}, reused=match
+            ))
+
+    prompt = flask_app.build_prompt(style, room_type, custom_prompt)
+    logger.debug("Using prompt: %s", prompt)
+
+    timings = {}
+
+    def create():
+        return request_edit(prepared['processed_image'], prepared['mask_data'], prompt, timings,
+                            flask_app.edit_size(prepared['size']))
+
+    if flask_app.CACHE_ENABLED:
+        cache_key = flask_app.generation_cache_key(prepared, style, room_type, custom_prompt)
+        (generated_key, upstream_url), cached = await flask_app.generation_cache.get_or_create_async(
+            cache_key, create, run_blocking
+        )
+        if cached:
+            logger.info("Cache hit for %s, reusing %s", cache_key[:12], generated_key)
+    else:
+        generated_key, upstream_url = await create()
+
+    return await run_blocking(
+        flask_app.finish_variant, prepared, style, room_type, custom_prompt, generated_key, upstream_url, timings
+    )
+
+
+async def read_upload(request):
+    """Form fields and image bytes of a multipart request; image is None when missing.
+
+    Raises UploadTooLarge from the Content-Length header, before the body
+    is read.
+    """
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > flask_app.MAX_UPLOAD_BYTES:
+        raise UploadTooLarge(f"Upload is larger than {flask_app.MAX_UPLOAD_BYTES // (1024 * 1024)} MB")
+    form = await request.form()
+    upload = form.get('image')
+    if upload is None or isinstance(upload, str):
+        return form, None, None
+    return form, await upload.read(), upload.content_type
+
+
+async def generate_designs(request):
+    try:
+        form, image_data, content_type = await read_upload(request)
+        style, room_type, custom_prompt = flask_app.parse_generation_form(form)
+        reuse_similar = flask_app.parse_reuse_form(form)
+        try:
+            mask_spec = flask_app.parse_mask_form(form)
+            size = flask_app.parse_preview_form(form)
+        except ValueError as e:
+            return error(str(e), 400)
+
+        if image_data is None:
+            return error("No image provided", 400)
+
+        logger.info(
+            "Starting design generation: style=%s room_type=%s size=%d bytes=%d content_type=%s",
+            style, room_type, size, len(image_data), content_type
+        )
+
+        try:
+            prepared = await run_blocking(flask_app.prepare_generation, image_data, mask_spec, size)
+            return JSONResponse(await generate_variant(prepared, style, room_type, custom_prompt, reuse_similar))
+        except UploadTooLarge as e:
+            return error(str(e), 413)
+        except Overloaded as e:
+            return overloaded_response(e)
+        except Exception as api_error:
+            return error(flask_app.describe_api_error(api_error), 500)
+    except UploadTooLarge as e:
+        return error(str(e), 413)
+    except Exception as e:
+        logger.exception("Error generating design")
+        return error(str(e), 500)
+
+
+async def generate_designs_batch(request):
+    """Render one photo in several styles, streaming each result as it finishes"""
+    try:
+        form, image_data, _ = await read_upload(request)
+        _, _, custom_prompt = flask_app.parse_generation_form(form)
+        reuse_similar = flask_app.parse_reuse_form(form)
+        try:
+            mask_spec = flask_app.parse_mask_form(form)
+            variants = flask_app.parse_variants_form(form)
+            size = flask_app.parse_preview_form(form)
+        except ValueError as e:
+            return error(str(e), 400)
+
+        if image_data is None:
+            return error("No image provided", 400)
+        logger.info("Starting batch of %d designs at %dpx", len(variants), size)
+
+        try:
+            prepared = await run_blocking(flask_app.prepare_generation, image_data, mask_spec, size)
+        except UploadTooLarge as e:
+            return error(str(e), 413)
+        except Overloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return error(flask_app.describe_api_error(e), 500)
+    except UploadTooLarge as e:
+        return error(str(e), 413)
+    except Exception as e:
+        logger.exception("Error starting batch generation")
+        return error(str(e), 500)
+
+    semaphore = asyncio.Semaphore(flask_app.BATCH_CONCURRENCY)
+
+    async def render(index, style, room_type):
+        variant = {"index": index, "style": style, "roomType": room_type}
+        async with semaphore:
+            try:
+                return 'result', {**variant, **await generate_variant(prepared, style, room_type, custom_prompt, reuse_similar)}
+            except Overloaded as e:
+                return 'error', {**variant, "error": str(e), "retryAfter": round(e.retry_after)}
+            except Exception as e:
+                return 'error', {**variant, "error": flask_app.describe_api_error(e)}
+
+    async def results():
+        tasks = [asyncio.ensure_future(render(index, *variant)) for index, variant in enumerate(variants)]
+        # Unlike the thread pool version, a disconnect cancels edits not yet finished
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield flask_app.sse_event(*await finished)
+            yield flask_app.sse_event('done', {"count": len(variants)})
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+async def get_generations(request):
+    try:
+        try:
+            query = flask_app.parse_generations_query(request.query_params)
+        except ValueError as e:
+            return error(str(e), 400)
+        generations, next_cursor = await run_blocking(flask_app.list_generations, *query)
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else None
+        return JSONResponse(generations, headers=headers)
+    except Exception as e:
+        logger.error("Error fetching generations: %s", e)
+        return error(str(e), 500)
+
+
+async def search_generations(request):
+    try:
+        try:
+            query = flask_app.parse_generations_query(request.query_params)
+        except ValueError as e:
+            return error(str(e), 400)
+        payload, next_cursor = await run_blocking(
+            flask_app.search_generations, request.query_params.get('q', ''), *query
+        )
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else None
+        return JSONResponse(payload, headers=headers)
+    except Exception as e:
+        logger.error("Error searching generations: %s", e)
+        return error(str(e), 500)
+
+
+async def get_generation_stats(request):
+    try:
+        try:
+            days = min(max(int(request.query_params.get('days', flask_app.STATS_DAYS)), 1), flask_app.STATS_MAX_DAYS)
+        except ValueError:
+            return error('days must be a number', 400)
+        return JSONResponse(await run_blocking(flask_app.generation_stats, days))
+    except Exception as e:
+        logger.error("Error reading generation stats: %s", e)
+        return error(str(e), 500)
+
+
+async def get_previews(request):
+    try:
+        try:
+            query = flask_app.parse_generations_query(request.query_params)
+        except ValueError as e:
+            return error(str(e), 400)
+        previews, next_cursor = await run_blocking(flask_app.list_previews, *query)
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else None
+        return JSONResponse(previews, headers=headers)
+    except Exception as e:
+        logger.error("Error fetching previews: %s", e)
+        return error(str(e), 500)
+
+
+async def finalize_preview(request):
+    """Render a preview at full resolution; the upstream call is awaited, not run on a thread"""
+    preview_id = request.path_params['preview_id']
+    try:
+        logger.info("Finalizing preview %d", preview_id)
+        deadline = time.monotonic() + flask_app.FINALIZE_MAX_WAIT
+        while True:
+            existing, claimed = await run_blocking(flask_app.begin_finalize, preview_id)
+            if existing is not None:
+                return JSONResponse(existing)
+            if claimed:
+                break
+            if time.monotonic() >= deadline:
+                raise flask_app.finalize_busy()
+            await asyncio.sleep(flask_app.FINALIZE_POLL_SECONDS)
+        try:
+            prepared, (style, room_type, custom_prompt) = await run_blocking(flask_app.prepare_finalize, preview_id)
+            payload = await generate_variant(prepared, style, room_type, custom_prompt)
+        except BaseException:
+            await asyncio.shield(run_blocking(flask_app.release_finalize, preview_id))
+            raise
+        return JSONResponse(await run_blocking(flask_app.record_finalized, preview_id, payload))
+    except LookupError as e:
+        return error(str(e), 404)
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as api_error:
+        return error(flask_app.describe_api_error(api_error), 500)
+
+
+async def export_generations(request):
+    try:
+        selection = flask_app.parse_export_query(request.query_params)
+    except ValueError as e:
+        return error(str(e), 400)
+
+    async def chunks():
+        # Each step reads storage and maybe the database, so it runs on the executor
+        archive = export.stream_archive(flask_app.image_store, **selection)
+        try:
+            while True:
+                data = await run_blocking(next, archive, None)
+                if data is None:
+                    return
+                yield data
+        finally:
+            await run_blocking(archive.close)
+
+    return StreamingResponse(chunks(), media_type='application/zip', headers={
+        'Content-Disposition': f'attachment; filename="{flask_app.export_filename()}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+async def get_stored_image(request):
+    """Same caching, conditional and range behavior as the Flask route"""
+    filename = request.path_params['filename']
+    try:
+        storage.validate_key(filename)
+        flask_app.reconciler.touch(filename)
+        try:
+            width = int(request.query_params.get('w', 0))
+        except ValueError:
+            width = 0
+        if width:
+            fmt = 'webp' if 'image/webp' in request.headers.get('accept', '') else 'jpeg'
+            path = await run_blocking(
+                thumbnails.get_thumbnail, filename, width, fmt, lambda: flask_app.image_store.open(filename)
+            )
+            mimetype = f'image/{fmt}'
+        else:
+            path = flask_app.image_store.local_path(filename)
+            if path is None:
+                direct_url = await run_blocking(flask_app.image_store.direct_url, filename)
+                return RedirectResponse(direct_url, status_code=302, headers={
+                    'Cache-Control': f'public, max-age={storage.S3_URL_EXPIRY // 2}'
+                })
+            mimetype = await run_blocking(flask_app.sniff_mimetype, path)
+
+        stat = await run_blocking(os.stat, path)
+        headers = {
+            'Cache-Control': f'public, max-age={flask_app.IMAGE_MAX_AGE}, immutable',
+            'Accept-Ranges': 'bytes',
+        }
+        if width:
+            headers['Vary'] = 'Accept'
+        response = FileResponse(path, media_type=mimetype, headers=headers, stat_result=stat)
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match and response.headers['etag'] in (tag.strip() for tag in if_none_match.split(',')):
+            headers['ETag'] = response.headers['etag']
+            return Response(status_code=304, headers=headers)
+        return response
+    except (FileNotFoundError, storage.InvalidKey):
+        logger.info("Image not found: %s", filename)
+        return error('Image not found', 404)
+    except Exception as e:
+        logger.error("Error serving image: %s", e)
+        return error(str(e), 500)
+
+
+async def get_upstream_stats(request):
+    return JSONResponse(flask_app.upstream.stats())
+
+
+async def get_cache_stats(request):
+    try:
+        stats = await run_blocking(flask_app.generation_cache.stats)
+        return JSONResponse({**stats, 'similar': flask_app.similar_index.stats()})
+    except Exception as e:
+        logger.error("Error reading cache stats: %s", e)
+        return error(str(e), 500)
+
+
+async def get_reconcile_report(request):
+    if flask_app.reconciler.last_report is None:
+        return error("No reconciliation pass has finished yet", 404)
+    return JSONResponse(flask_app.reconciler.last_report)
+
+
+async def submit_generation_job(request):
+    """Queue a design generation; jobs run on the shared job queue's threads"""
+    try:
+        form, image_data, _ = await read_upload(request)
+        style, room_type, custom_prompt = flask_app.parse_generation_form(form)
+        reuse_similar = flask_app.parse_reuse_form(form)
+        try:
+            mask_spec = flask_app.parse_mask_form(form)
+            size = flask_app.parse_preview_form(form)
+        except ValueError as e:
+            return error(str(e), 400)
+
+        if image_data is None:
+            return error("No image provided", 400)
+        # Refuse an oversized photo now rather than fail the job later
+        flask_app.open_upload(image_data)
+
+        try:
+            job_id = await run_blocking(functools.partial(
+                flask_app.job_queue.submit,
+                flask_app.run_generation, image_data, style, room_type, custom_prompt, mask_spec, reuse_similar, size,
+                style=style, room_type=room_type
+            ))
+        except QueueFull:
+            return error("Too many pending generations. Please try again shortly.", 503)
+
+        logger.info("Queued generation job %s (%s, %s)", job_id, style, room_type)
+        return JSONResponse({
+            "jobId": job_id,
+            "status": "queued",
+            "statusUrl": f"/api/jobs/{job_id}",
+            "eventsUrl": f"/api/jobs/{job_id}/events"
+        }, status_code=202)
+    except UploadTooLarge as e:
+        return error(str(e), 413)
+    except Exception as e:
+        logger.exception("Error queueing generation job")
+        return error(str(e), 500)
+
+
+async def get_generation_job(request):
+    job = await run_blocking(flask_app.job_queue.get, request.path_params['job_id'])
+    if job is None:
+        return error("Job not found", 404)
+    return JSONResponse(job)
+
+
+async def stream_generation_job(request):
+    """Stream job status changes as server-sent events"""
+    job_id = request.path_params['job_id']
+    job = await run_blocking(flask_app.job_queue.get, job_id)
+    if job is None:
+        return error("Job not found", 404)
+
+    async def events(job):
+        last_status = None
+        while True:
+            if job['status'] != last_status:
+                last_status = job['status']
+                yield flask_app.sse_event(last_status, job)
+            else:
+                # Comment line keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+            if last_status in FINISHED_STATUSES:
+                return
+            # Poll rather than park a thread on the queue's condition
+            keepalive_at = time.monotonic() + flask_app.SSE_KEEPALIVE_SECONDS
+            while time.monotonic() < keepalive_at:
+                await asyncio.sleep(JOB_POLL_SECONDS)
+                job = await run_blocking(flask_app.job_queue.get, job_id)
+                if job['status'] != last_status:
+                    break
+
+    return StreamingResponse(events(job), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+async def get_metrics(request):
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+class RequestMetricsMiddleware:
+    """Per-endpoint response counts and times, as the Flask hooks record them"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+
+        async def send_and_record(message):
+            if message['type'] == 'http.response.start':
+                route = scope.get('route')
+                endpoint = route.path if route is not None else 'unmatched'
+                flask_app.http_requests_total.inc(endpoint=endpoint, status=message['status'])
+                flask_app.http_request_seconds.observe(time.perf_counter() - started, endpoint=endpoint)
+            await send(message)
+
+        await self.app(scope, receive, send_and_record)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Start the preprocessing workers before the first upload has to wait for them
+    await run_blocking(flask_app.preprocessor.warm)
+    flask_app.start_background_tasks()
+    yield
+    await http_client.aclose()
+    await aclient.close()
+    blocking_executor.shutdown(wait=False)
+    flask_app.preprocessor.shutdown()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/generate-designs', generate_designs, methods=['POST']),
+        Route('/api/generate-designs/batch', generate_designs_batch, methods=['POST']),
+        Route('/api/generations', get_generations, methods=['GET']),
+        Route('/api/generations/search', search_generations, methods=['GET']),
+        Route('/api/generations/stats', get_generation_stats, methods=['GET']),
+        Route('/api/generations/export', export_generations, methods=['GET']),
+        Route('/api/previews', get_previews, methods=['GET']),
+        Route('/api/previews/{preview_id:int}/finalize', finalize_preview, methods=['POST']),
+        Route('/api/stored-image/{filename:path}', get_stored_image, methods=['GET']),
+        Route('/api/upstream/stats', get_upstream_stats, methods=['GET']),
+        Route('/api/cache/stats', get_cache_stats, methods=['GET']),
+        Route('/api/storage/reconcile', get_reconcile_report, methods=['GET']),
+        Route('/api/jobs', submit_generation_job, methods=['POST']),
+        Route('/api/jobs/{job_id}', get_generation_job, methods=['GET']),
+        Route('/api/jobs/{job_id}/events', stream_generation_job, methods=['GET']),
+        Route('/metrics', get_metrics, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(RequestMetricsMiddleware),
+        Middleware(
+            CORSMiddleware,
+            allow_origins=['*'],
+            allow_methods=['GET', 'POST', 'OPTIONS'],
+            allow_headers=['Content-Type'],
+            expose_headers=['X-Next-Cursor']
+        ),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,206 @@
+"""Content-addressed cache of generated images.
+
+Entries map a hash of the normalized input image and the final prompt to
+the storage key of a generated image. Concurrent requests for the
+same key share a single upstream call.
+"""
+import asyncio
+import hashlib
+import threading
+import time
+
+import db
+
+
+class _Flight:
+    """An in-progress computation other threads can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class GenerationCache:
+    def __init__(self, storage, max_entries=1000, max_bytes=1 << 30, max_age=30 * 86400):
+        self.storage = storage
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._async_flights = {}
+        self._counters = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(image_png, *parts):
+        """Hash the normalized image bytes together with the prompt parts"""
+        digest = hashlib.sha256(image_png)
+        for part in parts:
+            # Length-prefix each part so ('ab', 'c') and ('a', 'bc') differ
+            encoded = part.encode('utf-8')
+            digest.update(len(encoded).to_bytes(4, 'big'))
+            digest.update(encoded)
+        return digest.hexdigest()
+
+    def get_or_create(self, key, create):
+        """Return (value, hit) for key, calling create() on a miss.
+
+        create() must return (storage key, fallback); only results with a
+        stored key are cached. Threads asking for a key that is
+        already being created wait for that call instead of making their own.
+        """
+        filename = self.get(key)
+        if filename is not None:
+            return (filename, None), True
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self._counters['misses'] += 1
+            else:
+                self._counters['coalesced'] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, True
+
+        try:
+            flight.value = create()
+            filename = flight.value[0]
+            if filename is not None:
+                self.put(key, filename)
+            return flight.value, False
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    async def get_or_create_async(self, key, create, run_blocking):
+        """get_or_create() for the event loop.
+
+        create is a coroutine function; run_blocking(fn, *args) runs the
+        database work off the loop. Coroutines asking for a key already
+        being created await the same future.
+        """
+        filename = await run_blocking(self.get, key)
+        if filename is not None:
+            return (filename, None), True
+
+        with self._lock:
+            future = self._async_flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._async_flights[key] = asyncio.get_running_loop().create_future()
+                self._counters['misses'] += 1
+            else:
+                self._counters['coalesced'] += 1
+
+        if not leader:
+            # shield() so a follower going away doesn't cancel the leader's result
+            return await asyncio.shield(future), True
+
+        try:
+            value = await create()
+            if value[0] is not None:
+                await run_blocking(self.put, key, value[0])
+            future.set_result(value)
+            return value, False
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so an unawaited failure isn't logged as lost
+            future.exception()
+            raise
+        finally:
+            with self._lock:
+                del self._async_flights[key]
+
+    def get(self, key):
+        """Return the cached storage key for key, or None on a miss"""
+        now = time.time()
+        row = db.query_one(
+            'SELECT generated_filename, created_at FROM generation_cache WHERE key = ?',
+            (key,)
+        )
+        if row is None:
+            return None
+
+        filename, created_at = row
+        if now - created_at > self.max_age or not self.storage.exists(filename):
+            db.execute('DELETE FROM generation_cache WHERE key = ?', (key,))
+            return None
+
+        db.execute(
+            'UPDATE generation_cache SET last_used_at = ?, hits = hits + 1 WHERE key = ?',
+            (now, key)
+        )
+
+        with self._lock:
+            self._counters['hits'] += 1
+        return filename
+
+    def put(self, key, filename):
+        """Record a generated image under key and evict old entries"""
+        now = time.time()
+        size_bytes = self.storage.size(filename)
+        with db.transaction() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO generation_cache
+                (key, generated_filename, size_bytes, created_at, last_used_at, hits)
+                VALUES (?, ?, ?, ?, ?, 0)
+            ''', (key, filename, size_bytes, now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        """Drop expired entries, then least recently used ones over budget.
+
+        Only the cache entry is removed; the image stays in history.
+        """
+        evicted = conn.execute(
+            'DELETE FROM generation_cache WHERE created_at < ?', (now - self.max_age,)
+        ).rowcount
+
+        count, total = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM generation_cache'
+        ).fetchone()
+        if count > self.max_entries or total > self.max_bytes:
+            rows = conn.execute(
+                'SELECT key, size_bytes FROM generation_cache ORDER BY last_used_at'
+            )
+            victims = []
+            for key, size_bytes in rows:
+                if count <= self.max_entries and total <= self.max_bytes:
+                    break
+                victims.append((key,))
+                count -= 1
+                total -= size_bytes
+            conn.executemany('DELETE FROM generation_cache WHERE key = ?', victims)
+            evicted += len(victims)
+
+        if evicted:
+            with self._lock:
+                self._counters['evictions'] += evicted
+
+    def stats(self):
+        """Counters since startup plus the current size of the cache"""
+        count, total = db.query_one(
+            'SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM generation_cache'
+        )
+
+        with self._lock:
+            stats = dict(self._counters)
+        lookups = stats['hits'] + stats['misses']
+        stats['hitRate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['entries'] = count
+        stats['bytes'] = total
+        return stats
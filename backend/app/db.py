@@ -0,0 +1,296 @@
+"""SQLite access layer.
+
+Each thread keeps one open connection in WAL mode, so readers never
+block the writer and statements stay in the connection's prepared
+statement cache between requests. Connections run in autocommit mode;
+use ``transaction()`` to group writes.
+"""
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv('DATABASE_PATH', str(Path(os.path.abspath(os.path.dirname(__file__))) / 'images.db'))
+
+# Prepared statements kept per connection
+STATEMENT_CACHE_SIZE = 256
+
+# Milliseconds to wait for another writer before raising "database is locked"
+BUSY_TIMEOUT_MS = 5000
+
+# Schema history; each entry upgrades the database to the next version.
+# Append new entries, never edit old ones.
+MIGRATIONS = [
+    # 1: generation history, job queue and generation cache
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS generated_images
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         original_path TEXT NOT NULL,
+         generated_path TEXT NOT NULL,
+         style TEXT NOT NULL,
+         room_type TEXT NOT NULL,
+         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS generation_jobs
+        (id TEXT PRIMARY KEY,
+         status TEXT NOT NULL,
+         style TEXT,
+         room_type TEXT,
+         result TEXT,
+         error TEXT,
+         created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+         updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS generation_cache
+        (key TEXT PRIMARY KEY,
+         generated_filename TEXT NOT NULL,
+         size_bytes INTEGER NOT NULL,
+         created_at REAL NOT NULL,
+         last_used_at REAL NOT NULL,
+         hits INTEGER NOT NULL DEFAULT 0)
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_generation_cache_last_used ON generation_cache (last_used_at)',
+        # Keyset pagination and filtering for /api/generations
+        'CREATE INDEX IF NOT EXISTS idx_generated_images_timestamp ON generated_images (timestamp, id)',
+        'CREATE INDEX IF NOT EXISTS idx_generated_images_style ON generated_images (style, timestamp, id)',
+        'CREATE INDEX IF NOT EXISTS idx_generated_images_style_room ON generated_images (style, room_type, timestamp, id)',
+        'CREATE INDEX IF NOT EXISTS idx_generated_images_room_type ON generated_images (room_type, timestamp, id)',
+    ],
+    # 2: inventory of stored files for the reconciler, and lookups by file
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS stored_objects
+        (key TEXT PRIMARY KEY,
+         size_bytes INTEGER NOT NULL,
+         last_accessed REAL NOT NULL,
+         seen_at REAL NOT NULL)
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_stored_objects_last_accessed ON stored_objects (last_accessed, key)',
+        'CREATE INDEX IF NOT EXISTS idx_generated_images_original_path ON generated_images (original_path)',
+        'CREATE INDEX IF NOT EXISTS idx_generated_images_generated_path ON generated_images (generated_path)',
+        # Rows from before content addressing hold absolute paths into the
+        # flat storage directory; their file name is the storage key
+        '''
+        UPDATE generated_images
+        SET original_path = replace(original_path, rtrim(original_path, replace(original_path, '/', '')), '')
+        WHERE original_path LIKE '/%'
+        ''',
+        '''
+        UPDATE generated_images
+        SET generated_path = replace(generated_path, rtrim(generated_path, replace(generated_path, '/', '')), '')
+        WHERE generated_path LIKE '/%'
+        ''',
+    ],
+    # 3: perceptual hash of the photo behind plain generations (similarity.py)
+    [
+        'ALTER TABLE generated_images ADD COLUMN image_hash INTEGER',
+    ],
+    # 4: prompts with a full-text index, and counts kept up to date by
+    # triggers so facets and daily volume never scan the history (search.py)
+    [
+        'ALTER TABLE generated_images ADD COLUMN prompt TEXT',
+        'ALTER TABLE generated_images ADD COLUMN custom_prompt TEXT',
+        # External content: the text lives in generated_images only
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS generated_images_fts USING fts5(
+            prompt, custom_prompt,
+            content='generated_images', content_rowid='id', tokenize='porter unicode61'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS generation_facets
+        (style TEXT NOT NULL,
+         room_type TEXT NOT NULL,
+         count INTEGER NOT NULL,
+         PRIMARY KEY (style, room_type)) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS generation_daily
+        (day TEXT PRIMARY KEY,
+         count INTEGER NOT NULL,
+         custom_prompts INTEGER NOT NULL) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS generated_images_after_insert AFTER INSERT ON generated_images BEGIN
+            INSERT INTO generated_images_fts (rowid, prompt, custom_prompt)
+            VALUES (new.id, new.prompt, new.custom_prompt);
+            INSERT INTO generation_facets (style, room_type, count) VALUES (new.style, new.room_type, 1)
+            ON CONFLICT (style, room_type) DO UPDATE SET count = count + 1;
+            INSERT INTO generation_daily (day, count, custom_prompts)
+            VALUES (date(new.timestamp), 1, new.custom_prompt IS NOT NULL)
+            ON CONFLICT (day) DO UPDATE SET count = count + 1, custom_prompts = custom_prompts + excluded.custom_prompts;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS generated_images_after_delete AFTER DELETE ON generated_images BEGIN
+            INSERT INTO generated_images_fts (generated_images_fts, rowid, prompt, custom_prompt)
+            VALUES ('delete', old.id, old.prompt, old.custom_prompt);
+            UPDATE generation_facets SET count = count - 1 WHERE style = old.style AND room_type = old.room_type;
+            DELETE FROM generation_facets WHERE style = old.style AND room_type = old.room_type AND count <= 0;
+            UPDATE generation_daily
+            SET count = count - 1, custom_prompts = custom_prompts - (old.custom_prompt IS NOT NULL)
+            WHERE day = date(old.timestamp);
+            DELETE FROM generation_daily WHERE day = date(old.timestamp) AND count <= 0;
+        END
+        ''',
+        # Rows are only rewritten by migrations, but keep the counts right if they are
+        '''
+        CREATE TRIGGER IF NOT EXISTS generated_images_after_update
+        AFTER UPDATE OF prompt, custom_prompt, style, room_type, timestamp ON generated_images BEGIN
+            INSERT INTO generated_images_fts (generated_images_fts, rowid, prompt, custom_prompt)
+            VALUES ('delete', old.id, old.prompt, old.custom_prompt);
+            INSERT INTO generated_images_fts (rowid, prompt, custom_prompt)
+            VALUES (new.id, new.prompt, new.custom_prompt);
+            UPDATE generation_facets SET count = count - 1 WHERE style = old.style AND room_type = old.room_type;
+            DELETE FROM generation_facets WHERE style = old.style AND room_type = old.room_type AND count <= 0;
+            INSERT INTO generation_facets (style, room_type, count) VALUES (new.style, new.room_type, 1)
+            ON CONFLICT (style, room_type) DO UPDATE SET count = count + 1;
+            UPDATE generation_daily
+            SET count = count - 1, custom_prompts = custom_prompts - (old.custom_prompt IS NOT NULL)
+            WHERE day = date(old.timestamp);
+            DELETE FROM generation_daily WHERE day = date(old.timestamp) AND count <= 0;
+            INSERT INTO generation_daily (day, count, custom_prompts)
+            VALUES (date(new.timestamp), 1, new.custom_prompt IS NOT NULL)
+            ON CONFLICT (day) DO UPDATE SET count = count + 1, custom_prompts = custom_prompts + excluded.custom_prompts;
+        END
+        ''',
+        # Existing history has no prompts, but every row needs an (empty)
+        # index entry for the delete trigger to remove, and counting
+        "INSERT INTO generated_images_fts (generated_images_fts) VALUES ('rebuild')",
+        '''
+        INSERT INTO generation_facets (style, room_type, count)
+        SELECT style, room_type, COUNT(*) FROM generated_images GROUP BY style, room_type
+        ''',
+        '''
+        INSERT INTO generation_daily (day, count, custom_prompts)
+        SELECT date(timestamp), COUNT(*), 0 FROM generated_images GROUP BY date(timestamp)
+        ''',
+    ],
+    # 5: low-resolution previews, kept apart from the history of full
+    # renders; final_id is the generated_images row a preview became
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS preview_images
+        (id INTEGER PRIMARY KEY AUTOINCREMENT,
+         original_path TEXT NOT NULL,
+         generated_path TEXT NOT NULL,
+         style TEXT NOT NULL,
+         room_type TEXT NOT NULL,
+         size INTEGER NOT NULL,
+         prompt TEXT,
+         custom_prompt TEXT,
+         mask TEXT NOT NULL,
+         final_id INTEGER,
+         timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_preview_images_timestamp ON preview_images (timestamp, id)',
+        'CREATE INDEX IF NOT EXISTS idx_preview_images_original_path ON preview_images (original_path)',
+        'CREATE INDEX IF NOT EXISTS idx_preview_images_generated_path ON preview_images (generated_path)',
+    ],
+    # 6: the queue that owns each job and when it last reported it alive,
+    # so one worker's restart doesn't fail another's jobs (jobs.py)
+    [
+        'ALTER TABLE generation_jobs ADD COLUMN owner TEXT',
+        'ALTER TABLE generation_jobs ADD COLUMN heartbeat_at REAL',
+        'CREATE INDEX IF NOT EXISTS idx_generation_jobs_status ON generation_jobs (status, heartbeat_at)',
+    ],
+    # 7: when a finalize call claimed a preview, so concurrent calls
+    # render it once (app.finalize_preview)
+    [
+        'ALTER TABLE preview_images ADD COLUMN finalizing_at REAL',
+    ],
+]
+
+_local = threading.local()
+
+
+def open_connection(path=None):
+    """Open a new connection with the pragmas every connection needs"""
+    conn = sqlite3.connect(
+        path or DB_PATH,
+        isolation_level=None,
+        cached_statements=STATEMENT_CACHE_SIZE
+    )
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA journal_mode = WAL')
+    # Durable across application crashes; WAL makes NORMAL safe
+    conn.execute('PRAGMA synchronous = NORMAL')
+    return conn
+
+
+def get_connection():
+    """Return this thread's connection, opening it on first use"""
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _local.conn = open_connection()
+    return conn
+
+
+def close_connection():
+    """Close this thread's connection, if it has one"""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+
+def query(sql, params=()):
+    """Run a SELECT and return all rows"""
+    return get_connection().execute(sql, params).fetchall()
+
+
+def query_one(sql, params=()):
+    """Run a SELECT and return the first row, or None"""
+    return get_connection().execute(sql, params).fetchone()
+
+
+def execute(sql, params=()):
+    """Run one statement in its own transaction and return the cursor"""
+    return get_connection().execute(sql, params)
+
+
+def execute_many(sql, seq_of_params):
+    """Run a statement for every parameter set in a single transaction"""
+    with transaction() as conn:
+        return conn.executemany(sql, seq_of_params).rowcount
+
+
+@contextmanager
+def transaction():
+    """Group statements into one write transaction.
+
+    BEGIN IMMEDIATE takes the write lock up front, so a transaction that
+    reads before it writes can't fail halfway with SQLITE_BUSY.
+    """
+    conn = get_connection()
+    if conn.in_transaction:
+        # Nested use joins the outer transaction
+        yield conn
+        return
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    else:
+        conn.execute('COMMIT')
+
+
+def migrate():
+    """Bring the schema up to date"""
+    conn = get_connection()
+    with transaction():
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f'PRAGMA user_version = {number}')
+            logger.info("Applied database migration %d", number)
@@ -0,0 +1,222 @@
+"""ZIP exports of the generation history, streamed as they are built.
+
+The archive is written to a sink that can't seek, so zipfile puts each
+entry's CRC and sizes in a data descriptor after its data instead of
+going back to patch the header. Zip64 records are added if the archive
+passes 4 GB. Images are copied in chunks straight from storage into
+stored (uncompressed) entries, because JPEG and PNG are compressed
+already. The manifest is spooled to a temporary file alongside and added
+last. Memory doesn't grow with the size of the files: it holds a chunk,
+a batch of rows, and per file added its name and the central directory
+record zipfile writes at the end (a few hundred bytes each).
+
+Rows are read in batches of EXPORT_BATCH_ROWS by id, newest first, and
+no database cursor is held between batches. The ASGI app advances the
+stream from its executor threads, and each batch may run on a different
+thread.
+"""
+import csv
+import io
+import json
+import logging
+import tempfile
+import time
+import zipfile
+from datetime import datetime
+from pathlib import PurePosixPath
+
+import db
+import metrics
+import search
+import storage
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from storage and handed to the response at a time
+EXPORT_CHUNK_BYTES = 256 * 1024
+# History rows read per query
+EXPORT_BATCH_ROWS = 500
+# Manifests larger than this spill from memory to disk
+MANIFEST_SPOOL_BYTES = 1024 * 1024
+
+MANIFEST_FORMATS = ('json', 'csv')
+MANIFEST_FIELDS = ('id', 'timestamp', 'style', 'roomType', 'prompt', 'customPrompt', 'original', 'generated')
+# Archive folders, and the values of the include parameter
+INCLUDE_FOLDERS = ('originals', 'generated')
+
+export_bytes_total = metrics.counter('designspace_export_bytes_total', 'Bytes of ZIP exports sent')
+
+
+class _Sink(io.RawIOBase):
+    """Write-only, unseekable buffer that zipfile writes into and the stream drains"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _rows(ids, expression, style, room_type):
+    """(id, original, generated, style, room_type, timestamp, prompt, custom_prompt) rows, newest first"""
+    before_id = None
+    while True:
+        if expression is not None and ids is None:
+            rows = search.search(expression, EXPORT_BATCH_ROWS, before_id, style, room_type)[:EXPORT_BATCH_ROWS]
+        else:
+            conditions, params = [], []
+            if ids is not None:
+                conditions.append(f"id IN ({', '.join('?' * len(ids))})")
+                params.extend(ids)
+            if expression is not None:
+                conditions.append('id IN (SELECT rowid FROM generated_images_fts WHERE generated_images_fts MATCH ?)')
+                params.append(expression)
+            if style:
+                conditions.append('style = ?')
+                params.append(style)
+            if room_type:
+                conditions.append('room_type = ?')
+                params.append(room_type)
+            if before_id is not None:
+                conditions.append('id < ?')
+                params.append(before_id)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+            rows = db.query(f'''
+                SELECT id, original_path, generated_path, style, room_type, timestamp, prompt, custom_prompt
+                FROM generated_images
+                {where}
+                ORDER BY id DESC
+                LIMIT ?
+            ''', params + [EXPORT_BATCH_ROWS])
+        yield from rows
+        if len(rows) < EXPORT_BATCH_ROWS:
+            return
+        before_id = rows[-1][0]
+
+
+def _date_time(timestamp):
+    """ZIP entry date for a history timestamp; ZIP dates start in 1980"""
+    try:
+        stamp = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return time.gmtime()[:6]
+    return max(stamp.timetuple()[:6], (1980, 1, 1, 0, 0, 0))
+
+
+class _Manifest:
+    """One record per exported generation, spooled until the archive ends"""
+
+    def __init__(self, fmt):
+        self.fmt = fmt
+        self.file = tempfile.SpooledTemporaryFile(max_size=MANIFEST_SPOOL_BYTES, mode='w+', newline='',
+                                                  encoding='utf-8')
+        self.count = 0
+        if fmt == 'csv':
+            self._writer = csv.DictWriter(self.file, MANIFEST_FIELDS)
+            self._writer.writeheader()
+        else:
+            self.file.write('[')
+
+    def add(self, record):
+        if self.fmt == 'csv':
+            self._writer.writerow(record)
+        else:
+            self.file.write(('\n' if not self.count else ',\n') + json.dumps(record))
+        self.count += 1
+
+    def chunks(self):
+        if self.fmt == 'json':
+            self.file.write('\n]\n')
+        self.file.seek(0)
+        while True:
+            text = self.file.read(EXPORT_CHUNK_BYTES)
+            if not text:
+                return
+            yield text.encode('utf-8')
+
+    def close(self):
+        self.file.close()
+
+
+def stream_archive(image_store, ids=None, text='', style=None, room_type=None,
+                   include=INCLUDE_FOLDERS, manifest='json'):
+    """Yield the bytes of a ZIP of the selected generations and a manifest.
+
+    ids limits the export to those generations; text, style and room_type
+    filter as for /api/generations/search. Files missing from storage are
+    left out, and their manifest path is null.
+    """
+    records = _Manifest(manifest)
+    sent = 0
+    started = time.perf_counter()
+    try:
+        for data in _archive_chunks(image_store, records, ids, text, style, room_type, include, manifest):
+            if data:
+                sent += len(data)
+                yield data
+        logger.info("Exported %d generations, %d bytes in %.1fs",
+                    records.count, sent, time.perf_counter() - started)
+    finally:
+        records.close()
+        export_bytes_total.inc(sent)
+
+
+def _archive_chunks(image_store, records, ids, text, style, room_type, include, manifest):
+    expression = search.match_expression(text or '')
+    ids = frozenset(ids) if ids is not None else None
+    sink = _Sink()
+    archive = zipfile.ZipFile(sink, 'w')
+    # Content-addressed files are shared between generations; add each once
+    added = set()
+
+    def add_file(folder, key, date_time):
+        """Copy key into folder; returns its archive path, or None if it's missing"""
+        name = f'{folder}/{PurePosixPath(key).name}'
+        if (folder, key) in added:
+            return name
+        try:
+            source = image_store.open(key)
+        except (FileNotFoundError, storage.InvalidKey):
+            logger.warning("Export skipped missing file %s", key)
+            return None
+        added.add((folder, key))
+        entry = zipfile.ZipInfo(name, date_time)
+        entry.compress_type = zipfile.ZIP_STORED
+        with source, archive.open(entry, 'w') as target:
+            while True:
+                chunk = source.read(EXPORT_CHUNK_BYTES)
+                if not chunk:
+                    break
+                target.write(chunk)
+                yield sink.drain()
+        return name
+
+    for row in _rows(ids, expression, style, room_type):
+        date_time = _date_time(row[5])
+        paths = {'original': None, 'generated': None}
+        for field, folder, stored in (('original', 'originals', row[1]), ('generated', 'generated', row[2])):
+            if folder in include:
+                paths[field] = yield from add_file(folder, storage.key_from_path(stored), date_time)
+        records.add({
+            'id': row[0], 'timestamp': row[5], 'style': row[3], 'roomType': row[4],
+            'prompt': row[6], 'customPrompt': row[7], **paths,
+        })
+        yield sink.drain()
+
+    entry = zipfile.ZipInfo(f'manifest.{manifest}', time.gmtime()[:6])
+    entry.compress_type = zipfile.ZIP_DEFLATED
+    with archive.open(entry, 'w') as target:
+        for chunk in records.chunks():
+            target.write(chunk)
+            yield sink.drain()
+    archive.close()
+    yield sink.drain()
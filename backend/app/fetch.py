@@ -0,0 +1,83 @@
+"""Retrieval of generated images into storage.
+
+Downloads share one connection-pooled session, run with timeouts and a
+bounded number of retries, and stream into storage through a save
+function (see storage.LocalStorage.save) that only keeps complete
+files. b64_json results are decoded in chunks the same way.
+"""
+import base64
+import logging
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT = float(os.getenv('FETCH_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('FETCH_READ_TIMEOUT', 30))
+MAX_RETRIES = int(os.getenv('FETCH_RETRIES', 3))
+BACKOFF_SECONDS = 0.5
+POOL_SIZE = int(os.getenv('FETCH_POOL_SIZE', 16))
+CHUNK_SIZE = 64 * 1024
+
+# Worth another attempt: the server or the network had a moment
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+session.mount('https://', _adapter)
+session.mount('http://', _adapter)
+
+
+class FetchError(Exception):
+    """Raised when a download fails for good"""
+
+
+def download(url, save):
+    """Stream url through save(write) and return what save returns.
+
+    save is called once per attempt and must discard the partial data of
+    an attempt whose write raises.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        retry_after = None
+        try:
+            with session.get(url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+                if response.status_code == 200:
+                    def write(f):
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+                    return save(write)
+
+                if response.status_code not in RETRY_STATUSES:
+                    raise FetchError(f"Download failed with HTTP {response.status_code}")
+                error = FetchError(f"Download failed with HTTP {response.status_code}")
+                retry_after = response.headers.get('Retry-After')
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+
+        if attempt == MAX_RETRIES:
+            break
+        # Exponential backoff with jitter, unless the server said how long
+        delay = BACKOFF_SECONDS * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        logger.warning("Download attempt %d failed (%s), retrying in %.1fs", attempt + 1, error, delay)
+        time.sleep(delay)
+
+    raise FetchError(f"Download failed after {MAX_RETRIES + 1} attempts: {error}")
+
+
+def write_base64(data, save):
+    """Decode base64 text through save(write) and return what save returns"""
+    # A multiple of 4 characters decodes independently of its neighbours
+    step = CHUNK_SIZE // 3 * 4
+
+    def write(f):
+        for start in range(0, len(data), step):
+            f.write(base64.b64decode(data[start:start + step]))
+
+    return save(write)
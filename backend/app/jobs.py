@@ -0,0 +1,153 @@
+"""Background job queue for design generation.
+
+Jobs run on a bounded thread pool and their state is kept in the
+``generation_jobs`` table so any worker process can answer a poll.
+
+Every queue has an owner id, new each time a process starts, and stamps
+the jobs it is running with a heartbeat. A job is only failed as
+interrupted once its heartbeat is older than stale_after, so starting or
+restarting one worker never touches another worker's live jobs.
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import db
+
+logger = logging.getLogger(__name__)
+
+FINISHED_STATUSES = ('succeeded', 'failed')
+
+
+class QueueFull(Exception):
+    """Raised when the queue already holds its maximum number of jobs"""
+
+
+class JobQueue:
+    def __init__(self, workers=4, max_pending=32, describe_error=str, heartbeat=10, stale_after=60):
+        self.describe_error = describe_error
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self.owner = uuid.uuid4().hex
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='generation-job')
+        # One slot per queued or running job
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._changed = threading.Condition()
+        self._version = 0
+
+    def start(self):
+        """Keep this queue's jobs alive and fail abandoned ones, in a daemon thread"""
+        thread = threading.Thread(target=self._loop, name='generation-job-heartbeat', daemon=True)
+        thread.start()
+        return thread
+
+    def _loop(self):
+        while True:
+            try:
+                self.beat()
+                self.recover()
+            except Exception:
+                logger.exception("Job heartbeat failed")
+            time.sleep(self.heartbeat)
+
+    def beat(self):
+        """Stamp the jobs this queue is running as still alive"""
+        db.execute('''
+            UPDATE generation_jobs SET heartbeat_at = ?
+            WHERE owner = ? AND status IN ('queued', 'running')
+        ''', (time.time(), self.owner))
+
+    def recover(self):
+        """Fail unfinished jobs whose process has stopped sending heartbeats"""
+        cursor = db.execute('''
+            UPDATE generation_jobs
+            SET status = 'failed', error = 'Interrupted by server restart',
+                updated_at = CURRENT_TIMESTAMP
+            WHERE status IN ('queued', 'running') AND owner IS NOT ?
+              AND (heartbeat_at IS NULL OR heartbeat_at < ?)
+        ''', (self.owner, time.time() - self.stale_after))
+        if cursor.rowcount:
+            logger.warning("Failed %d generation jobs abandoned by a stopped worker", cursor.rowcount)
+
+    def submit(self, fn, *args, style=None, room_type=None):
+        """Queue fn(*args) and return the new job id"""
+        if not self._slots.acquire(blocking=False):
+            raise QueueFull()
+
+        job_id = uuid.uuid4().hex
+        try:
+            db.execute('''
+                INSERT INTO generation_jobs (id, status, style, room_type, owner, heartbeat_at)
+                VALUES (?, 'queued', ?, ?, ?, ?)
+            ''', (job_id, style, room_type, self.owner, time.time()))
+            self._executor.submit(self._run, job_id, fn, args)
+        except Exception:
+            self._slots.release()
+            raise
+        return job_id
+
+    def get(self, job_id):
+        """Return the job as a dict, or None if it doesn't exist"""
+        row = db.query_one('''
+            SELECT id, status, style, room_type, result, error, created_at, updated_at
+            FROM generation_jobs
+            WHERE id = ?
+        ''', (job_id,))
+
+        if row is None:
+            return None
+        return {
+            'id': row[0],
+            'status': row[1],
+            'style': row[2],
+            'roomType': row[3],
+            'result': json.loads(row[4]) if row[4] else None,
+            'error': row[5],
+            'createdAt': row[6],
+            'updatedAt': row[7]
+        }
+
+    def wait(self, job_id, last_status, timeout):
+        """Block until the job leaves last_status or timeout expires.
+
+        Jobs run by another process never notify us, so the row is
+        re-read after every wakeup.
+        """
+        with self._changed:
+            version = self._version
+        job = self.get(job_id)
+        if job is None or job['status'] != last_status:
+            return job
+        with self._changed:
+            # Skip the wait if any job changed since we read the row
+            if self._version == version:
+                self._changed.wait(timeout)
+        return self.get(job_id)
+
+    def _run(self, job_id, fn, args):
+        try:
+            self._update(job_id, 'running')
+            try:
+                result = fn(*args)
+            except Exception as e:
+                logger.warning("Generation job %s failed: %s", job_id, e)
+                self._update(job_id, 'failed', error=self.describe_error(e))
+            else:
+                self._update(job_id, 'succeeded', result=result)
+        finally:
+            self._slots.release()
+
+    def _update(self, job_id, status, result=None, error=None):
+        # A job already failed as abandoned keeps that status; pollers may have stopped on it
+        db.execute('''
+            UPDATE generation_jobs
+            SET status = ?, result = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ? AND status IN ('queued', 'running')
+        ''', (status, json.dumps(result) if result is not None else None, error, job_id))
+
+        with self._changed:
+            self._version += 1
+            self._changed.notify_all()
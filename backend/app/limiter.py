@@ -0,0 +1,220 @@
+"""Admission control in front of the OpenAI images API.
+
+A token bucket caps the request rate and an AIMD limit caps how many
+calls are in flight: the limit grows by about one per round of successful
+calls and halves whenever the API answers 429. Callers wait a bounded
+time for admission and get Overloaded, with a retry hint, instead of
+queueing without end. A call still rate limited after its retries also
+ends in Overloaded; an exhausted quota is passed on as the API's error.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# How often a coroutine waiting for a free slot checks again
+ASYNC_POLL_SECONDS = 0.05
+
+
+class Overloaded(Exception):
+    """Raised when a call can't be admitted within the allowed wait"""
+
+    def __init__(self, retry_after, message="Upstream is busy"):
+        super().__init__(f"{message}, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def is_rate_limited(error):
+    """Whether error is a 429 that is worth retrying later.
+
+    OpenAI also answers 429 for an exhausted quota, which waiting won't fix.
+    """
+    response = getattr(error, 'response', None)
+    if getattr(response, 'status_code', None) != 429:
+        return False
+    return getattr(error, 'code', None) != 'insufficient_quota'
+
+
+def retry_after_of(error):
+    """Seconds the server asked us to wait, if it said"""
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class AdmissionController:
+    def __init__(self, rate=2.0, burst=5, initial_limit=4, min_limit=1, max_limit=16,
+                 max_wait=30.0, max_retries=2, backoff=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self._cond = threading.Condition()
+        self._tokens = float(burst)
+        self._refilled_at = time.monotonic()
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiting = 0
+        # No admissions before this time after a 429
+        self._cooldown_until = 0.0
+        self._counters = {'admitted': 0, 'rejected': 0, 'throttled': 0, 'retries': 0}
+
+    def call(self, fn):
+        """Run fn() once admitted, retrying rate-limited attempts.
+
+        Raises Overloaded if admission takes longer than max_wait, or if
+        the last attempt is still rate limited once retries are used up.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    self.release()
+                    raise
+                delay = retry_after_of(e) or self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                self.release(throttled_for=delay)
+                if attempt == self.max_retries:
+                    raise Overloaded(delay, "Upstream rate limit reached") from e
+                logger.warning("Upstream rate limited, retrying in %.1fs (attempt %d)", delay, attempt + 1)
+                with self._cond:
+                    self._counters['retries'] += 1
+            else:
+                self.release(succeeded=True)
+                return result
+
+    async def call_async(self, fn):
+        """call() for coroutines: await fn() once admitted, without blocking the event loop"""
+        for attempt in range(self.max_retries + 1):
+            await self.acquire_async()
+            try:
+                result = await fn()
+            except Exception as e:
+                if not is_rate_limited(e):
+                    self.release()
+                    raise
+                delay = retry_after_of(e) or self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+                self.release(throttled_for=delay)
+                if attempt == self.max_retries:
+                    raise Overloaded(delay, "Upstream rate limit reached") from e
+                logger.warning("Upstream rate limited, retrying in %.1fs (attempt %d)", delay, attempt + 1)
+                with self._cond:
+                    self._counters['retries'] += 1
+            else:
+                self.release(succeeded=True)
+                return result
+
+    def acquire(self):
+        """Wait for a token and an in-flight slot, or raise Overloaded"""
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            self._waiting += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._try_acquire(now)
+                    if wait is None:
+                        return
+                    self._check_deadline(now, deadline)
+                    self._cond.wait(min(wait, deadline - now))
+            finally:
+                self._waiting -= 1
+
+    async def acquire_async(self):
+        """acquire() for the event loop.
+
+        release() can't wake a coroutine through the condition, so waiting
+        for a free slot polls instead.
+        """
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            self._waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    wait = self._try_acquire(now)
+                    if wait is None:
+                        return
+                    self._check_deadline(now, deadline)
+                await asyncio.sleep(min(wait, ASYNC_POLL_SECONDS, deadline - now))
+        finally:
+            with self._cond:
+                self._waiting -= 1
+
+    def release(self, succeeded=False, throttled_for=None):
+        """Give back an in-flight slot and adjust the limit"""
+        with self._cond:
+            self._in_flight -= 1
+            if throttled_for is not None:
+                # Multiplicative decrease, and hold everyone off for a while
+                self._limit = max(self.min_limit, self._limit / 2)
+                self._cooldown_until = max(self._cooldown_until, time.monotonic() + throttled_for)
+                self._tokens = 0.0
+                self._counters['throttled'] += 1
+            elif succeeded:
+                # Additive increase: about +1 per limit's worth of successes
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._counters)
+            stats.update({
+                'limit': round(self._limit, 2),
+                'inFlight': self._in_flight,
+                'waiting': self._waiting,
+                'cooldownSeconds': round(max(0.0, self._cooldown_until - time.monotonic()), 2),
+            })
+        return stats
+
+    def _try_acquire(self, now):
+        """Take a token and a slot and return None, or return seconds to wait.
+
+        The caller holds the condition.
+        """
+        self._refill(now)
+        wait = self._cooldown_until - now
+        if wait <= 0:
+            if self._in_flight < max(int(self._limit), self.min_limit):
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._in_flight += 1
+                    self._counters['admitted'] += 1
+                    return None
+                wait = (1 - self._tokens) / self.rate
+            else:
+                # Woken by release(); the timeout is just a safety net
+                wait = self.max_wait
+        return wait
+
+    def _check_deadline(self, now, deadline):
+        """Raise Overloaded once waiting any longer is pointless"""
+        # Fail fast when a cooldown outlasts our patience anyway
+        if deadline - now <= 0 or self._cooldown_until > deadline:
+            self._counters['rejected'] += 1
+            raise Overloaded(self._retry_hint(now))
+
+    def _refill(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _retry_hint(self, now):
+        """Rough seconds until a new caller could expect to be admitted"""
+        cooldown = max(0.0, self._cooldown_until - now)
+        queued = (self._waiting + self._in_flight) / self.rate
+        return max(1.0, cooldown, queued)
@@ -0,0 +1,212 @@
+"""Edit masks for the OpenAI images API.
+
+Transparent pixels mark the area DALL-E may repaint; opaque white pixels
+are preserved. Fixed masks are built once per (size, strategy) and kept
+as encoded PNG bytes. Client-drawn masks are rasterized with NumPy and
+memoized by their geometry.
+"""
+import io
+import json
+import threading
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+# Most client-drawn masks kept encoded in memory
+CLIENT_MASK_CACHE_SIZE = 128
+
+# Limits on client-supplied geometry
+MAX_SHAPES = 32
+MAX_POINTS = 2048
+
+PRESERVE = 255
+EDIT = 0
+
+
+def _border(size):
+    """Preserve a frame of about 5% of the image width, edit the interior"""
+    alpha = np.full((size[1], size[0]), EDIT, dtype=np.uint8)
+    border_width = size[0] // 20
+    alpha[:border_width + 1, :] = PRESERVE
+    alpha[size[1] - border_width:, :] = PRESERVE
+    alpha[:, :border_width + 1] = PRESERVE
+    alpha[:, size[0] - border_width:] = PRESERVE
+    return alpha
+
+
+def _full(size):
+    """Let the whole image be edited"""
+    return np.full((size[1], size[0]), EDIT, dtype=np.uint8)
+
+
+STRATEGIES = {
+    'border': _border,
+    'full': _full,
+}
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def encode(alpha):
+    """Encode an alpha plane as an RGBA PNG: white where preserved, clear where edited"""
+    rgba = np.repeat(alpha[:, :, None], 4, axis=2)
+    output = io.BytesIO()
+    Image.fromarray(rgba, 'RGBA').save(output, format='PNG')
+    return output.getvalue()
+
+
+def get_mask(size=(1024, 1024), strategy='border'):
+    """Return the encoded PNG for a fixed mask strategy, building it once"""
+    key = (tuple(size), strategy)
+    mask = _registry.get(key)
+    if mask is None:
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown mask strategy: {strategy}")
+        mask = encode(STRATEGIES[strategy](key[0]))
+        with _registry_lock:
+            mask = _registry.setdefault(key, mask)
+    return mask
+
+
+def warm(sizes, strategies=None):
+    """Build the fixed masks for the given sizes ahead of the first request"""
+    for size in sizes:
+        for strategy in strategies or STRATEGIES:
+            get_mask(size, strategy)
+
+
+def parse_geometry(text):
+    """Validate client mask geometry and return a hashable canonical form.
+
+    The JSON looks like:
+
+        {"polygons": [[[x, y], ...], ...],
+         "strokes": [{"points": [[x, y], ...], "radius": r}, ...]}
+
+    Coordinates are fractions (0-1) of the uploaded photo's width and
+    height; a stroke radius is a fraction of the photo's longer side.
+    Polygons and strokes mark the area to edit. Raises ValueError.
+    """
+    try:
+        data = json.loads(text)
+    except ValueError:
+        raise ValueError("Mask geometry is not valid JSON")
+    if not isinstance(data, dict):
+        raise ValueError("Mask geometry must be an object")
+
+    polygons = data.get('polygons') or []
+    strokes = data.get('strokes') or []
+    if not polygons and not strokes:
+        raise ValueError("Mask geometry has no polygons or strokes")
+    if len(polygons) + len(strokes) > MAX_SHAPES:
+        raise ValueError(f"Mask geometry has more than {MAX_SHAPES} shapes")
+
+    def points(raw, minimum):
+        if not isinstance(raw, list) or not minimum <= len(raw) <= MAX_POINTS:
+            raise ValueError(f"A mask shape needs between {minimum} and {MAX_POINTS} points")
+        try:
+            # Rounding keeps near-identical drawings on the same cache entry
+            return tuple((round(min(max(float(x), 0.0), 1.0), 4), round(min(max(float(y), 0.0), 1.0), 4))
+                         for x, y in raw)
+        except (TypeError, ValueError):
+            raise ValueError("Mask points must be [x, y] number pairs")
+
+    canonical_polygons = tuple(points(polygon, 3) for polygon in polygons)
+    canonical_strokes = []
+    for stroke in strokes:
+        if not isinstance(stroke, dict):
+            raise ValueError("Mask strokes must be objects with points and radius")
+        try:
+            radius = round(float(stroke.get('radius', 0.02)), 4)
+        except (TypeError, ValueError):
+            raise ValueError("Mask stroke radius must be a number")
+        if not 0 < radius <= 1:
+            raise ValueError("Mask stroke radius must be between 0 and 1")
+        canonical_strokes.append((radius, points(stroke.get('points'), 1)))
+
+    return canonical_polygons, tuple(canonical_strokes)
+
+
+def geometry_json(geometry):
+    """JSON text for canonical geometry that parse_geometry reads back unchanged"""
+    polygons, strokes = geometry
+    return json.dumps({
+        'polygons': polygons,
+        'strokes': [{'points': points, 'radius': radius} for radius, points in strokes],
+    }, separators=(',', ':'))
+
+
+def _fill_polygon(inside, vertices):
+    """Even-odd scanline fill of one polygon (pixel coordinates) into inside"""
+    h, w = inside.shape
+    x0, y0 = vertices[:, 0], vertices[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+
+    # Intersections of every edge with every pixel-centre scanline: (H, E)
+    ys = np.arange(h, dtype=np.float64)[:, None] + 0.5
+    crosses = (y0 <= ys) != (y1 <= ys)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xs = x0 + (ys - y0) * (x1 - x0) / (y1 - y0)
+    xs = np.where(crosses, xs, np.inf)
+    xs.sort(axis=1)
+    if xs.shape[1] % 2:
+        xs = np.pad(xs, ((0, 0), (0, 1)), constant_values=np.inf)
+
+    # Pixels whose centres fall between each pair of crossings are inside
+    starts, ends = xs[:, 0::2], xs[:, 1::2]
+    rows = np.nonzero(np.isfinite(ends))
+    first = np.clip(np.ceil(starts[rows] - 0.5), 0, w).astype(np.intp)
+    last = np.clip(np.ceil(ends[rows] - 0.5), 0, w).astype(np.intp)
+    spans = np.zeros((h, w + 1), dtype=np.int32)
+    np.add.at(spans, (rows[0], first), 1)
+    np.add.at(spans, (rows[0], last), -1)
+    inside |= np.cumsum(spans[:, :w], axis=1) > 0
+
+
+def _fill_stroke(inside, points, radius):
+    """Mark every pixel within radius of the stroke's polyline"""
+    h, w = inside.shape
+    if len(points) == 1:
+        points = np.vstack([points, points])
+    for (ax, ay), (bx, by) in zip(points[:-1], points[1:]):
+        # Only look at the segment's bounding box
+        left = int(max(min(ax, bx) - radius, 0))
+        right = int(min(max(ax, bx) + radius + 1, w))
+        top = int(max(min(ay, by) - radius, 0))
+        bottom = int(min(max(ay, by) + radius + 1, h))
+        if left >= right or top >= bottom:
+            continue
+        px = np.arange(left, right, dtype=np.float64)[None, :] + 0.5
+        py = np.arange(top, bottom, dtype=np.float64)[:, None] + 0.5
+
+        dx, dy = bx - ax, by - ay
+        length_sq = dx * dx + dy * dy
+        if length_sq:
+            t = np.clip(((px - ax) * dx + (py - ay) * dy) / length_sq, 0.0, 1.0)
+        else:
+            t = 0.0
+        dist_sq = (px - ax - t * dx) ** 2 + (py - ay - t * dy) ** 2
+        inside[top:bottom, left:right] |= dist_sq <= radius * radius
+
+
+@lru_cache(maxsize=CLIENT_MASK_CACHE_SIZE)
+def rasterize(size, box, geometry):
+    """Return the encoded PNG for client geometry from parse_geometry.
+
+    box is (x, y, width, height) of the photo inside the square canvas,
+    which is how normalized photo coordinates map to pixels.
+    """
+    polygons, strokes = geometry
+    box_x, box_y, box_w, box_h = box
+    scale = np.array([box_w, box_h], dtype=np.float64)
+    offset = np.array([box_x, box_y], dtype=np.float64)
+
+    edit = np.zeros((size[1], size[0]), dtype=bool)
+    for polygon in polygons:
+        _fill_polygon(edit, np.asarray(polygon, dtype=np.float64) * scale + offset)
+    for radius, stroke in strokes:
+        _fill_stroke(edit, np.asarray(stroke, dtype=np.float64) * scale + offset, radius * max(box_w, box_h))
+
+    return encode(np.where(edit, EDIT, PRESERVE).astype(np.uint8))
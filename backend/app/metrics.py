@@ -0,0 +1,157 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+Counters and histograms are labelled by a small fixed set of values
+(stage, endpoint, status). Histograms also keep a window of recent
+observations so percentiles can be read straight off /metrics without
+a Prometheus server doing the math.
+"""
+import bisect
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Seconds; covers everything from a mask lookup to a slow upstream edit
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+QUANTILES = (0.5, 0.95, 0.99)
+RECENT_WINDOW = 1024
+
+_lock = threading.Lock()
+_metrics = {}
+_gauge_callbacks = []
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self):
+        """Sum over all label values"""
+        with _lock:
+            return sum(self._values.values())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self._values.items()):
+            lines.append(f'{self.name}{_label_text(key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {
+                    'counts': [0] * len(self.buckets),
+                    'sum': 0.0,
+                    'count': 0,
+                    'recent': deque(maxlen=RECENT_WINDOW),
+                }
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series['counts'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+            series['recent'].append(value)
+
+    def quantile(self, q, **labels):
+        """q-quantile of the recent window, or None without observations"""
+        with _lock:
+            series = self._series.get(tuple(sorted(labels.items())))
+            recent = sorted(series['recent']) if series else []
+        if not recent:
+            return None
+        return recent[min(len(recent) - 1, int(q * len(recent)))]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        recent_lines = [
+            f'# HELP {self.name}_recent Quantiles over the last {RECENT_WINDOW} observations',
+            f'# TYPE {self.name}_recent gauge',
+        ]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_label_text(key + (("le", bound),))} {cumulative}')
+            lines.append(f'{self.name}_bucket{_label_text(key + (("le", "+Inf"),))} {series["count"]}')
+            lines.append(f'{self.name}_sum{_label_text(key)} {series["sum"]}')
+            lines.append(f'{self.name}_count{_label_text(key)} {series["count"]}')
+
+            recent = sorted(series['recent'])
+            for q in QUANTILES:
+                value = recent[min(len(recent) - 1, int(q * len(recent)))]
+                recent_lines.append(f'{self.name}_recent{_label_text(key + (("quantile", q),))} {value}')
+        return lines + recent_lines
+
+
+def counter(name, help_text):
+    return _register(Counter(name, help_text))
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help_text, buckets))
+
+
+def gauge_callback(fn):
+    """Register fn() -> [(name, help, value)] to be sampled on every render"""
+    _gauge_callbacks.append(fn)
+    return fn
+
+
+def _register(metric):
+    with _lock:
+        return _metrics.setdefault(metric.name, metric)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    with _lock:
+        metrics = list(_metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+    for fn in _gauge_callbacks:
+        for name, help_text, value in fn():
+            lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {value}'])
+    return '\n'.join(lines) + '\n'
+
+
+stage_seconds = histogram('designspace_stage_seconds', 'Duration of each generation pipeline stage')
+
+
+@contextmanager
+def span(stage, timings=None):
+    """Time the enclosed block as a pipeline stage.
+
+    The duration is also stored in timings[stage] when a dict is given.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage)
+        if timings is not None:
+            timings[stage] = elapsed
@@ -0,0 +1,250 @@
+"""Upload preprocessing in a pool of worker processes.
+
+Decoding, resizing and PNG encoding hold the GIL for most of their run,
+so threads can't spread them over cores. Preprocessor hands them to
+worker processes instead. The upload and the encoded PNG travel through
+shared memory blocks that both sides map, rather than being pickled
+through the pool's pipes. Only the block names and the small result
+tuple cross the pipe.
+
+Admission is bounded: at most workers + max_queued uploads are in the
+pool or waiting for it. A caller that can't get a slot within max_wait
+gets Overloaded, so a burst of uploads turns into 503s with a retry hint
+rather than an ever longer queue.
+"""
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+
+import imaging
+from limiter import Overloaded
+import metrics
+from metrics import span, stage_seconds
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest run in the average used for retry hints
+DURATION_SMOOTHING = 0.2
+
+preprocess_rejected_total = metrics.counter(
+    'designspace_preprocess_rejected_total', 'Uploads turned away because preprocessing was busy')
+
+
+def _attach(name):
+    """Map a block the parent created, leaving its cleanup to the parent"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block with the resource
+        # tracker, which workers share with the parent; the parent's unlink
+        # unregisters it again
+        return shared_memory.SharedMemory(name=name)
+
+
+def _prepare_shared(input_name, length, output_name, size, compress_level):
+    """Worker side: read the upload from one block and write the PNG into another.
+
+    Returns (PNG length, image hash, stage timings, PNG bytes if they
+    didn't fit in the output block, else None).
+    """
+    source = _attach(input_name)
+    try:
+        image_data = bytes(source.buf[:length])
+    finally:
+        source.close()
+
+    timings = {}
+    png, image_hash = imaging.prepare_image(image_data, size, compress_level, timings)
+
+    target = _attach(output_name)
+    try:
+        if len(png) > target.size:
+            return len(png), image_hash, timings, png
+        target.buf[:len(png)] = png
+    finally:
+        target.close()
+    return len(png), image_hash, timings, None
+
+
+@contextmanager
+def _main_module_hidden():
+    """Keep processes started inside the block from re-running the main script.
+
+    Spawned processes import the parent's __main__ before anything else.
+    Under `python app.py` that would start a second copy of the app, with
+    its migrations, reconciler and job threads, in every worker.
+    """
+    main = sys.modules['__main__']
+    sys.modules['__main__'] = types.ModuleType('__main__')
+    try:
+        yield
+    finally:
+        sys.modules['__main__'] = main
+
+
+def _exit_with_parent():
+    """Pool initializer: end the worker when the web app process goes away.
+
+    Workers otherwise wait on the pool's queue forever when the app is
+    killed without shutting the pool down.
+    """
+    parent = multiprocessing.parent_process()
+
+    def watch():
+        parent.join()
+        os._exit(0)
+
+    threading.Thread(target=watch, name='parent-watch', daemon=True).start()
+
+
+def _warm_up():
+    """Import the imaging stack in a fresh worker"""
+    return os.getpid()
+
+
+class Preprocessor:
+    """Runs imaging.prepare_image in worker processes with bounded admission.
+
+    workers=0 runs it on the calling thread instead, still behind the
+    same admission limit.
+    """
+
+    def __init__(self, workers, max_queued, max_wait, compress_level=imaging.PNG_COMPRESS_LEVEL):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self.compress_level = compress_level
+        self._slots = threading.BoundedSemaphore(max(1, workers) + max_queued)
+        self._lock = threading.Lock()
+        # Held while submitting, which is when the pool starts processes
+        self._submit_lock = threading.Lock()
+        self._pool = None
+        self._waiting = 0
+        self._in_flight = 0
+        self._rejected = 0
+        self._average_seconds = 1.0
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # spawn, not fork: the web app's threads and open connections
+                # must not be copied into the workers
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_exit_with_parent
+                )
+            return self._pool
+
+    def _submit(self, pool, fn, *args):
+        with self._submit_lock, _main_module_hidden():
+            return pool.submit(fn, *args)
+
+    def _discard_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def warm(self):
+        """Start the worker processes now rather than on the first upload"""
+        if self.workers:
+            pool = self._get_pool()
+            for future in [self._submit(pool, _warm_up) for _ in range(self.workers)]:
+                future.result()
+
+    def prepare(self, image_data, size=(1024, 1024), timings=None):
+        """Square PNG and image hash for an upload, as imaging.prepare_image.
+
+        Raises Overloaded when no slot frees up within max_wait, and
+        UploadTooLarge before queueing for an upload over the limits.
+        """
+        # Cheap header check, so oversized uploads are refused without a slot
+        imaging.open_upload(image_data)
+
+        with self._lock:
+            self._waiting += 1
+        try:
+            with span('preprocess_wait', timings):
+                admitted = self._slots.acquire(timeout=self.max_wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        if not admitted:
+            with self._lock:
+                self._rejected += 1
+                retry_after = self._average_seconds * (max(1, self.workers) + self.max_queued) / max(1, self.workers)
+            preprocess_rejected_total.inc()
+            raise Overloaded(max(1.0, retry_after), "Image processing is busy")
+
+        with self._lock:
+            self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            if self.workers:
+                result = self._prepare_in_pool(image_data, size, timings)
+            else:
+                result = imaging.prepare_image(image_data, size, self.compress_level, timings)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self._in_flight -= 1
+                self._average_seconds += DURATION_SMOOTHING * (elapsed - self._average_seconds)
+            self._slots.release()
+        return result
+
+    def _prepare_in_pool(self, image_data, size, timings):
+        source = shared_memory.SharedMemory(create=True, size=max(1, len(image_data)))
+        try:
+            target = shared_memory.SharedMemory(create=True, size=imaging.max_png_bytes(size))
+            try:
+                source.buf[:len(image_data)] = image_data
+                pool = self._get_pool()
+                try:
+                    length, image_hash, worker_timings, png = self._submit(
+                        pool, _prepare_shared, source.name, len(image_data), target.name, size, self.compress_level
+                    ).result()
+                except BrokenProcessPool:
+                    # A worker died (killed, or out of memory); start a fresh pool for the next upload
+                    logger.error("Preprocessing worker died; restarting the pool")
+                    self._discard_pool(pool)
+                    raise
+                if png is None:
+                    png = bytes(target.buf[:length])
+            finally:
+                target.close()
+                target.unlink()
+        finally:
+            source.close()
+            source.unlink()
+
+        # The workers' spans observe into their own registries, so record them here
+        for stage, seconds in worker_timings.items():
+            stage_seconds.observe(seconds, stage=stage)
+        if timings is not None:
+            timings.update(worker_timings)
+        return png, image_hash
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'slots': max(1, self.workers) + self.max_queued,
+                'inFlight': self._in_flight,
+                'waiting': self._waiting,
+                'rejected': self._rejected,
+                'compressLevel': self.compress_level,
+            }
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,336 @@
+"""Background reconciliation of the database with image storage.
+
+A pass runs in small batches with a pause between them, so no single
+write transaction holds the database for long:
+
+1. generations older than the retention period are deleted;
+2. generations whose original or generated image is gone are deleted;
+3. storage is listed, every file is recorded in ``stored_objects`` and
+   files no generation refers to are removed once past a grace period
+   (a new file is stored a moment before its row is written);
+4. if stored files exceed the disk quota, the least recently accessed
+   ones are evicted, with the generations that use them.
+
+Generations are the rows of every table in HISTORY_TABLES: the history
+of full renders and the previews kept apart from it.
+
+Accesses from /api/stored-image are buffered in memory and written in
+batches. In dry-run mode nothing is deleted and the report shows what
+would have been.
+
+Run a single pass from the command line with::
+
+    python reconcile.py --dry-run
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import db
+import metrics
+import storage
+import thumbnails
+
+logger = logging.getLogger(__name__)
+
+# Evict down to this share of the quota so eviction doesn't run on every pass
+QUOTA_LOW_WATERMARK = 0.9
+# Write buffered accesses at least this often between passes
+TOUCH_FLUSH_SECONDS = 30
+# Tables whose rows refer to stored files through original_path and generated_path
+HISTORY_TABLES = ('generated_images', 'preview_images')
+
+reclaimed_bytes = metrics.counter(
+    'designspace_storage_reclaimed_bytes_total', 'Bytes of stored images removed by the reconciler')
+
+
+class Reconciler:
+    def __init__(self, storage, batch_size=200, pause=0.2, interval=600, grace=3600,
+                 retention_days=0, max_bytes=0, dry_run=False):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.pause = pause
+        self.interval = interval
+        self.grace = grace
+        self.retention_days = retention_days
+        self.max_bytes = max_bytes
+        self.dry_run = dry_run
+        self.last_report = None
+
+        self._touched = {}
+        self._touch_lock = threading.Lock()
+        self._scanned = False
+
+    def touch(self, key):
+        """Note that key was just saved or served"""
+        with self._touch_lock:
+            self._touched[key] = time.time()
+
+    def flush_touches(self):
+        """Write buffered access times to stored_objects"""
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            db.execute_many(
+                'UPDATE stored_objects SET last_accessed = MAX(last_accessed, ?) WHERE key = ?',
+                [(accessed, key) for key, accessed in touched.items()]
+            )
+
+    def start(self):
+        """Run a pass now and then every interval seconds, in a daemon thread"""
+        thread = threading.Thread(target=self._loop, name='storage-reconciler', daemon=True)
+        thread.start()
+        return thread
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_pass()
+            except Exception:
+                logger.exception("Storage reconciliation failed")
+            next_pass = time.monotonic() + self.interval
+            while time.monotonic() < next_pass:
+                time.sleep(min(TOUCH_FLUSH_SECONDS, max(0.0, next_pass - time.monotonic())))
+                try:
+                    self.flush_touches()
+                except Exception:
+                    logger.exception("Writing image access times failed")
+
+    def run_pass(self):
+        """Reconcile once and return the report"""
+        started = time.time()
+        report = {
+            'dryRun': self.dry_run,
+            'startedAt': datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+            'expiredRows': 0,
+            'rowsScanned': 0,
+            'orphanRows': 0,
+            'filesScanned': 0,
+            'orphanFiles': 0,
+            'orphanBytes': 0,
+            'evictedFiles': 0,
+            'evictedBytes': 0,
+            'evictedRows': 0,
+        }
+        self.flush_touches()
+        self._expire_rows(report)
+        self._check_rows(report)
+        self._scan_storage(report, started)
+        self._enforce_quota(report)
+
+        report['storedObjects'], report['storedBytes'] = db.query_one(
+            'SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM stored_objects'
+        )
+        report['bytesReclaimed'] = report['orphanBytes'] + report['evictedBytes']
+        report['seconds'] = round(time.time() - started, 3)
+        self.last_report = report
+        if not self.dry_run:
+            reclaimed_bytes.inc(report['bytesReclaimed'])
+        logger.info(
+            "Reconciled storage%s: %d rows removed, %d files removed, %d bytes reclaimed",
+            " (dry run, nothing deleted)" if self.dry_run else "",
+            report['expiredRows'] + report['orphanRows'] + report['evictedRows'],
+            report['orphanFiles'] + report['evictedFiles'],
+            report['bytesReclaimed']
+        )
+        return report
+
+    def _pause(self):
+        self.flush_touches()
+        time.sleep(self.pause)
+
+    def _expire_rows(self, report):
+        """Delete generations older than the retention period"""
+        if not self.retention_days:
+            return
+        cutoff = (f'-{self.retention_days} days',)
+        for table in HISTORY_TABLES:
+            if self.dry_run:
+                report['expiredRows'] += db.query_one(
+                    f"SELECT COUNT(*) FROM {table} WHERE timestamp < datetime('now', ?)", cutoff
+                )[0]
+                continue
+            while True:
+                deleted = db.execute(f'''
+                    DELETE FROM {table} WHERE id IN (
+                        SELECT id FROM {table}
+                        WHERE timestamp < datetime('now', ?)
+                        LIMIT ?
+                    )
+                ''', cutoff + (self.batch_size,)).rowcount
+                report['expiredRows'] += deleted
+                if deleted < self.batch_size:
+                    break
+                self._pause()
+
+    def _check_rows(self, report):
+        """Delete generations whose images no longer exist"""
+        for table in HISTORY_TABLES:
+            self._check_table(table, report)
+
+    def _check_table(self, table, report):
+        last_id = 0
+        while True:
+            rows = db.query(
+                f'SELECT id, original_path, generated_path FROM {table} WHERE id > ? ORDER BY id LIMIT ?',
+                (last_id, self.batch_size)
+            )
+            if not rows:
+                return
+            last_id = rows[-1][0]
+
+            exists = {}
+            missing = []
+            for row_id, original_key, generated_key in rows:
+                for key in (original_key, generated_key):
+                    if key not in exists:
+                        try:
+                            exists[key] = self.storage.exists(key)
+                        except storage.InvalidKey:
+                            exists[key] = False
+                if not (exists[original_key] and exists[generated_key]):
+                    missing.append((row_id,))
+            report['rowsScanned'] += len(rows)
+            report['orphanRows'] += len(missing)
+            if missing and not self.dry_run:
+                logger.info("Removing %d generations with missing files", len(missing))
+                db.execute_many(f'DELETE FROM {table} WHERE id = ?', missing)
+            self._pause()
+
+    def _scan_storage(self, report, started):
+        """Record every stored file and remove the ones nothing refers to"""
+        batch = []
+        for item in self.storage.iter_objects():
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._scan_batch(batch, report)
+                batch = []
+                self._pause()
+        if batch:
+            self._scan_batch(batch, report)
+
+        # Whatever wasn't listed this time is gone from storage
+        db.execute('DELETE FROM stored_objects WHERE seen_at < ?', (started,))
+        self._scanned = True
+
+    def _scan_batch(self, batch, report):
+        now = time.time()
+        seen = []
+        for key, size, modified in batch:
+            report['filesScanned'] += 1
+            referenced = any(
+                db.query_one(f'SELECT 1 FROM {table} WHERE original_path = ? OR generated_path = ? LIMIT 1', (key, key))
+                for table in HISTORY_TABLES
+            )
+            if referenced or now - modified < self.grace or self._recently_used(key, now - self.grace):
+                # A file starts out as recently accessed as it is new
+                seen.append((key, size, modified, now))
+                continue
+            report['orphanFiles'] += 1
+            report['orphanBytes'] += size
+            if self.dry_run:
+                seen.append((key, size, modified, now))
+            else:
+                self._remove(key)
+
+        db.execute_many('''
+            INSERT INTO stored_objects (key, size_bytes, last_accessed, seen_at)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET size_bytes = excluded.size_bytes, seen_at = excluded.seen_at
+        ''', seen)
+
+    def _enforce_quota(self, report):
+        """Evict least recently accessed files until under the quota"""
+        # Until storage has been listed once the inventory is incomplete
+        if not self.max_bytes or not self._scanned:
+            return
+        total = db.query_one('SELECT COALESCE(SUM(size_bytes), 0) FROM stored_objects')[0]
+        if total <= self.max_bytes:
+            return
+
+        target = int(self.max_bytes * QUOTA_LOW_WATERMARK)
+        # Never evict a file that was just written or served
+        cutoff = time.time() - self.grace
+        after = (-1.0, '')
+        while total > target:
+            rows = db.query('''
+                SELECT key, size_bytes, last_accessed FROM stored_objects
+                WHERE last_accessed < ? AND (last_accessed, key) > (?, ?)
+                ORDER BY last_accessed, key
+                LIMIT ?
+            ''', (cutoff,) + after + (self.batch_size,))
+            if not rows:
+                logger.warning("Storage is over its quota but nothing is old enough to evict")
+                return
+            for key, size, _ in rows:
+                if total <= target:
+                    break
+                if self._recently_used(key, cutoff):
+                    continue
+                if not self.dry_run:
+                    for table in HISTORY_TABLES:
+                        report['evictedRows'] += db.execute(
+                            f'DELETE FROM {table} WHERE original_path = ? OR generated_path = ?', (key, key)
+                        ).rowcount
+                    self._remove(key)
+                total -= size
+                report['evictedFiles'] += 1
+                report['evictedBytes'] += size
+            after = (rows[-1][2], rows[-1][0])
+            self._pause()
+
+    def _recently_used(self, key, since):
+        """Whether key was saved or served since then, as far as we know.
+
+        The listing's modification times and the inventory can be older
+        than a save of the same content in the meantime.
+        """
+        with self._touch_lock:
+            if self._touched.get(key, 0) >= since:
+                return True
+        row = db.query_one('SELECT last_accessed FROM stored_objects WHERE key = ?', (key,))
+        return row is not None and row[0] >= since
+
+    def _remove(self, key):
+        """Delete a stored file and everything that points at it"""
+        self.storage.delete(key)
+        # A cached thumbnail is served without checking its source still exists
+        thumbnails.discard(key)
+        with db.transaction() as conn:
+            conn.execute('DELETE FROM stored_objects WHERE key = ?', (key,))
+            conn.execute('DELETE FROM generation_cache WHERE generated_filename = ?', (key,))
+
+
+def from_env(storage):
+    """Reconciler configured from RECONCILE_* and retention environment variables"""
+    return Reconciler(
+        storage,
+        batch_size=int(os.getenv('RECONCILE_BATCH_SIZE', 200)),
+        pause=float(os.getenv('RECONCILE_PAUSE', 0.2)),
+        interval=float(os.getenv('RECONCILE_INTERVAL', 600)),
+        grace=float(os.getenv('ORPHAN_GRACE_SECONDS', 3600)),
+        retention_days=int(os.getenv('RETENTION_DAYS', 0)),
+        max_bytes=int(os.getenv('STORAGE_MAX_BYTES', 0)),
+        dry_run=os.getenv('RECONCILE_DRY_RUN', '0') != '0'
+    )
+
+
+if __name__ == '__main__':
+    import argparse
+    import json
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Run one storage reconciliation pass')
+    parser.add_argument('--dry-run', action='store_true', help='report what would be removed without removing it')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
+    db.migrate()
+    reconciler = from_env(storage.from_env(''))
+    reconciler.dry_run = reconciler.dry_run or args.dry_run
+    reconciler.pause = 0
+    print(json.dumps(reconciler.run_pass(), indent=2))
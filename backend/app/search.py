@@ -0,0 +1,134 @@
+"""Full-text search and aggregate counts over the generation history.
+
+Prompts are indexed by the generated_images_fts table, and the
+generation_facets and generation_daily tables are kept up to date by
+triggers (see migration 4 in db.py). Counts that don't depend on the
+search text are read from those small tables rather than by grouping
+the history. Counts within a text search are grouped over the matching
+rows only.
+"""
+import re
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+
+import db
+
+# Words and numbers; everything else in the search box is ignored, so
+# user input can never be a malformed FTS5 query
+TERM = re.compile(r'\w+')
+MAX_TERMS = 16
+
+# Facet counts of recent searches, keyed by query and history version
+FACET_CACHE_SIZE = 256
+
+
+def match_expression(text):
+    """FTS5 query matching rows that contain every word of text, or None"""
+    terms = TERM.findall(text.lower())[:MAX_TERMS]
+    if not terms:
+        return None
+    # Quoted, so words like AND, OR, NEAR and NOT are plain terms
+    return ' '.join(f'"{term}"' for term in terms)
+
+
+def _filters(style, room_type, alias=''):
+    conditions, params = [], []
+    if style:
+        conditions.append(f'{alias}style = ?')
+        params.append(style)
+    if room_type:
+        conditions.append(f'{alias}room_type = ?')
+        params.append(room_type)
+    return conditions, params
+
+
+def search(expression, limit, before_id=None, style=None, room_type=None):
+    """Rows matching an FTS5 expression, newest first.
+
+    Returns up to limit + 1 rows of (id, original_path, generated_path,
+    style, room_type, timestamp, prompt, custom_prompt), so the caller
+    can tell whether there is another page. Ids increase with time, and
+    FTS5 walks its index in rowid order, so this stops after the first
+    page of matches instead of ranking all of them.
+    """
+    conditions, params = _filters(style, room_type, 'g.')
+    if before_id is not None:
+        conditions.append('f.rowid < ?')
+        params.append(before_id)
+    extra = ''.join(f' AND {condition}' for condition in conditions)
+    return db.query(f'''
+        SELECT g.id, g.original_path, g.generated_path, g.style, g.room_type, g.timestamp,
+               g.prompt, g.custom_prompt
+        FROM generated_images_fts f
+        JOIN generated_images g ON g.id = f.rowid
+        WHERE generated_images_fts MATCH ?{extra}
+        ORDER BY f.rowid DESC
+        LIMIT ?
+    ''', [expression] + params + [limit + 1])
+
+
+def facet_counts(expression=None):
+    """{(style, room_type): count} for all rows, or for rows matching expression"""
+    counts = {
+        (style, room_type): count
+        for style, room_type, count in db.query('SELECT style, room_type, count FROM generation_facets')
+    }
+    if expression is None:
+        return counts
+    # Any insert raises the last id and any delete lowers the total, so
+    # cached counts are never served for a history that has changed
+    version = (db.query_one('SELECT max(id) FROM generated_images')[0], sum(counts.values()))
+    return _matching_facet_counts(expression, version)
+
+
+@lru_cache(maxsize=FACET_CACHE_SIZE)
+def _matching_facet_counts(expression, version):
+    # Grouping looks up every matching row, so a word that is in most
+    # prompts costs far more than the page of results; the cache saves
+    # recounting as the client pages through them
+    rows = db.query('''
+        SELECT g.style, g.room_type, COUNT(*)
+        FROM generated_images_fts f
+        JOIN generated_images g ON g.id = f.rowid
+        WHERE generated_images_fts MATCH ?
+        GROUP BY g.style, g.room_type
+    ''', (expression,))
+    return {(style, room_type): count for style, room_type, count in rows}
+
+
+def facets(counts, style=None, room_type=None):
+    """Style and room type facets with the total that matches both filters.
+
+    Each facet counts rows that pass the other facet's filter, so the
+    client can show how many results picking a different value would give.
+    """
+    by_style, by_room_type, total = {}, {}, 0
+    for (row_style, row_room_type), count in counts.items():
+        if not room_type or row_room_type == room_type:
+            by_style[row_style] = by_style.get(row_style, 0) + count
+        if not style or row_style == style:
+            by_room_type[row_room_type] = by_room_type.get(row_room_type, 0) + count
+            if not room_type or row_room_type == room_type:
+                total += count
+    return total, {
+        'style': dict(sorted(by_style.items(), key=lambda item: (-item[1], item[0]))),
+        'roomType': dict(sorted(by_room_type.items(), key=lambda item: (-item[1], item[0]))),
+    }
+
+
+def daily_volume(days, today=None):
+    """Generations per UTC day for the last days days, oldest first, days without any included"""
+    # SQLite's CURRENT_TIMESTAMP, and so every stored day, is in UTC
+    today = today or datetime.now(timezone.utc).date()
+    first = today - timedelta(days=days - 1)
+    rows = db.query(
+        'SELECT day, count, custom_prompts FROM generation_daily WHERE day >= ? ORDER BY day',
+        (first.isoformat(),)
+    )
+    counts = {day: (count, custom_prompts) for day, count, custom_prompts in rows}
+    volume = []
+    for offset in range(days):
+        day = (first + timedelta(days=offset)).isoformat()
+        count, custom_prompts = counts.get(day, (0, 0))
+        volume.append({'date': day, 'count': count, 'customPrompts': custom_prompts})
+    return volume
@@ -0,0 +1,188 @@
+"""Perceptual hashes of uploads and a near-duplicate index over them.
+
+Each plain generation (no custom prompt, default mask) records a 64-bit
+difference hash (dHash) of the photo it was made from. Re-photographing
+the same room, re-encoding or lightly cropping it, or picking one of the
+sample rooms again changes only a few bits, so a small Hamming distance
+means "same room, same shot".
+
+Lookups use multi-index hashing: the hash is split into m chunks, and
+any hash within r bits of the query differs from it by at most r // m
+bits on at least one chunk (pigeonhole). Each chunk is looked up with
+every variant of the query's chunk that close, and only the hashes found
+that way are compared in full. m = r // 2 + 1 keeps the probe radius at
+one bit, with chunks wide enough that buckets stay small. There is one
+index per style/room type, since a match is only useful for the same
+combination.
+"""
+import itertools
+import logging
+import threading
+
+from PIL import Image
+
+import db
+
+logger = logging.getLogger(__name__)
+
+HASH_BITS = 64
+# dHash compares neighbouring pixels of a (HASH_WIDTH + 1) x HASH_HEIGHT thumbnail
+HASH_WIDTH = 8
+HASH_HEIGHT = 8
+
+
+def dhash(image):
+    """64-bit difference hash of a PIL image"""
+    small = image.convert('L').resize((HASH_WIDTH + 1, HASH_HEIGHT), Image.Resampling.BOX)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(HASH_HEIGHT):
+        offset = row * (HASH_WIDTH + 1)
+        for column in range(HASH_WIDTH):
+            value = (value << 1) | (pixels[offset + column] < pixels[offset + column + 1])
+    return value
+
+
+def to_db(value):
+    """Store an unsigned 64-bit hash in SQLite's signed INTEGER"""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+
+def from_db(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+
+class MultiIndexHash:
+    """Hamming-radius search over 64-bit hashes"""
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        chunks = max_distance // 2 + 1
+        probe_distance = max_distance // chunks
+        # (shift, mask, probes) of each chunk, spreading the bits as evenly
+        # as possible; probes are the XOR masks within probe_distance bits
+        self._chunks = []
+        start = 0
+        for i in range(chunks):
+            width = HASH_BITS // chunks + (1 if i < HASH_BITS % chunks else 0)
+            probes = [
+                sum(1 << bit for bit in bits)
+                for flipped in range(probe_distance + 1)
+                for bits in itertools.combinations(range(width), flipped)
+            ]
+            self._chunks.append((start, (1 << width) - 1, probes))
+            start += width
+        self._tables = [{} for _ in self._chunks]
+        self._items = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, value, item):
+        items = self._items.setdefault(value, [])
+        if item in items:
+            return
+        items.append(item)
+        if len(items) > 1:
+            return
+        for table, (shift, mask, _) in zip(self._tables, self._chunks):
+            table.setdefault((value >> shift) & mask, []).append(value)
+
+    def remove(self, value, item):
+        items = self._items.get(value)
+        if not items or item not in items:
+            return
+        items.remove(item)
+        if items:
+            return
+        del self._items[value]
+        for table, (shift, mask, _) in zip(self._tables, self._chunks):
+            bucket = table[(value >> shift) & mask]
+            bucket.remove(value)
+            if not bucket:
+                del table[(value >> shift) & mask]
+
+    def search(self, value):
+        """(distance, hash, item) for everything within max_distance bits, nearest first"""
+        found = {}
+        for table, (shift, mask, probes) in zip(self._tables, self._chunks):
+            chunk = (value >> shift) & mask
+            for probe in probes:
+                for candidate in table.get(chunk ^ probe, ()):
+                    if candidate not in found:
+                        found[candidate] = (candidate ^ value).bit_count()
+        return sorted(
+            (distance, candidate, item)
+            for candidate, distance in found.items() if distance <= self.max_distance
+            for item in self._items[candidate]
+        )
+
+
+class SimilarityIndex:
+    """Finds earlier generations of a near-identical photo.
+
+    Loaded from generated_images on first use and kept up to date as
+    generations are stored. Before each lookup, rows with an id past the
+    last one read are loaded too, so generations stored by other worker
+    processes are found. Rows deleted elsewhere (by the reconciler) are
+    dropped from the index when a lookup finds them gone.
+    """
+
+    def __init__(self, max_distance=8):
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._indexes = None
+        # Highest generated_images id read from the database
+        self._loaded_id = 0
+
+    def _index_for(self, style, room_type):
+        key = (style, room_type)
+        if key not in self._indexes:
+            self._indexes[key] = MultiIndexHash(self.max_distance)
+        return self._indexes[key]
+
+    def _load(self):
+        """Read rows added since the last call; the first call reads them all"""
+        first = self._indexes is None
+        if first:
+            self._indexes = {}
+        # A range scan of the primary key; ids are assigned in commit order
+        rows = db.query(
+            'SELECT id, style, room_type, image_hash FROM generated_images WHERE id > ? ORDER BY id',
+            (self._loaded_id,)
+        )
+        hashed = 0
+        for row_id, style, room_type, image_hash in rows:
+            if image_hash is not None:
+                self._index_for(style, room_type).add(from_db(image_hash), row_id)
+                hashed += 1
+        if rows:
+            self._loaded_id = rows[-1][0]
+        if first:
+            logger.info("Loaded %d image hashes into the similarity index", hashed)
+
+    def add(self, row_id, image_hash, style, room_type):
+        with self._lock:
+            # Rows stored before the first lookup are picked up by _load;
+            # a row _load reads again later isn't added twice
+            if self._indexes is not None:
+                self._index_for(style, room_type).add(image_hash, row_id)
+
+    def find(self, image_hash, style, room_type):
+        """Closest earlier generation as (row id, generated key, distance), or None"""
+        with self._lock:
+            self._load()
+            matches = self._index_for(style, room_type).search(image_hash)
+        for distance, candidate, row_id in matches:
+            row = db.query_one('SELECT generated_path FROM generated_images WHERE id = ?', (row_id,))
+            if row is not None:
+                return row_id, row[0], distance
+            with self._lock:
+                self._index_for(style, room_type).remove(candidate, row_id)
+        return None
+
+    def stats(self):
+        with self._lock:
+            if self._indexes is None:
+                return {'loaded': False, 'hashes': 0}
+            return {'loaded': True, 'hashes': sum(len(index) for index in self._indexes.values())}
@@ -0,0 +1,310 @@
+"""Storage for uploaded and generated images.
+
+Files are named by the SHA-256 of their contents and fanned out over two
+levels of subdirectories (``ab/cd/abcd....png``), so identical uploads
+are kept once and no single directory grows without bound. The storage
+key is that relative name; it is what the database records and what
+/api/stored-image serves. Files from before content addressing keep
+their flat names (``original_20240101_120000.jpg``) and still resolve.
+
+STORAGE_BACKEND selects the driver: ``local`` (the default) keeps files
+under STORAGE_DIR, ``s3`` puts them in an S3-compatible bucket. boto3 is
+only needed, and only imported, for the latter.
+"""
+import hashlib
+import io
+import logging
+import os
+import re
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DIR = Path(os.path.abspath(os.path.dirname(__file__))) / 'stored_images'
+
+# Content keys, plus the flat names written before them
+KEY_PATTERN = re.compile(r'^(?:[0-9a-f]{2}/[0-9a-f]{2}/)?[\w-]+\.[a-z0-9]+$')
+
+# Uploads larger than this spill from memory to a temp file before going to S3
+S3_SPOOL_BYTES = 8 * 1024 * 1024
+# Lifetime of the signed URLs stored images redirect to on S3
+S3_URL_EXPIRY = 3600
+
+
+class InvalidKey(ValueError):
+    """Raised for a key that could escape the storage root"""
+
+
+def validate_key(key):
+    if not KEY_PATTERN.match(key):
+        raise InvalidKey(f"Invalid storage key: {key}")
+    return key
+
+
+def key_from_path(stored):
+    """Storage key for a path recorded in the database.
+
+    Older rows hold absolute paths into the flat storage directory; the
+    file name is their key.
+    """
+    if os.path.isabs(stored):
+        return Path(stored).name
+    return stored
+
+
+def content_key(digest, suffix):
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{suffix}"
+
+
+class _HashingWriter:
+    """File wrapper that hashes and counts everything written through it"""
+
+    def __init__(self, f):
+        self._f = f
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+    def hexdigest(self):
+        return self._hash.hexdigest()
+
+
+class LocalStorage:
+    def __init__(self, root, public_base_url):
+        self.root = Path(root)
+        self.public_base_url = public_base_url.rstrip('/')
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def __str__(self):
+        return str(self.root)
+
+    def save(self, write, suffix):
+        """Call write(file) and store what it wrote under its content key.
+
+        The data goes to a temp file that is renamed into place once
+        complete; if the same content is already stored, the copy is
+        dropped and the stored file's modification time refreshed.
+        Returns the key.
+        """
+        fd, temp_path = tempfile.mkstemp(dir=self.root, prefix='.partial-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                writer = _HashingWriter(f)
+                write(writer)
+            key = content_key(writer.hexdigest(), suffix)
+            path = self.root / key
+            try:
+                # The caller is about to refer to the stored copy; make it as new
+                # as this one, so the reconciler doesn't take it for an old orphan
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            else:
+                os.unlink(temp_path)
+                logger.debug("Already stored as %s", key)
+                return key
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # mkstemp creates the file owner-only; match a normal open()
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+            return key
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+
+    def save_bytes(self, data, suffix):
+        return self.save(lambda f: f.write(data), suffix)
+
+    def local_path(self, key):
+        """Path of key on this machine"""
+        return self.root / validate_key(key)
+
+    def open(self, key):
+        """Binary file object for key; raises FileNotFoundError"""
+        return open(self.local_path(key), 'rb')
+
+    def exists(self, key):
+        return self.local_path(key).exists()
+
+    def size(self, key):
+        return self.local_path(key).stat().st_size
+
+    def delete(self, key):
+        try:
+            self.local_path(key).unlink()
+        except FileNotFoundError:
+            pass
+
+    def url(self, key):
+        """Public URL of key, served by /api/stored-image"""
+        return f"{self.public_base_url}/api/stored-image/{key}"
+
+    def iter_objects(self):
+        """Yield (key, size in bytes, modification time) for every stored file"""
+        for directory, subdirectories, filenames in os.walk(self.root):
+            # Skip in-progress writes and anything else hidden
+            subdirectories[:] = [d for d in subdirectories if not d.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                if KEY_PATTERN.match(key):
+                    yield key, stat.st_size, stat.st_mtime
+
+
+class S3Storage:
+    def __init__(self, bucket, public_base_url, prefix='', endpoint_url=None, region=None, direct_url=None):
+        # Optional dependency, only needed when images live in a bucket
+        import boto3
+        from botocore.config import Config
+        from botocore.exceptions import ClientError
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.public_base_url = public_base_url.rstrip('/')
+        self.direct_base_url = direct_url.rstrip('/') if direct_url else None
+        # Stand-ins like MinIO don't do virtual-hosted buckets
+        config = Config(s3={'addressing_style': 'path'}) if endpoint_url else None
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region, config=config)
+        self._client_error = ClientError
+
+    def __str__(self):
+        return f"s3://{self.bucket}/{self.prefix}"
+
+    def save(self, write, suffix):
+        """Same contract as LocalStorage.save; the object is written in one PUT"""
+        with tempfile.SpooledTemporaryFile(max_size=S3_SPOOL_BYTES) as f:
+            writer = _HashingWriter(f)
+            write(writer)
+            key = content_key(writer.hexdigest(), suffix)
+            if self._refresh(key, suffix):
+                logger.debug("Already stored as %s", key)
+                return key
+            f.seek(0)
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.prefix + key,
+                Body=f,
+                ContentLength=writer.size,
+                ContentType=_content_type(suffix),
+                CacheControl='public, max-age=31536000, immutable'
+            )
+        return key
+
+    def save_bytes(self, data, suffix):
+        return self.save(lambda f: f.write(data), suffix)
+
+    def local_path(self, key):
+        """Objects have no local path; callers fall back to open() or direct_url()"""
+        validate_key(key)
+        return None
+
+    def open(self, key):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + validate_key(key))
+        except self._client_error as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(key) from e
+            raise
+        with response['Body'] as body:
+            return io.BytesIO(body.read())
+
+    def exists(self, key):
+        try:
+            self._head(key)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def size(self, key):
+        return self._head(key)['ContentLength']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + validate_key(key))
+
+    def url(self, key):
+        """Public URL of key, served (as a redirect) by /api/stored-image"""
+        return f"{self.public_base_url}/api/stored-image/{key}"
+
+    def iter_objects(self):
+        """Yield (key, size in bytes, modification time) for every stored object"""
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get('Contents', []):
+                key = item['Key'][len(self.prefix):]
+                if KEY_PATTERN.match(key):
+                    yield key, item['Size'], item['LastModified'].timestamp()
+
+    def direct_url(self, key):
+        """URL the object can be fetched from without going through the app"""
+        if self.direct_base_url:
+            return f"{self.direct_base_url}/{self.prefix}{key}"
+        return self.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': self.bucket, 'Key': self.prefix + validate_key(key)},
+            ExpiresIn=S3_URL_EXPIRY
+        )
+
+    def _refresh(self, key, suffix):
+        """Copy an existing object onto itself so its LastModified is now.
+
+        Plays the part of LocalStorage's utime for content saved again, in
+        the one request a HEAD would take. Returns False if it's missing.
+        """
+        try:
+            self.client.copy_object(
+                Bucket=self.bucket,
+                Key=self.prefix + key,
+                CopySource={'Bucket': self.bucket, 'Key': self.prefix + key},
+                MetadataDirective='REPLACE',
+                ContentType=_content_type(suffix),
+                CacheControl='public, max-age=31536000, immutable'
+            )
+        except self._client_error as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return False
+            raise
+        return True
+
+    def _head(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.prefix + validate_key(key))
+        except self._client_error as e:
+            if e.response['Error']['Code'] in ('NoSuchKey', '404'):
+                raise FileNotFoundError(key) from e
+            raise
+
+
+def _content_type(suffix):
+    return {'.png': 'image/png', '.webp': 'image/webp', '.gif': 'image/gif'}.get(suffix, 'image/jpeg')
+
+
+def from_env(public_base_url):
+    """Build the driver selected by STORAGE_BACKEND"""
+    backend = os.getenv('STORAGE_BACKEND', 'local')
+    if backend == 'local':
+        return LocalStorage(os.getenv('STORAGE_DIR', DEFAULT_DIR), public_base_url)
+    if backend == 's3':
+        bucket = os.getenv('S3_BUCKET')
+        if not bucket:
+            raise ValueError("S3_BUCKET must be set when STORAGE_BACKEND is 's3'")
+        return S3Storage(
+            bucket,
+            public_base_url,
+            prefix=os.getenv('S3_PREFIX', ''),
+            endpoint_url=os.getenv('S3_ENDPOINT_URL') or None,
+            region=os.getenv('S3_REGION') or None,
+            direct_url=os.getenv('S3_PUBLIC_URL') or None
+        )
+    raise ValueError("STORAGE_BACKEND must be 'local' or 's3'")
@@ -0,0 +1,140 @@
+"""On-demand resized copies of stored images.
+
+Thumbnails are generated on first request at one of a few fixed widths,
+kept on disk and evicted least-recently-used once the directory grows
+past its size budget.
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_DIR = Path(os.getenv(
+    'THUMBNAIL_DIR',
+    Path(os.path.abspath(os.path.dirname(__file__))) / 'thumbnails'
+))
+THUMBNAIL_MAX_BYTES = int(os.getenv('THUMBNAIL_MAX_BYTES', 256 * 1024 * 1024))
+
+# Requested widths snap up to one of these so the cache stays small
+WIDTHS = (128, 256, 384, 512, 768)
+FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+QUALITY = 80
+
+# Refresh a thumbnail's mtime (its LRU position) at most this often
+TOUCH_INTERVAL = 3600
+
+THUMBNAIL_DIR.mkdir(parents=True, exist_ok=True)
+
+_lock = threading.Lock()
+_total_bytes = None
+
+
+def snap_width(width):
+    """Smallest supported width that is at least width"""
+    for candidate in WIDTHS:
+        if candidate >= width:
+            return candidate
+    return WIDTHS[-1]
+
+
+def get_thumbnail(name, width, fmt, load):
+    """Return the path of image name resized to width in fmt, creating it if needed.
+
+    load() opens the source image as a binary file and is only called
+    when the thumbnail has to be rendered; its FileNotFoundError for a
+    missing image propagates.
+    """
+    width = snap_width(width)
+    path = THUMBNAIL_DIR / f"{Path(name).stem}_{width}.{fmt}"
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        pass
+    else:
+        if time.time() - stat.st_mtime > TOUCH_INTERVAL:
+            os.utime(path)
+        return path
+
+    size = _render(load, path, width, fmt)
+    _account(size)
+    return path
+
+
+def discard(name):
+    """Delete every thumbnail of image name, once the image itself is gone"""
+    global _total_bytes
+    removed = 0
+    for path in THUMBNAIL_DIR.glob(f"{Path(name).stem}_*"):
+        try:
+            size = path.stat().st_size
+            path.unlink()
+        except FileNotFoundError:
+            continue
+        removed += size
+    if removed:
+        with _lock:
+            if _total_bytes is not None:
+                _total_bytes -= removed
+
+
+def _render(load, path, width, fmt):
+    with load() as source, Image.open(source) as image:
+        # Let JPEG decode at a reduced scale instead of full resolution
+        image.draft('RGB', (width, width))
+        # Thumbnails carry no EXIF, so apply the orientation to the pixels
+        ImageOps.exif_transpose(image, in_place=True)
+        image.thumbnail((width, width * 4), Image.Resampling.LANCZOS)
+        if fmt == 'jpeg' and image.mode != 'RGB':
+            image = image.convert('RGB')
+
+        fd, temp_path = tempfile.mkstemp(dir=THUMBNAIL_DIR, prefix='.partial-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, format=FORMATS[fmt], quality=QUALITY)
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+    return path.stat().st_size
+
+
+def _account(size):
+    """Add a new thumbnail's size to the total and evict if over budget"""
+    global _total_bytes
+    with _lock:
+        if _total_bytes is None:
+            _total_bytes = sum(entry.stat().st_size for entry in os.scandir(THUMBNAIL_DIR) if entry.is_file())
+        else:
+            _total_bytes += size
+        if _total_bytes > THUMBNAIL_MAX_BYTES:
+            _total_bytes = _evict(int(THUMBNAIL_MAX_BYTES * 0.9))
+
+
+def _evict(target_bytes):
+    """Delete least recently used thumbnails until at most target_bytes remain"""
+    entries = []
+    for entry in os.scandir(THUMBNAIL_DIR):
+        if entry.is_file() and not entry.name.startswith('.partial-'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= target_bytes:
+            break
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    logger.info("Evicted %d thumbnails, %d bytes remain", removed, total)
+    return total
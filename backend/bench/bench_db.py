@@ -0,0 +1,134 @@
+"""Micro-benchmark of the SQLite access layer.
+
+Compares the old pattern (a fresh sqlite3.connect per call, rollback
+journal, one commit per insert) with the pooled WAL connections in
+app/db.py, single-threaded and across several threads:
+
+    python bench/bench_db.py --rows 20000 --threads 4 --json results.json
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import db  # noqa: E402
+
+INSERT_SQL = '''
+    INSERT INTO generated_images (original_path, generated_path, style, room_type)
+    VALUES (?, ?, ?, ?)
+'''
+PAGE_SQL = '''
+    SELECT id, original_path, generated_path, style, room_type, timestamp
+    FROM generated_images
+    WHERE style = ?
+    ORDER BY timestamp DESC, id DESC
+    LIMIT 50
+'''
+STYLES = ['modern minimalist', 'luxury classic', 'scandinavian', 'industrial', 'bohemian', 'contemporary']
+
+
+def row(i):
+    return (f'/stored/original_{i}.jpg', f'/stored/generated_{i}.jpg', STYLES[i % len(STYLES)], 'living room')
+
+
+def naive_insert(path, i):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(INSERT_SQL, row(i))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def naive_read(path, i):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(PAGE_SQL, (STYLES[i % len(STYLES)],)).fetchall()
+    finally:
+        conn.close()
+
+
+def pooled_insert(path, i):
+    db.execute(INSERT_SQL, row(i))
+
+
+def pooled_read(path, i):
+    db.query(PAGE_SQL, (STYLES[i % len(STYLES)],))
+
+
+def run(fn, path, count, threads):
+    """Run fn count times spread over threads and return operations per second"""
+    per_thread = count // threads
+
+    def worker(offset):
+        for i in range(offset, offset + per_thread):
+            fn(path, i)
+        db.close_connection()
+
+    workers = [threading.Thread(target=worker, args=(t * per_thread,)) for t in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return per_thread * threads / (time.perf_counter() - start)
+
+
+def fresh_database(directory, name, wal):
+    path = os.path.join(directory, name)
+    db.DB_PATH = path
+    db.migrate()
+    if not wal:
+        db.execute('PRAGMA journal_mode = DELETE')
+    db.close_connection()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite access layer micro-benchmark')
+    parser.add_argument('--rows', type=int, default=5000, help='inserts per run, and rows to read from')
+    parser.add_argument('--reads', type=int, default=5000)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for threads in (1, args.threads):
+            naive_path = fresh_database(directory, f'naive_{threads}.db', wal=False)
+            pooled_path = fresh_database(directory, f'pooled_{threads}.db', wal=True)
+            db.DB_PATH = pooled_path
+
+            results[f'threads={threads}'] = {
+                'naive_inserts_per_sec': run(naive_insert, naive_path, args.rows, threads),
+                'pooled_inserts_per_sec': run(pooled_insert, pooled_path, args.rows, threads),
+                'naive_reads_per_sec': run(naive_read, naive_path, args.reads, threads),
+                'pooled_reads_per_sec': run(pooled_read, pooled_path, args.reads, threads),
+            }
+
+        # Batched insert of the same number of rows in one transaction
+        db.DB_PATH = fresh_database(directory, 'batched.db', wal=True)
+        start = time.perf_counter()
+        db.execute_many(INSERT_SQL, [row(i) for i in range(args.rows)])
+        results['batched_inserts_per_sec'] = args.rows / (time.perf_counter() - start)
+        db.close_connection()
+
+    for name, value in results.items():
+        if isinstance(value, dict):
+            for metric, rate in value.items():
+                print(f"{name:>10} {metric:<26} {rate:>12,.0f}")
+        else:
+            print(f"{'':>10} {name:<26} {value:>12,.0f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+"""Throughput and peak memory of streaming ZIP exports.
+
+Fills a throwaway store with --generations generations. Every
+--variants of them share one original, as the variants of a batch do.
+Then it reads export.stream_archive end to end, as /api/generations/export
+sends it, for the whole history with a JSON manifest and for the
+generated images only with a CSV manifest. One full export is written to
+disk and checked with zipfile (CRCs, entry count, manifest rows):
+
+    python bench/bench_export.py --generations 3000 --json export.json
+
+The stored files are random bytes behind a JPEG or PNG signature. They
+cost nothing to make and compress no better than real photos, and the
+export never decodes them. Peak RSS is the rise in the process's
+high-water mark over the export (Linux only). --buffered also builds
+the same archive in memory, the way a non-streaming export would.
+Files are read from the page cache after the first pass.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, '..', 'app')
+STYLES = ['modern minimalist', 'luxury classic', 'scandinavian', 'industrial', 'bohemian', 'contemporary']
+JPEG_SIGNATURE = b'\xff\xd8\xff\xe0'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def status(field):
+    """Field of /proc/self/status in MB"""
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field + ':')) / 1024
+
+
+def reset_peak():
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    return status('VmRSS')
+
+
+def measure(name, run):
+    """Run, timing it and recording how far it raises peak RSS"""
+    baseline = reset_peak()
+    start = time.perf_counter()
+    size, chunks, largest = run()
+    seconds = time.perf_counter() - start
+    result = {
+        'bytes': size, 'seconds': seconds, 'mb_per_second': size / 1e6 / seconds,
+        'chunks': chunks, 'largest_chunk_kb': largest / 1024, 'peak_rss_mb': status('VmHWM') - baseline,
+    }
+    print(f"{name:<24} {size / 1e6:8.0f} MB in {seconds:5.1f}s  {result['mb_per_second']:7.0f} MB/s  "
+          f"peak RSS +{result['peak_rss_mb']:6.1f} MB  largest chunk {result['largest_chunk_kb']:5.0f} KB")
+    return result
+
+
+def consume(stream, output=None):
+    size = chunks = largest = 0
+    for data in stream:
+        size += len(data)
+        chunks += 1
+        largest = max(largest, len(data))
+        if output is not None:
+            output.write(data)
+    return size, chunks, largest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Streaming export benchmark')
+    parser.add_argument('--generations', type=int, default=2000)
+    parser.add_argument('--variants', type=int, default=3, help='generations per original')
+    parser.add_argument('--original-kb', type=int, default=300)
+    parser.add_argument('--generated-kb', type=int, default=900)
+    parser.add_argument('--buffered', action='store_true', help='also build the archive in memory')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-export-')
+    os.environ.update(
+        DATABASE_PATH=os.path.join(workdir, 'bench.db'),
+        STORAGE_DIR=os.path.join(workdir, 'stored_images'),
+        THUMBNAIL_DIR=os.path.join(workdir, 'thumbnails'),
+        OPENAI_API_KEY='bench',
+        PREPROCESS_WORKERS='0',
+        LOG_LEVEL='WARNING',
+    )
+    sys.path.insert(0, APP_DIR)
+    import app  # noqa: E402
+    import db  # noqa: E402
+    import export  # noqa: E402
+
+    try:
+        rng = random.Random(args.seed)
+        room_types = sorted(set(app.ROOM_TYPE_MAPPING.values()))
+        start = time.perf_counter()
+        rows, original = [], None
+        for i in range(args.generations):
+            if i % args.variants == 0:
+                original = app.image_store.save_bytes(
+                    JPEG_SIGNATURE + rng.randbytes(args.original_kb * 1024), '.jpg')
+            generated = app.image_store.save_bytes(PNG_SIGNATURE + rng.randbytes(args.generated_kb * 1024), '.png')
+            style, room_type = rng.choice(STYLES), rng.choice(room_types)
+            rows.append((original, generated, style, room_type, app.build_prompt(style, room_type, '')))
+        db.execute_many('''
+            INSERT INTO generated_images (original_path, generated_path, style, room_type, prompt)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+        originals = -(-args.generations // args.variants)
+        store_mb = (originals * args.original_kb + args.generations * args.generated_kb) / 1024
+        print(f"{args.generations:,} generations, {originals:,} originals, {store_mb:,.0f} MB stored "
+              f"in {time.perf_counter() - start:.1f}s")
+
+        results = {'config': vars(args), 'store_mb': store_mb, 'exports': {}}
+        runs = {
+            'all, json manifest': {},
+            'generated, csv manifest': {'include': ('generated',), 'manifest': 'csv'},
+        }
+        for name, options in runs.items():
+            results['exports'][name] = measure(
+                name, lambda: consume(export.stream_archive(app.image_store, **options)))
+
+        path = os.path.join(workdir, 'export.zip')
+        with open(path, 'wb') as output:
+            results['exports']['all, written to disk'] = measure(
+                'all, written to disk', lambda: consume(export.stream_archive(app.image_store), output))
+        with zipfile.ZipFile(path) as archive:
+            bad = archive.testzip()
+            entries = len(archive.namelist())
+            manifest = json.loads(archive.read('manifest.json'))
+        if bad is not None or entries != originals + args.generations + 1 or len(manifest) != args.generations:
+            sys.exit(f"export is wrong: first bad entry {bad}, {entries} entries, {len(manifest)} manifest rows")
+        print(f"verified {entries:,} entries, {len(manifest):,} manifest rows")
+
+        if args.buffered:
+            def buffered():
+                buffer = io.BytesIO()
+                with zipfile.ZipFile(buffer, 'w') as archive:
+                    for original_key, generated_key, *_ in rows:
+                        for folder, key in (('originals', original_key), ('generated', generated_key)):
+                            name = f'{folder}/{os.path.basename(key)}'
+                            if name not in archive.NameToInfo:
+                                archive.write(app.image_store.local_path(key), name)
+                data = buffer.getvalue()
+                return len(data), 1, len(data)
+            results['exports']['all, buffered in memory'] = measure('all, buffered in memory', buffered)
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
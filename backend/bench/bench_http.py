@@ -0,0 +1,330 @@
+"""End-to-end benchmark of the backend against a local images API.
+
+Starts fake_openai.py and the Flask app as subprocesses, on a throwaway
+database and storage directory, then drives the HTTP endpoints with the
+room fixtures in frontend/public/rooms. Reports throughput and latency
+percentiles per endpoint, the server's own stage percentiles from
+/metrics, in-process micro-benchmarks of prepare_image_for_api (at
+full size and each preview size) and create_mask, and the peak memory
+preparing each upload adds to a process:
+
+    python bench/bench_http.py --latency-ms 500 --requests 40 --json http.json
+
+The generation cache is off unless --cache is given, so every
+generate-designs request pays for a (fake) upstream call. --preview 256
+or 512 generates previews instead of full-size designs.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BACKEND = os.path.join(HERE, '..')
+APP_DIR = os.path.join(BACKEND, 'app')
+ROOMS = os.path.join(BACKEND, '..', 'frontend', 'public', 'rooms')
+STYLES = ['modern minimalist', 'luxury classic', 'scandinavian', 'industrial', 'bohemian', 'contemporary']
+ROOM_TYPES = ['living room', 'bedroom', 'kitchen']
+PERCENTILES = (50, 90, 95, 99)
+
+# Run in a fresh interpreter per fixture, so one photo's peak doesn't hide the
+# next. Linux only: ru_maxrss would carry over the parent's peak through fork,
+# so the high-water mark is read from /proc and reset once app is imported.
+PEAK_RSS_SCRIPT = """
+import sys
+import app
+
+def status(field):
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith(field + ':'))
+
+with open(sys.argv[1], 'rb') as f:
+    image_data = f.read()
+with open('/proc/self/clear_refs', 'w') as f:
+    f.write('5')
+baseline = status('VmRSS')
+app.prepare_generation(image_data)
+print(status('VmHWM') - baseline)
+"""
+
+STAGE_QUANTILE = re.compile(r'^designspace_stage_seconds_recent\{stage="([^"]+)",quantile="([^"]+)"\} (\S+)$')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode}")
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(samples, elapsed):
+    """Throughput and latency percentiles (ms) for a list of (seconds, status)"""
+    latencies = sorted(seconds * 1000 for seconds, _ in samples)
+    errors = sum(1 for _, status in samples if status >= 400)
+    summary = {
+        'requests': len(samples),
+        'errors': errors,
+        'throughput_rps': len(samples) / elapsed if elapsed else None,
+        'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+        'max_ms': latencies[-1] if latencies else None,
+    }
+    for p in PERCENTILES:
+        summary[f'p{p}_ms'] = percentile(latencies, p)
+    return summary
+
+
+def run_load(call, count, concurrency):
+    """Run call(i) count times on concurrency threads; returns (summary, results)"""
+    def timed(i):
+        start = time.perf_counter()
+        status, result = call(i)
+        return time.perf_counter() - start, status, result
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(timed, range(count)))
+    elapsed = time.perf_counter() - start
+    return summarize([(seconds, status) for seconds, status, _ in outcomes], elapsed), [r for _, _, r in outcomes]
+
+
+def bench_endpoints(base_url, fixtures, args):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency)
+    session.mount('http://', adapter)
+    results = {}
+
+    def generate(i):
+        name, data = fixtures[i % len(fixtures)]
+        response = session.post(f'{base_url}/api/generate-designs', files={'image': (name, data, 'image/jpeg')}, data={
+            'style': STYLES[i % len(STYLES)],
+            'roomType': ROOM_TYPES[i % len(ROOM_TYPES)],
+            'preview': args.preview or '',
+        })
+        stored = response.json().get('storedImage') if response.ok else None
+        return response.status_code, stored
+
+    results['generate-designs'], stored = run_load(generate, args.requests, args.concurrency)
+    filenames = [url.split('/api/stored-image/', 1)[1] for url in stored if url]
+
+    def generations(i):
+        params = {'limit': 50}
+        if i % 2:
+            params['style'] = STYLES[i % len(STYLES)]
+        response = session.get(f'{base_url}/api/generations', params=params)
+        return response.status_code, None
+
+    results['generations'], _ = run_load(generations, args.read_requests, args.concurrency)
+
+    if filenames:
+        def stored_image(i):
+            response = session.get(f'{base_url}/api/stored-image/{filenames[i % len(filenames)]}')
+            response.content  # read the whole body
+            return response.status_code, None
+
+        def thumbnail(i):
+            response = session.get(f'{base_url}/api/stored-image/{filenames[i % len(filenames)]}',
+                                   params={'w': 384}, headers={'Accept': 'image/webp'})
+            response.content  # read the whole body
+            return response.status_code, None
+
+        results['stored-image'], _ = run_load(stored_image, args.read_requests, args.concurrency)
+        results['stored-image?w=384'], _ = run_load(thumbnail, args.read_requests, args.concurrency)
+    return results
+
+
+def scrape_stages(base_url):
+    """Server-side stage quantiles (ms) from /metrics"""
+    stages = {}
+    for line in requests.get(f'{base_url}/metrics').text.splitlines():
+        match = STAGE_QUANTILE.match(line)
+        if match:
+            stage, quantile, value = match.groups()
+            stages.setdefault(stage, {})[f'p{int(float(quantile) * 100)}_ms'] = float(value) * 1000
+    return stages
+
+
+def bench_micro(fixtures, repeat):
+    """In-process timings of the preprocessing helpers (ms per call)"""
+    os.environ.setdefault('OPENAI_API_KEY', 'bench')
+    sys.path.insert(0, APP_DIR)
+    import app
+    # Keep worker start-up out of the first sample
+    app.preprocessor.warm()
+
+    def timed(fn):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        return {'mean_ms': sum(samples) / len(samples), 'p50_ms': percentile(samples, 50), 'min_ms': samples[0]}
+
+    results = {'prepare_image_for_api': {}, 'create_mask': {}, 'prepare_by_size': {}}
+    for name, data in fixtures:
+        results['prepare_image_for_api'][name] = timed(lambda: app.prepare_image_for_api(data))
+    for strategy in ('border', 'full'):
+        results['create_mask'][strategy] = timed(lambda: app.create_mask(strategy=strategy))
+    # Preview tiers against the full size, on the first fixture
+    data = fixtures[0][1]
+    for size in app.PREVIEW_SIZES + (app.FULL_SIZE,):
+        results['prepare_by_size'][size] = {
+            **timed(lambda: app.prepare_image_for_api(data, (size, size))),
+            'png_bytes': len(app.prepare_image_for_api(data, (size, size))),
+        }
+    return results
+
+
+def bench_peak_memory(paths, env):
+    """Peak RSS (MB) that preparing one upload adds to a process"""
+    results = {}
+    # Preprocess in-process, so the decode's peak is in the process being measured
+    env = dict(env, PREPROCESS_WORKERS='0')
+    for path in paths:
+        output = subprocess.run([sys.executable, '-c', PEAK_RSS_SCRIPT, path], cwd=APP_DIR, env=env,
+                                capture_output=True, text=True, check=True).stdout
+        # /proc reports kilobytes
+        results[os.path.basename(path)] = int(output.split()[-1]) / 1024
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end backend benchmark')
+    parser.add_argument('--latency-ms', type=float, default=500, help='fake upstream latency per edit')
+    parser.add_argument('--requests', type=int, default=24, help='generate-designs requests')
+    parser.add_argument('--read-requests', type=int, default=200, help='requests for each read endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--micro-repeat', type=int, default=5, help='calls per micro-benchmark')
+    parser.add_argument('--response-format', choices=['url', 'b64_json'], default='url')
+    parser.add_argument('--cache', action='store_true', help='leave the generation cache on')
+    parser.add_argument('--preview', type=int, choices=[256, 512], help='generate previews of this size')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    fixtures = []
+    paths = sorted(glob.glob(os.path.join(ROOMS, 'room*.jpg')))
+    for path in paths:
+        with open(path, 'rb') as f:
+            fixtures.append((os.path.basename(path), f.read()))
+    if not fixtures:
+        parser.error(f"no fixtures found in {ROOMS}")
+
+    workdir = tempfile.mkdtemp(prefix='bench-http-')
+    fake_port, app_port = free_port(), free_port()
+    base_url = f'http://127.0.0.1:{app_port}'
+    env = dict(
+        os.environ,
+        OPENAI_API_KEY='bench',
+        OPENAI_BASE_URL=f'http://127.0.0.1:{fake_port}/v1',
+        OPENAI_RESPONSE_FORMAT=args.response_format,
+        DATABASE_PATH=os.path.join(workdir, 'bench.db'),
+        STORAGE_DIR=os.path.join(workdir, 'stored_images'),
+        THUMBNAIL_DIR=os.path.join(workdir, 'thumbnails'),
+        GENERATION_CACHE='1' if args.cache else '0',
+        # Let the fake upstream, not the admission controller, set the pace
+        UPSTREAM_RATE='1000',
+        UPSTREAM_BURST='1000',
+        UPSTREAM_CONCURRENCY=str(args.concurrency),
+        LOG_LEVEL='WARNING',
+    )
+    processes = []
+    try:
+        fake = subprocess.Popen(
+            [sys.executable, os.path.join(BACKEND, 'fake_openai.py'),
+             '--port', str(fake_port), '--latency-ms', str(args.latency_ms)],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        processes.append(fake)
+        server = subprocess.Popen(
+            [sys.executable, '-c', f"import app; app.app.run(host='127.0.0.1', port={app_port}, threaded=True)"],
+            cwd=APP_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        processes.append(server)
+        wait_until_up(f'http://127.0.0.1:{fake_port}/stats', fake)
+        wait_until_up(f'{base_url}/metrics', server)
+
+        endpoints = bench_endpoints(base_url, fixtures, args)
+        stages = scrape_stages(base_url)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+    # Same throwaway directories, so the import doesn't touch real data
+    for name in ('DATABASE_PATH', 'STORAGE_DIR', 'THUMBNAIL_DIR', 'LOG_LEVEL'):
+        os.environ[name] = env[name]
+    micro = bench_micro(fixtures, args.micro_repeat)
+    micro['peak_rss_mb'] = bench_peak_memory(paths, env)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'config': vars(args) | {'fixtures': [name for name, _ in fixtures]},
+        'endpoints': endpoints,
+        'stages': stages,
+        'micro': micro,
+    }
+
+    columns = ['requests', 'errors', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms']
+    print(f"{'endpoint':<22}" + ''.join(f"{c:>16}" for c in columns))
+    for name, row in endpoints.items():
+        print(f"{name:<22}" + ''.join(f"{row[c]:>16,.1f}" for c in columns))
+    print()
+    for stage, row in sorted(stages.items()):
+        print(f"{'stage ' + stage:<22}{row.get('p50_ms', 0):>16,.1f}{row.get('p95_ms', 0):>16,.1f}")
+    print()
+    for name, row in micro['prepare_image_for_api'].items():
+        print(f"{'prepare ' + name:<22}{row['mean_ms']:>16,.1f}")
+    for name, row in micro['create_mask'].items():
+        print(f"{'create_mask ' + name:<22}{row['mean_ms']:>16,.3f}")
+    for size, row in micro['prepare_by_size'].items():
+        print(f"{f'prepare {size}px':<22}{row['mean_ms']:>16,.1f}{row['png_bytes'] / 1024:>14,.0f} KB")
+    for name, peak in micro['peak_rss_mb'].items():
+        print(f"{'peak RSS MB ' + name:<22}{peak:>16,.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
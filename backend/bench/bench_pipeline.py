@@ -0,0 +1,111 @@
+"""Per-request allocation and byte-copy report for the edit upload path.
+
+Runs the preprocessing and upload hand-off for each room fixture two
+ways: the old path (PNGs written to temp files and read back) and the
+current in-memory path that passes the PNG bytes straight to the client.
+Nothing is sent upstream. Preprocessing runs in this process
+(PREPROCESS_WORKERS=0) so tracemalloc sees its allocations, and the
+copies each path makes show up in the peak traced bytes.
+
+    python bench/bench_pipeline.py --json pipeline.json
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOMS = os.path.join(HERE, '..', '..', 'frontend', 'public', 'rooms')
+sys.path.insert(0, os.path.join(HERE, '..', 'app'))
+
+# app.py refuses to start without a key and creates its database and
+# storage directories on import; keep them all in a throwaway directory
+WORKDIR = tempfile.mkdtemp(prefix='bench-pipeline-')
+os.environ.update(
+    OPENAI_API_KEY='bench',
+    DATABASE_PATH=os.path.join(WORKDIR, 'bench.db'),
+    STORAGE_DIR=os.path.join(WORKDIR, 'stored_images'),
+    THUMBNAIL_DIR=os.path.join(WORKDIR, 'thumbnails'),
+    PREPROCESS_WORKERS='0',
+)
+import app  # noqa: E402
+
+
+def legacy_handoff(processed_image, mask_data, counters):
+    """What generate_designs used to do before calling images.edit"""
+    temp_files = []
+    try:
+        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as image_temp, \
+             tempfile.NamedTemporaryFile(suffix='.png', delete=False) as mask_temp:
+            image_temp.write(processed_image)
+            mask_temp.write(mask_data)
+            temp_files.extend([image_temp.name, mask_temp.name])
+        counters['disk_written'] += len(processed_image) + len(mask_data)
+
+        # The client reads each file object in full to build the multipart body
+        with open(temp_files[0], 'rb') as image_file, open(temp_files[1], 'rb') as mask_file:
+            parts = (image_file.read(), mask_file.read())
+        counters['disk_read'] += sum(len(p) for p in parts)
+        return parts
+    finally:
+        for temp_file in temp_files:
+            os.unlink(temp_file)
+
+
+def inmemory_handoff(processed_image, mask_data, counters):
+    """The tuples request_edit passes to images.edit"""
+    return ("image.png", processed_image, "image/png"), ("mask.png", mask_data, "image/png")
+
+
+def measure(handoff, image_data):
+    counters = {'disk_written': 0, 'disk_read': 0}
+    tracemalloc.start()
+    start = time.perf_counter()
+    processed_image = app.prepare_image_for_api(image_data)
+    mask_data = app.create_mask()
+    handoff(processed_image, mask_data, counters)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'ms': elapsed * 1000,
+        'peak_traced_bytes': peak,
+        'png_bytes': len(processed_image) + len(mask_data),
+        'disk_bytes_written': counters['disk_written'],
+        'disk_bytes_read': counters['disk_read'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Edit upload path allocation report')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    for path in sorted(glob.glob(os.path.join(ROOMS, '*.jpg'))):
+        with open(path, 'rb') as f:
+            image_data = f.read()
+        results[os.path.basename(path)] = {
+            'legacy': measure(legacy_handoff, image_data),
+            'inmemory': measure(inmemory_handoff, image_data),
+        }
+
+    columns = ['ms', 'peak_traced_bytes', 'disk_bytes_written', 'disk_bytes_read']
+    print(f"{'fixture':<12}{'mode':<10}" + ''.join(f"{c:>20}" for c in columns))
+    for name, modes in results.items():
+        for mode, row in modes.items():
+            print(f"{name:<12}{mode:<10}" + ''.join(f"{row[c]:>20,.0f}" for c in columns))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
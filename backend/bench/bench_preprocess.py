@@ -0,0 +1,144 @@
+"""Throughput of upload preprocessing on threads versus worker processes.
+
+Runs the room fixtures in frontend/public/rooms through a Preprocessor
+from concurrent callers, first in-thread (PREPROCESS_WORKERS=0, the GIL
+decides) and then with 1, 2, ... worker processes up to the core count.
+It also times the shared-memory hand-off against pickling the same
+bytes through a plain process pool. Then it prints the PNG size and
+encode time of each compression level:
+
+    python bench/bench_preprocess.py --uploads 48 --json preprocess.json
+
+Throughput can only scale up to the number of cores the machine has;
+the results record os.cpu_count() next to the numbers.
+"""
+import argparse
+import glob
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, '..', 'app')
+ROOMS = os.path.join(HERE, '..', '..', 'frontend', 'public', 'rooms')
+sys.path.insert(0, APP_DIR)
+import imaging  # noqa: E402
+from preprocess import Preprocessor  # noqa: E402
+
+COMPRESS_LEVELS = (0, 1, 3, 6, 9)
+
+
+def prepare_pickled(image_data, size, compress_level):
+    """Baseline for the hand-off: upload and PNG pickled through the pool's pipes"""
+    return imaging.prepare_image(image_data, size, compress_level)
+
+
+def run(call, uploads, concurrency):
+    """Images per second with concurrency callers working through uploads"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as callers:
+        for _ in callers.map(call, uploads):
+            pass
+    return len(uploads) / (time.perf_counter() - start)
+
+
+def bench_scaling(uploads, worker_counts, compress_level):
+    results = []
+    for workers in worker_counts:
+        preprocessor = Preprocessor(workers, max_queued=len(uploads), max_wait=600, compress_level=compress_level)
+        preprocessor.warm()
+        try:
+            # Twice as many callers as workers keeps every worker busy
+            concurrency = max(1, workers) * 2
+            throughput = run(preprocessor.prepare, uploads, concurrency)
+        finally:
+            preprocessor.shutdown()
+        results.append({'workers': workers, 'mode': 'processes' if workers else 'thread',
+                        'concurrency': concurrency, 'images_per_second': throughput})
+        print(f"{'in-thread' if not workers else f'{workers} worker(s)':<14} concurrency {concurrency:>2}  "
+              f"{throughput:6.2f} images/s")
+    return results
+
+
+def bench_handoff(uploads, compress_level):
+    """One worker each way, so only the transfer differs"""
+    pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+    pool.submit(os.getpid).result()
+    try:
+        pickled = run(lambda data: pool.submit(prepare_pickled, data, (1024, 1024), compress_level).result(), uploads, 2)
+    finally:
+        pool.shutdown()
+    preprocessor = Preprocessor(1, max_queued=len(uploads), max_wait=600, compress_level=compress_level)
+    preprocessor.warm()
+    try:
+        shared = run(preprocessor.prepare, uploads, 2)
+    finally:
+        preprocessor.shutdown()
+    print(f"hand-off       pickled {pickled:6.2f} images/s, shared memory {shared:6.2f} images/s")
+    return {'pickled_images_per_second': pickled, 'shared_memory_images_per_second': shared}
+
+
+def bench_compress_levels(fixtures, repeat):
+    """Encode time and size of the 1024x1024 square at each zlib level"""
+    squares = []
+    for _, data in fixtures:
+        png, _ = imaging.prepare_image(data, compress_level=0)
+        squares.append(Image.open(io.BytesIO(png)).copy())
+
+    results = []
+    for level in COMPRESS_LEVELS:
+        seconds, size = [], 0
+        for square in squares:
+            for _ in range(repeat):
+                output = io.BytesIO()
+                start = time.perf_counter()
+                square.save(output, format='PNG', compress_level=level)
+                seconds.append(time.perf_counter() - start)
+            size += output.tell()
+        row = {'level': level, 'mean_ms': sum(seconds) / len(seconds) * 1000, 'mean_kb': size / len(squares) / 1024}
+        results.append(row)
+        print(f"compress_level {level}  {row['mean_ms']:7.1f} ms  {row['mean_kb']:7.0f} KB")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Preprocessing throughput benchmark')
+    parser.add_argument('--uploads', type=int, default=32, help='uploads per configuration')
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--compress-level', type=int, default=imaging.PNG_COMPRESS_LEVEL)
+    parser.add_argument('--repeat', type=int, default=2, help='encodes per fixture and compression level')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    fixtures = []
+    for path in sorted(glob.glob(os.path.join(ROOMS, 'room*.jpg'))):
+        with open(path, 'rb') as f:
+            fixtures.append((os.path.basename(path), f.read()))
+    if not fixtures:
+        parser.error(f"no fixtures found in {ROOMS}")
+    uploads = [fixtures[i % len(fixtures)][1] for i in range(args.uploads)]
+
+    print(f"{os.cpu_count()} CPU(s), {len(uploads)} uploads per run, compress_level {args.compress_level}")
+    results = {
+        'config': vars(args),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'scaling': bench_scaling(uploads, [0] + list(range(1, args.max_workers + 1)), args.compress_level),
+        'handoff': bench_handoff(uploads, args.compress_level),
+        'compress_levels': bench_compress_levels(fixtures, args.repeat),
+    }
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Search, facet and stats latency over a large generation history.
+
+Fills a throwaway database with --rows generations (the app's own
+prompts for every style and room type, a share of them with custom
+prompts, spread over --days days), then times the search and stats
+functions behind /api/generations/search and /api/generations/stats.
+The facet and daily counts read from the trigger-maintained aggregate
+tables are compared, for time and result, with the GROUP BY scans they
+replace:
+
+    python bench/bench_search.py --rows 300000 --json search.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(HERE, '..', 'app')
+PERCENTILES = (50, 90, 99)
+STYLES = ['modern minimalist', 'luxury classic', 'scandinavian', 'industrial', 'bohemian', 'contemporary']
+
+CUSTOM_PROMPTS = [
+    'add a fireplace', 'lots of green plants', 'a reading nook by the window', 'warm wood tones',
+    'a large abstract painting', 'velvet emerald sofa', 'minimal clutter', 'a home office corner',
+    'brass pendant lights', 'a kids play area', 'a bar cart with glassware', 'moody dark walls',
+]
+SEARCHES = {
+    'common': 'sofa',
+    'rare': 'fireplace',
+    'phrase_words': 'reading nook window',
+    'custom_rare': 'glassware',
+}
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {f'p{p}_ms': samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000 for p in PERCENTILES}
+
+
+def timed(fn, repeat):
+    samples, result = [], None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return percentiles(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='History search benchmark')
+    parser.add_argument('--rows', type=int, default=300000)
+    parser.add_argument('--days', type=int, default=365, help='days the history is spread over')
+    parser.add_argument('--custom-share', type=float, default=0.3, help='share of rows with a custom prompt')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench-search-')
+    os.environ.update(
+        DATABASE_PATH=os.path.join(workdir, 'bench.db'),
+        STORAGE_DIR=os.path.join(workdir, 'stored_images'),
+        THUMBNAIL_DIR=os.path.join(workdir, 'thumbnails'),
+        OPENAI_API_KEY='bench',
+        PREPROCESS_WORKERS='0',
+        LOG_LEVEL='WARNING',
+    )
+    sys.path.insert(0, APP_DIR)
+    import app  # noqa: E402
+    import db  # noqa: E402
+    import search  # noqa: E402
+
+    rng = random.Random(args.seed)
+    room_types = sorted(set(app.ROOM_TYPE_MAPPING.values()))
+    start_day = time.time() - args.days * 86400
+
+    def row(i):
+        style, room_type = rng.choice(STYLES), rng.choice(room_types)
+        custom = rng.choice(CUSTOM_PROMPTS) if rng.random() < args.custom_share else ''
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start_day + i * args.days * 86400 / args.rows))
+        return (f'o{i}.jpg', f'g{i}.png', style, room_type, stamp,
+                app.build_prompt(style, room_type, custom), custom or None)
+
+    start = time.perf_counter()
+    batch = 5000
+    for offset in range(0, args.rows, batch):
+        db.execute_many('''
+            INSERT INTO generated_images
+            (original_path, generated_path, style, room_type, timestamp, prompt, custom_prompt)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [row(i) for i in range(offset, min(offset + batch, args.rows))])
+    insert_seconds = time.perf_counter() - start
+    db.execute('ANALYZE')
+    size_mb = os.path.getsize(os.environ['DATABASE_PATH']) / 1e6
+    print(f"{args.rows:,} rows inserted in {insert_seconds:.1f}s ({args.rows / insert_seconds:,.0f}/s), "
+          f"database {size_mb:.0f} MB")
+
+    results = {'config': vars(args), 'insert_rows_per_second': args.rows / insert_seconds,
+               'database_mb': size_mb, 'search': {}, 'aggregates': {}}
+
+    for name, text in SEARCHES.items():
+        def first_page():
+            # Counted afresh every time, as for the first request for a query
+            search._matching_facet_counts.cache_clear()
+            return app.search_generations(text, 50)
+
+        stats, (payload, cursor) = timed(first_page, args.repeat)
+        after = app.decode_cursor(cursor) if cursor else None
+        next_page, _ = timed(lambda: app.search_generations(text, 50, after), args.repeat)
+        filtered, _ = timed(lambda: app.search_generations(text, 50, None, STYLES[0], room_types[0]), args.repeat)
+        results['search'][name] = {'query': text, 'total': payload['total'], 'first_page': stats,
+                                   'next_page': next_page, 'filtered_page': filtered}
+        print(f"search {text!r:<22} {payload['total']:>8,} matches  first page p50 {stats['p50_ms']:6.1f} ms  "
+              f"p99 {stats['p99_ms']:6.1f} ms  next page p50 {next_page['p50_ms']:5.1f} ms  "
+              f"filtered p50 {filtered['p50_ms']:5.1f} ms")
+
+    browse, _ = timed(lambda: app.search_generations('', 50), args.repeat)
+    results['search']['browse'] = {'page': browse}
+    print(f"browse (no q) with facets    page p50 {browse['p50_ms']:7.1f} ms")
+
+    comparisons = {
+        'facets': (
+            search.facet_counts,
+            lambda: {(s, r): c for s, r, c in db.query(
+                'SELECT style, room_type, COUNT(*) FROM generated_images GROUP BY style, room_type')},
+        ),
+        'daily': (
+            lambda: search.daily_volume(args.days + 1),
+            lambda: db.query(
+                "SELECT date(timestamp), COUNT(*), COUNT(custom_prompt) FROM generated_images "
+                "WHERE timestamp >= date('now', ?) GROUP BY date(timestamp)", (f'-{args.days} days',)),
+        ),
+    }
+    for name, (aggregate, scan) in comparisons.items():
+        fast, fast_result = timed(aggregate, args.repeat)
+        slow, slow_result = timed(scan, max(1, args.repeat // 4))
+        if name == 'facets' and fast_result != slow_result:
+            sys.exit(f"aggregate facets disagree with GROUP BY: {fast_result} != {slow_result}")
+        if name == 'daily':
+            by_day = {day['date']: (day['count'], day['customPrompts']) for day in fast_result if day['count']}
+            if by_day != {day: (count, custom) for day, count, custom in slow_result}:
+                sys.exit("aggregate daily volume disagrees with GROUP BY")
+        results['aggregates'][name] = {'aggregate_table': fast, 'group_by_scan': slow}
+        print(f"{name:<8} aggregate table p50 {fast['p50_ms']:7.2f} ms   GROUP BY scan p50 {slow['p50_ms']:8.1f} ms")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Lookup latency of the near-duplicate index at scale.
+
+Fills a MultiIndexHash with random 64-bit hashes, plus a few near copies
+of each query, and times Hamming-radius lookups against a linear scan
+of the same hashes. Both must return the same matches:
+
+    python bench/bench_similarity.py --hashes 100000 --distance 8 --json similarity.json
+
+--combinations splits the hashes across that many style/room indexes,
+as the app does; 1 puts everything in one index (the worst case).
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from similarity import HASH_BITS, MultiIndexHash  # noqa: E402
+
+PERCENTILES = (50, 90, 99)
+
+
+def near(value, distance, rng):
+    """value with distance random bits flipped"""
+    for bit in rng.sample(range(HASH_BITS), distance):
+        value ^= 1 << bit
+    return value
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {f'p{p}_us': samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1e6 for p in PERCENTILES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Similarity index lookup benchmark')
+    parser.add_argument('--hashes', type=int, default=100000)
+    parser.add_argument('--distance', type=int, default=8, help='search radius in bits')
+    parser.add_argument('--combinations', type=int, default=1, help='style/room indexes to spread hashes over')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    per_index = args.hashes // args.combinations
+    values = [rng.getrandbits(HASH_BITS) for _ in range(per_index)]
+    queries = [rng.getrandbits(HASH_BITS) for _ in range(args.queries)]
+    # Each query has a few stored near-duplicates, inside and just outside the radius
+    for query in queries:
+        for distance in (0, args.distance // 2, args.distance, args.distance + 1):
+            values.append(near(query, distance, rng))
+
+    start = time.perf_counter()
+    index = MultiIndexHash(args.distance)
+    for row_id, value in enumerate(values):
+        index.add(value, row_id)
+    build_seconds = time.perf_counter() - start
+
+    indexed, scanned = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found = index.search(query)
+        indexed.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        expected = sorted(
+            ((value ^ query).bit_count(), value, row_id)
+            for row_id, value in enumerate(values) if (value ^ query).bit_count() <= args.distance
+        )
+        scanned.append(time.perf_counter() - start)
+        if found != expected:
+            sys.exit(f"index and scan disagree for {query:016x}: {found} != {expected}")
+
+    results = {
+        'config': vars(args),
+        'hashes_per_index': len(values),
+        'build_seconds': build_seconds,
+        'index': percentiles(indexed),
+        'scan': percentiles(scanned),
+    }
+    print(f"{len(values):,} hashes in one index, radius {args.distance}, built in {build_seconds:.2f}s")
+    for name in ('index', 'scan'):
+        print(f"{name:<8}" + ''.join(f"{key:>12} {value:>10,.1f}" for key, value in results[name].items()))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""Check that the ASGI server answers like the Flask app.
+
+Starts fake_openai.py, then the Flask app and ``uvicorn asgi:app`` side
+by side, each on its own throwaway database and storage directory. Sends
+both the same requests and compares status codes, JSON keys, the headers
+clients depend on (caching, ranges, pagination, Retry-After, CORS) and
+the sequence of server-sent events. ZIP exports are compared by their
+entries, with file names and the manifest's values left out:
+
+    python bench/parity.py
+
+Exits with status 1 and lists the differences if there are any.
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+import requests
+
+from bench_http import APP_DIR, BACKEND, ROOMS, free_port, wait_until_up
+
+ORIGIN = 'http://localhost:3000'
+# Headers compared by value; the rest of a response only has to agree on status and shape
+COMPARED_HEADERS = (
+    'Cache-Control', 'Accept-Ranges', 'Vary', 'Content-Range', 'Retry-After',
+    'Access-Control-Allow-Origin', 'Access-Control-Expose-Headers',
+)
+# Headers that must be present on both or neither, whatever their value
+PRESENT_HEADERS = ('ETag', 'X-Next-Cursor', 'Location')
+# MAX_UPLOAD_BYTES for both servers, small enough to test cheaply
+UPLOAD_LIMIT = 4 * 1024 * 1024
+
+
+def start_servers(workdir, fake_args, extra_env, processes):
+    """Start the fake upstream and both servers, adding them to processes; returns {name: base_url}"""
+    fake_port = free_port()
+    processes.append(subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND, 'fake_openai.py'), '--port', str(fake_port)] + fake_args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    ))
+    wait_until_up(f'http://127.0.0.1:{fake_port}/stats', processes[0])
+
+    commands = {
+        'flask': lambda port: [sys.executable, '-c', f"import app; app.start_background_tasks(); app.app.run(host='127.0.0.1', port={port}, threaded=True)"],
+        'asgi': lambda port: [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(port),
+                              '--log-level', 'warning'],
+    }
+    servers = {}
+    for name, command in commands.items():
+        port = free_port()
+        env = dict(
+            os.environ,
+            OPENAI_API_KEY='parity',
+            OPENAI_BASE_URL=f'http://127.0.0.1:{fake_port}/v1',
+            PUBLIC_BASE_URL=f'http://127.0.0.1:{port}',
+            DATABASE_PATH=os.path.join(workdir, f'{name}.db'),
+            STORAGE_DIR=os.path.join(workdir, name, 'stored_images'),
+            THUMBNAIL_DIR=os.path.join(workdir, name, 'thumbnails'),
+            LOG_LEVEL='WARNING',
+            MAX_UPLOAD_BYTES=str(UPLOAD_LIMIT),
+            **extra_env
+        )
+        process = subprocess.Popen(command(port), cwd=APP_DIR, env=env,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        processes.append(process)
+        servers[name] = f'http://127.0.0.1:{port}'
+        wait_until_up(f'{servers[name]}/metrics', process)
+    return servers
+
+
+def shape(body):
+    """Structure of a JSON body with the values left out"""
+    if isinstance(body, dict):
+        return {key: shape(value) for key, value in sorted(body.items()) if key != 'timings'}
+    if isinstance(body, list):
+        return [shape(body[0])] if body else []
+    return type(body).__name__
+
+
+def sse_events(text):
+    """Event names of a server-sent event stream, in order"""
+    return [line[len('event: '):] for line in text.splitlines() if line.startswith('event: ')]
+
+
+def archive_entries(content):
+    """Folder of every entry in a ZIP, and the manifest's shape"""
+    with zipfile.ZipFile(io.BytesIO(content)) as archive:
+        if archive.testzip() is not None:
+            return 'corrupt'
+        entries = sorted(name.split('/')[0] for name in archive.namelist() if '/' in name)
+        manifest = {}
+        for name in archive.namelist():
+            if name == 'manifest.json':
+                manifest[name] = shape(json.loads(archive.read(name)))
+            elif name == 'manifest.csv':
+                manifest[name] = archive.read(name).decode('utf-8').splitlines()[0]
+    return {'entries': entries, 'manifest': manifest}
+
+
+def describe(response, events=False):
+    """What has to match between the two servers' responses"""
+    summary = {'status': response.status_code}
+    content_type = response.headers.get('Content-Type', '')
+    summary['content-type'] = content_type.split(';')[0].strip()
+    for header in COMPARED_HEADERS:
+        summary[header] = response.headers.get(header)
+    # The ASGI CORS middleware adds Origin to Vary; it changes nothing for a '*' origin
+    if summary['Vary']:
+        summary['Vary'] = ', '.join(v for v in map(str.strip, summary['Vary'].split(',')) if v != 'Origin') or None
+    for header in PRESENT_HEADERS:
+        summary[header] = header in response.headers
+    if events:
+        summary['events'] = sse_events(response.text)
+    elif content_type.startswith('application/json'):
+        summary['body'] = shape(response.json())
+    elif content_type.startswith('application/zip'):
+        summary['archive'] = archive_entries(response.content)
+        summary['attachment'] = response.headers.get('Content-Disposition', '').startswith('attachment;')
+    else:
+        summary['bytes'] = len(response.content)
+    return summary
+
+
+def huge_image():
+    """A small file whose header claims more pixels than the server accepts"""
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('L', (9000, 8000)).save(output, format='JPEG')
+    return output.getvalue()
+
+
+def fixture():
+    path = sorted(glob.glob(os.path.join(ROOMS, 'room*.jpg')))[0]
+    with open(path, 'rb') as f:
+        return os.path.basename(path), f.read()
+
+
+def scenarios(base_url, session, image):
+    """Run every scenario against one server; yields (name, summary)"""
+    name, data = image
+    files = {'image': (name, data, 'image/jpeg')}
+
+    def post(path, **kwargs):
+        return session.post(f'{base_url}{path}', **kwargs)
+
+    def get(path, **kwargs):
+        return session.get(f'{base_url}{path}', **kwargs)
+
+    response = post('/api/generate-designs', files=files, data={'style': 'scandinavian', 'roomType': 'bedroom'})
+    yield 'generate', describe(response)
+    generated = response.json()
+    response = post('/api/generate-designs', files=files, data={'style': 'scandinavian', 'roomType': 'bedroom', 'reuseSimilar': '1'})
+    yield 'generate reusing similar', describe(response)
+    response = post('/api/generate-designs', files=files,
+                    data={'style': 'industrial', 'roomType': 'kitchen', 'customPrompt': 'add a fireplace'})
+    yield 'generate with custom prompt', describe(response)
+    yield 'generate without image', describe(post('/api/generate-designs', data={'style': 'scandinavian'}))
+    yield 'generate with bad mask', describe(post('/api/generate-designs', files=files, data={'mask': 'nonsense'}))
+    oversized = {'image': ('big.jpg', b'\xff' * (UPLOAD_LIMIT + 1), 'image/jpeg')}
+    yield 'generate oversized upload', describe(post('/api/generate-designs', files=oversized))
+    too_many_pixels = {'image': ('huge.jpg', huge_image(), 'image/jpeg')}
+    yield 'generate too many pixels', describe(post('/api/generate-designs', files=too_many_pixels))
+    yield 'job too many pixels', describe(post('/api/jobs', files=too_many_pixels))
+
+    variants = json.dumps([{'style': 'industrial', 'roomType': 'kitchen'}, {'style': 'bohemian', 'roomType': 'bedroom'}])
+    response = post('/api/generate-designs/batch', files=files, data={'variants': variants})
+    summary = describe(response, events=True)
+    # Variants finish in any order; only how many of each kind matters
+    summary['events'] = sorted(summary['events'][:-1]) + summary['events'][-1:]
+    yield 'batch', summary
+    yield 'batch with bad variants', describe(post('/api/generate-designs/batch', files=files, data={'variants': '[]'}))
+    response = post('/api/generate-designs/batch', files=files, data={'variants': variants, 'preview': '256'})
+    summary = describe(response, events=True)
+    summary['events'] = sorted(summary['events'][:-1]) + summary['events'][-1:]
+    yield 'batch of previews', summary
+
+    response = post('/api/generate-designs', files=files,
+                    data={'style': 'bohemian', 'roomType': 'kitchen', 'preview': '512', 'maskStrategy': 'full'})
+    yield 'generate preview', describe(response)
+    preview_id = response.json().get('previewId') if response.ok else None
+    yield 'generate bad preview size', describe(post('/api/generate-designs', files=files, data={'preview': '300'}))
+    yield 'previews', describe(get('/api/previews', params={'limit': 1}))
+    if preview_id:
+        yield 'finalize preview', describe(post(f'/api/previews/{preview_id}/finalize'))
+        yield 'finalize preview again', describe(post(f'/api/previews/{preview_id}/finalize'))
+    yield 'finalize missing preview', describe(post('/api/previews/999999/finalize'))
+
+    response = post('/api/jobs', files=files, data={'style': 'contemporary', 'roomType': 'living room'})
+    yield 'job submit', describe(response)
+    if response.ok:
+        job_id = response.json()['jobId']
+        response = get(f'/api/jobs/{job_id}/events')
+        summary = describe(response, events=True)
+        # Whether 'queued' or 'running' is seen first depends on timing
+        summary['events'] = summary['events'][-1:]
+        yield 'job events', summary
+        yield 'job status', describe(get(f'/api/jobs/{job_id}'))
+    yield 'job not found', describe(get('/api/jobs/missing'))
+    yield 'job events not found', describe(get('/api/jobs/missing/events'))
+
+    response = get('/api/generations', params={'limit': 1})
+    yield 'generations first page', describe(response)
+    cursor = response.headers.get('X-Next-Cursor')
+    if cursor:
+        yield 'generations next page', describe(get('/api/generations', params={'limit': 1, 'cursor': cursor}))
+    yield 'generations by style', describe(get('/api/generations', params={'style': 'industrial'}))
+    yield 'generations bad limit', describe(get('/api/generations', params={'limit': 'many'}))
+    yield 'search custom prompt', describe(get('/api/generations/search', params={'q': 'fireplace'}))
+    response = get('/api/generations/search', params={'q': 'kitchen', 'limit': 1})
+    yield 'search first page', describe(response)
+    cursor = response.headers.get('X-Next-Cursor')
+    if cursor:
+        yield 'search next page', describe(get('/api/generations/search', params={'q': 'kitchen', 'limit': 1, 'cursor': cursor}))
+    yield 'search without text', describe(get('/api/generations/search', params={'style': 'industrial'}))
+    yield 'search with query syntax', describe(get('/api/generations/search', params={'q': '"AND NEAR('}))
+    yield 'search bad cursor', describe(get('/api/generations/search', params={'q': 'sofa', 'cursor': 'zzz'}))
+    yield 'generation stats', describe(get('/api/generations/stats', params={'days': 7}))
+    yield 'generation stats bad days', describe(get('/api/generations/stats', params={'days': 'week'}))
+    yield 'export everything', describe(get('/api/generations/export'))
+    yield 'export csv generated only', describe(
+        get('/api/generations/export', params={'manifest': 'csv', 'include': 'generated', 'q': 'fireplace'}))
+    yield 'export by id', describe(get('/api/generations/export', params={'ids': '1,2'}))
+    yield 'export bad ids', describe(get('/api/generations/export', params={'ids': 'first'}))
+    yield 'export bad manifest', describe(get('/api/generations/export', params={'manifest': 'xml'}))
+
+    stored = generated.get('storedImage')
+    if stored:
+        path = '/api/stored-image/' + stored.split('/api/stored-image/', 1)[1]
+        response = get(path)
+        yield 'stored image', describe(response)
+        etag = response.headers.get('ETag')
+        if etag:
+            yield 'stored image not modified', describe(get(path, headers={'If-None-Match': etag}))
+        yield 'stored image range', describe(get(path, headers={'Range': 'bytes=0-99'}))
+        yield 'thumbnail webp', describe(get(path, params={'w': 256}, headers={'Accept': 'image/webp'}))
+        yield 'thumbnail jpeg', describe(get(path, params={'w': 256}))
+    yield 'stored image missing', describe(get('/api/stored-image/00/00/missing.png'))
+    yield 'stored image traversal', describe(get('/api/stored-image/..%2Fapp.py'))
+
+    yield 'upstream stats', describe(get('/api/upstream/stats'))
+    yield 'cache stats', describe(get('/api/cache/stats'))
+    yield 'metrics', {'status': get('/metrics').status_code}
+
+
+def overload_scenarios(base_url, session, image):
+    """Scenarios for an upstream that rate limits every call"""
+    name, data = image
+    files = {'image': (name, data, 'image/jpeg')}
+    response = session.post(f'{base_url}/api/generate-designs', files=files, data={'style': 'scandinavian'})
+    yield 'generate rate limited', describe(response)
+    # The 429's Retry-After outlasts UPSTREAM_MAX_WAIT, so the next caller is turned away
+    response = session.post(f'{base_url}/api/generate-designs', files=files, data={'style': 'scandinavian'})
+    yield 'generate while cooling down', describe(response)
+
+
+def retry_scenarios(base_url, session, image):
+    """Scenarios for an upstream that still rate limits once retries are used up"""
+    name, data = image
+    files = {'image': (name, data, 'image/jpeg')}
+    response = session.post(f'{base_url}/api/generate-designs', files=files, data={'style': 'industrial'})
+    yield 'generate rate limited after retries', describe(response)
+
+
+def compare(servers, run, image):
+    """Differences between the servers' answers, as printable lines"""
+    results = {}
+    for name, base_url in servers.items():
+        session = requests.Session()
+        session.headers['Origin'] = ORIGIN
+        results[name] = dict(run(base_url, session, image))
+
+    flask, asgi = results['flask'], results['asgi']
+    differences = []
+    for scenario in flask.keys() | asgi.keys():
+        if flask.get(scenario) != asgi.get(scenario):
+            differences.append(f"{scenario}:\n  flask: {flask.get(scenario)}\n  asgi:  {asgi.get(scenario)}")
+    return sorted(flask), differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the Flask and ASGI servers')
+    parser.add_argument('--latency-ms', type=float, default=50, help='fake upstream latency per edit')
+    parser.add_argument('--response-format', choices=['url', 'b64_json'], default='url')
+    args = parser.parse_args()
+
+    image = fixture()
+    phases = [
+        ('normal', scenarios, ['--latency-ms', str(args.latency_ms)], {
+            'OPENAI_RESPONSE_FORMAT': args.response_format,
+            'UPSTREAM_RATE': '1000',
+            'UPSTREAM_BURST': '1000',
+        }),
+        ('rate limited', overload_scenarios, ['--rate-limit-probability', '1', '--retry-after', '30'], {
+            'UPSTREAM_RETRIES': '0',
+            'UPSTREAM_MAX_WAIT': '1',
+        }),
+        ('rate limited, retried', retry_scenarios, ['--rate-limit-probability', '1', '--retry-after', '1'], {
+            'UPSTREAM_RETRIES': '1',
+            'UPSTREAM_MAX_WAIT': '5',
+        }),
+    ]
+    failed = False
+    for phase, run, fake_args, extra_env in phases:
+        with tempfile.TemporaryDirectory(prefix='parity-') as workdir:
+            processes = []
+            try:
+                servers = start_servers(workdir, fake_args, extra_env, processes)
+                checked, differences = compare(servers, run, image)
+            finally:
+                for process in processes:
+                    process.terminate()
+                    process.wait()
+        print(f"{phase}: {len(checked)} scenarios, {len(differences)} differences")
+        for difference in differences:
+            print(difference)
+        failed = failed or bool(differences)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
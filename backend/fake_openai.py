@@ -0,0 +1,125 @@
+"""Local stand-in for the OpenAI images API.
+
+Start it and point the backend at it instead of the real API:
+
+    python fake_openai.py --port 8001 --latency-ms 2000
+    cd app && OPENAI_BASE_URL=http://localhost:8001/v1 OPENAI_API_KEY=test python app.py
+
+Edits return the uploaded image re-encoded as a PNG, either as a URL
+served by this process or inline as b64_json. Rate limiting can be
+simulated with --max-concurrent (429 once more edits than that are in
+flight) and --rate-limit-probability (429 at random).
+"""
+import argparse
+import base64
+import io
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from flask import Flask, request, jsonify, send_file, url_for
+from PIL import Image
+
+app = Flask(__name__)
+
+# Most recent results, served from /files/<id>.png
+MAX_STORED_RESULTS = 256
+results = OrderedDict()
+results_lock = threading.Lock()
+
+config = {
+    'latency': 0.0,
+    'max_concurrent': 0,
+    'rate_limit_probability': 0.0,
+    'retry_after': 1,
+}
+
+in_flight = 0
+in_flight_lock = threading.Lock()
+counters = {'edits': 0, 'rate_limited': 0}
+
+
+def render_result(image_bytes, size):
+    """Produce the 'edited' image for an upload"""
+    width, height = (int(v) for v in size.split('x'))
+    image = Image.open(io.BytesIO(image_bytes)).convert('RGB').resize((width, height))
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.getvalue()
+
+
+def rate_limited():
+    counters['rate_limited'] += 1
+    response = jsonify({'error': {
+        'message': 'Rate limit reached for images per minute.',
+        'type': 'requests',
+        'code': 'rate_limit_exceeded'
+    }})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(config['retry_after'])
+    return response
+
+
+@app.route('/v1/images/edits', methods=['POST'])
+def images_edit():
+    global in_flight
+    if 'image' not in request.files:
+        return jsonify({'error': {'message': 'image is required', 'type': 'invalid_request_error'}}), 400
+
+    with in_flight_lock:
+        over_capacity = config['max_concurrent'] and in_flight >= config['max_concurrent']
+        if over_capacity or random.random() < config['rate_limit_probability']:
+            return rate_limited()
+        in_flight += 1
+        counters['edits'] += 1
+    try:
+        time.sleep(config['latency'])
+    finally:
+        with in_flight_lock:
+            in_flight -= 1
+
+    png = render_result(request.files['image'].read(), request.form.get('size', '1024x1024'))
+    if request.form.get('response_format') == 'b64_json':
+        item = {'b64_json': base64.b64encode(png).decode('ascii')}
+    else:
+        result_id = uuid.uuid4().hex
+        with results_lock:
+            results[result_id] = png
+            while len(results) > MAX_STORED_RESULTS:
+                results.popitem(last=False)
+        item = {'url': url_for('get_file', result_id=result_id, _external=True)}
+
+    return jsonify({'created': int(time.time()), 'data': [item]})
+
+
+@app.route('/stats')
+def stats():
+    with in_flight_lock:
+        return jsonify({**counters, 'in_flight': in_flight})
+
+
+@app.route('/files/<result_id>.png')
+def get_file(result_id):
+    with results_lock:
+        png = results.get(result_id)
+    if png is None:
+        return jsonify({'error': 'not found'}), 404
+    return send_file(io.BytesIO(png), mimetype='image/png')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency-ms', type=float, default=0, help='delay added to every edit call')
+    parser.add_argument('--max-concurrent', type=int, default=0, help='answer 429 above this many edits in flight')
+    parser.add_argument('--rate-limit-probability', type=float, default=0, help='answer 429 at random')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429')
+    args = parser.parse_args()
+
+    config['latency'] = args.latency_ms / 1000
+    config['max_concurrent'] = args.max_concurrent
+    config['rate_limit_probability'] = args.rate_limit_probability
+    config['retry_after'] = args.retry_after
+    app.run(host='127.0.0.1', port=args.port, threaded=True)
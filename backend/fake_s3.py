@@ -0,0 +1,163 @@
+"""Local stand-in for an S3-compatible bucket.
+
+Enough of the S3 REST API (path-style PUT, GET, HEAD and DELETE of
+single objects, copies onto an existing key, and ListObjectsV2 for the
+reconciler) to run the backend
+with STORAGE_BACKEND=s3 without a cloud account:
+
+    python fake_s3.py --port 9000
+    cd app && STORAGE_BACKEND=s3 S3_BUCKET=images S3_ENDPOINT_URL=http://localhost:9000 \\
+        AWS_ACCESS_KEY_ID=test AWS_SECRET_ACCESS_KEY=test S3_REGION=us-east-1 python app.py
+
+Objects are kept in memory. Signatures are not checked. --max-keys
+caps listing pages below S3's 1000 keys, to exercise continuation.
+"""
+import argparse
+import hashlib
+import threading
+import time
+from urllib.parse import quote, unquote
+from xml.sax.saxutils import escape
+
+from flask import Flask, request, Response
+
+app = Flask(__name__)
+
+objects = {}
+objects_lock = threading.Lock()
+config = {'max_keys': 1000}
+
+
+def no_such_key(key):
+    body = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<Error><Code>NoSuchKey</Code><Message>The specified key does not exist.</Message><Key>{key}</Key></Error>'
+    )
+    return Response(body, status=404, mimetype='application/xml')
+
+
+def object_headers(stored):
+    return {
+        'ETag': f'"{stored["etag"]}"',
+        'Content-Length': str(len(stored['body'])),
+        'Content-Type': stored['content_type'],
+        'Cache-Control': stored['cache_control'],
+    }
+
+
+@app.route('/<bucket>/<path:key>', methods=['PUT'])
+def put_object(bucket, key):
+    copy_source = request.headers.get('x-amz-copy-source')
+    if copy_source:
+        return copy_object(bucket, key, unquote(copy_source).lstrip('/'))
+    body = request.get_data()
+    stored = {
+        'body': body,
+        'etag': hashlib.md5(body).hexdigest(),
+        'content_type': request.headers.get('Content-Type', 'binary/octet-stream'),
+        'cache_control': request.headers.get('Cache-Control', ''),
+        'last_modified': time.time(),
+    }
+    with objects_lock:
+        objects[(bucket, key)] = stored
+    return Response(status=200, headers={'ETag': f'"{stored["etag"]}"'})
+
+
+def copy_object(bucket, key, source):
+    """CopyObject; with the REPLACE directive, metadata comes from the request"""
+    source_bucket, _, source_key = source.partition('/')
+    with objects_lock:
+        original = objects.get((source_bucket, source_key))
+        if original is None:
+            return no_such_key(source_key)
+        stored = dict(original, last_modified=time.time())
+        if request.headers.get('x-amz-metadata-directive') == 'REPLACE':
+            stored['content_type'] = request.headers.get('Content-Type', 'binary/octet-stream')
+            stored['cache_control'] = request.headers.get('Cache-Control', '')
+        objects[(bucket, key)] = stored
+    body = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<CopyObjectResult><LastModified>{time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())}</LastModified>'
+        f'<ETag>&quot;{stored["etag"]}&quot;</ETag></CopyObjectResult>'
+    )
+    return Response(body, mimetype='application/xml')
+
+
+@app.route('/<bucket>/<path:key>', methods=['GET', 'HEAD'])
+def get_object(bucket, key):
+    with objects_lock:
+        stored = objects.get((bucket, key))
+    if stored is None:
+        if request.method == 'HEAD':
+            return Response(status=404)
+        return no_such_key(key)
+    body = b'' if request.method == 'HEAD' else stored['body']
+    response = Response(body, headers=object_headers(stored))
+    # Flask would otherwise set Content-Length to 0 for HEAD
+    response.headers['Content-Length'] = str(len(stored['body']))
+    return response
+
+
+@app.route('/<bucket>/<path:key>', methods=['DELETE'])
+def delete_object(bucket, key):
+    with objects_lock:
+        objects.pop((bucket, key), None)
+    return Response(status=204)
+
+
+@app.route('/<bucket>', methods=['GET'])
+def list_objects(bucket):
+    """ListObjectsV2: keys under prefix in order, a page at a time"""
+    if request.args.get('list-type') != '2':
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Error><Code>NotImplemented</Code><Message>Only ListObjectsV2 is supported.</Message></Error>'
+        )
+        return Response(body, status=501, mimetype='application/xml')
+    prefix = request.args.get('prefix', '')
+    # The token is the last key of the previous page
+    after = request.args.get('continuation-token') or request.args.get('start-after', '')
+    max_keys = min(int(request.args.get('max-keys', 1000)), config['max_keys'])
+    url_encoded = request.args.get('encoding-type') == 'url'
+    with objects_lock:
+        keys = sorted(key for b, key in objects if b == bucket and key.startswith(prefix) and key > after)
+        page = [(key, objects[(bucket, key)]) for key in keys[:max_keys]]
+    truncated = len(keys) > max_keys
+
+    def text(value):
+        return escape(quote(value, safe='/') if url_encoded else value)
+
+    contents = ''.join(
+        f'<Contents><Key>{text(key)}</Key>'
+        f'<LastModified>{time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(stored["last_modified"]))}</LastModified>'
+        f'<ETag>&quot;{stored["etag"]}&quot;</ETag><Size>{len(stored["body"])}</Size>'
+        f'<StorageClass>STANDARD</StorageClass></Contents>'
+        for key, stored in page
+    )
+    body = (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+        f'<Name>{escape(bucket)}</Name><Prefix>{text(prefix)}</Prefix>'
+        f'<KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+        + ('<EncodingType>url</EncodingType>' if url_encoded else '')
+        + f'<IsTruncated>{"true" if truncated else "false"}</IsTruncated>'
+        + (f'<NextContinuationToken>{escape(page[-1][0])}</NextContinuationToken>' if truncated else '')
+        + contents
+        + '</ListBucketResult>'
+    )
+    return Response(body, mimetype='application/xml')
+
+
+@app.route('/stats')
+def stats():
+    with objects_lock:
+        return {'objects': len(objects), 'bytes': sum(len(o['body']) for o in objects.values())}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--max-keys', type=int, default=1000, help='most keys in one listing page')
+    args = parser.parse_args()
+    config['max_keys'] = args.max_keys
+    app.run(host='127.0.0.1', port=args.port, threaded=True)
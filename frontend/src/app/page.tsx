@@ -17,6 +17,10 @@ const ROOM_TYPES = [
   { value: 'kitchen', label: 'Kitchen' }
 ];
 
+// History previews are small; ask the backend for a resized copy
+const THUMBNAIL_WIDTH = 384;
+const thumbnailUrl = (url: string) => `${url}?w=${THUMBNAIL_WIDTH}`;
+
 interface Generation {
   id: number;
   originalImage: string;
@@ -39,6 +43,9 @@ export default function Home() {
   const [showHistory, setShowHistory] = useState(false);
   const [history, setHistory] = useState<Generation[]>([]);
   const [isHistoryLoading, setIsHistoryLoading] = useState(false);
+  // Cursor of the next, older page of history, from X-Next-Cursor; null on the last page
+  const [historyCursor, setHistoryCursor] = useState<string | null>(null);
+  const [isLoadingMoreHistory, setIsLoadingMoreHistory] = useState(false);
   const [loadingProgress, setLoadingProgress] = useState(0);
 
   useEffect(() => {
@@ -113,20 +120,48 @@ export default function Home() {
     }
   };
 
+  const fetchHistoryPage = async (cursor: string | null) => {
+    const apiBase = process.env.NEXT_PUBLIC_API_URL || 'https://interior-image-generation.onrender.com/api';
+    const query = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+    const res = await fetch(`${apiBase}/generations${query}`);
+    if (!res.ok) {
+      throw new Error(`History request failed with HTTP ${res.status}`);
+    }
+    const data: Generation[] = await res.json();
+    return { data, nextCursor: res.headers.get('X-Next-Cursor') };
+  };
+
   const fetchHistory = async () => {
     setIsHistoryLoading(true);
     try {
-      const apiBase = process.env.NEXT_PUBLIC_API_URL || 'https://interior-image-generation.onrender.com/api';
-      const res = await fetch(`${apiBase}/generations`);
-      const data: Generation[] = await res.json();
+      const { data, nextCursor } = await fetchHistoryPage(null);
       setHistory(data);
+      setHistoryCursor(nextCursor);
     } catch {
       setHistory([]);
+      setHistoryCursor(null);
     } finally {
       setIsHistoryLoading(false);
     }
   };
 
+  const loadMoreHistory = async () => {
+    if (!historyCursor) return;
+    setIsLoadingMoreHistory(true);
+    try {
+      const { data, nextCursor } = await fetchHistoryPage(historyCursor);
+      setHistory((prev) => {
+        const seen = new Set(prev.map((generation) => generation.id));
+        return [...prev, ...data.filter((generation) => !seen.has(generation.id))];
+      });
+      setHistoryCursor(nextCursor);
+    } catch {
+      // Keep what is shown; the button stays so the page can be retried
+    } finally {
+      setIsLoadingMoreHistory(false);
+    }
+  };
+
   return (
     <main className="min-h-screen bg-black text-white">
       {/* Top Border Line */}
@@ -338,7 +373,7 @@ export default function Home() {
                           <p className="text-sm text-gray-400 mb-2">Original</p>
                           <div className="relative aspect-square rounded-lg overflow-hidden bg-gray-700">
                             <img
-                              src={generation.originalImage}
+                              src={thumbnailUrl(generation.originalImage)}
                               alt="Original room"
                               className="object-cover w-full h-full"
                             />
@@ -348,7 +383,7 @@ export default function Home() {
                           <p className="text-sm text-gray-400 mb-2">Generated</p>
                           <div className="relative aspect-square rounded-lg overflow-hidden bg-gray-700">
                             <img
-                              src={generation.generatedImage}
+                              src={thumbnailUrl(generation.generatedImage)}
                               alt="Generated design"
                               className="object-cover w-full h-full"
                             />
@@ -372,6 +407,17 @@ export default function Home() {
                   ))}
                 </div>
               )}
+              {!isHistoryLoading && historyCursor && (
+                <div className="flex justify-center mt-6">
+                  <button
+                    onClick={loadMoreHistory}
+                    disabled={isLoadingMoreHistory}
+                    className="px-6 py-2 rounded-lg bg-gray-800 hover:bg-gray-700 disabled:opacity-50 disabled:cursor-not-allowed"
+                  >
+                    {isLoadingMoreHistory ? 'Loading...' : 'Load more'}
+                  </button>
+                </div>
+              )}
             </div>
           </div>
         </>